@@ -1,20 +1,73 @@
-from pyrr import Vector3, Matrix44, vector4
+from pyrr import Vector3, Matrix44, Vector4
 
 from modelplane.gfx.trackball import Trackball
 
 
 class Camera:
+    """ A view into the scene: a trackball orientation, a position and a perspective projection.
+
+    The view, projection and view-projection matrices are cached and only
+    computed again after something they depend on changed.
+    """
 
     _DEFAULT_POSITION = Vector3([0.0, 0.0, 0.0])
     _DEFAULT_DISTANCE = 2.0
+    _DEFAULT_FOV = 70
+    _DEFAULT_NEAR_PLANE = 0.1
+    _DEFAULT_FAR_PLANE = 800.0
 
-    def __init__(self, position=_DEFAULT_POSITION, distance=_DEFAULT_DISTANCE):
+    def __init__(self, position=_DEFAULT_POSITION, distance=_DEFAULT_DISTANCE, fov=_DEFAULT_FOV,
+                 near=_DEFAULT_NEAR_PLANE, far=_DEFAULT_FAR_PLANE, theta=0, phi=0):
         self.distance = distance
-        self.position = position
-        self.trackball = Trackball(theta=0, distance=self.distance)
+        self.position = Vector3(position)  # A copy, translate() changes it in place
+        self.trackball = Trackball(theta=theta, phi=phi, distance=self.distance)
+
+        self.fov = fov
+        self.near = near
+        self.far = far
+        self.aspect = 1.0
+        self.viewport = (0, 0, 1, 1)  # x, y from the bottom, width and height in window pixels
+
+        self._view = None
+        self._view_key = None
+        self._projection = None
+        self._projection_key = None
+        self._view_projection = None
+        self._view_projection_key = None
 
     def translate(self, x, y, z):
         self.position += [x, y, z]
 
+    def set_viewport(self, width, height, x=0, y=0):
+        """ Fit the projection and trackball to a viewport of width by height pixels at x, y. """
+        if width > 0 and height > 0:
+            self.viewport = (x, y, width, height)
+            self.aspect = float(width) / float(height)
+            self.trackball.resize(width, height)
+
     def matrix(self):
         return Matrix44(self.trackball.matrix)
+
+    def view_matrix(self):
+        key = (self.trackball.revision, float(self.position[0]), float(self.position[1]), float(self.position[2]))
+        if key != self._view_key:
+            self._view = Matrix44.from_translation(self.position) * self.matrix()
+            self._view_key = key
+        return self._view
+
+    def projection_matrix(self):
+        # The camera looks at the trackball's center from its distance
+        key = (self.fov, self.aspect, self.near, self.far, self.distance)
+        if key != self._projection_key:
+            self._projection = Matrix44.perspective_projection(self.fov, self.aspect, self.near, self.far) * \
+                Matrix44.from_translation(Vector4([0.0, 0.0, -self.distance, 0.0]))
+            self._projection_key = key
+        return self._projection
+
+    def view_projection(self):
+        view = self.view_matrix()
+        projection = self.projection_matrix()
+        if self._view_projection_key != (self._view_key, self._projection_key):
+            self._view_projection = projection * view
+            self._view_projection_key = (self._view_key, self._projection_key)
+        return self._view_projection
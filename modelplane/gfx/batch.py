@@ -0,0 +1,129 @@
+import numpy
+
+from OpenGL.GL import *
+
+from modelplane.gfx.instance_buffer import InstanceBuffer
+from modelplane.gfx.mesh.layout import STANDARD
+from modelplane.gfx.mesh.registry import Mesh
+from modelplane.gfx.state import gl_state
+from modelplane.gfx.util.capabilities import supports
+
+_MAX_BATCH_VERTICES = 8192  # Larger meshes are drawn on their own, copying them would cost more than the draw call
+
+# count, instance count, first index, base vertex, base instance: DrawElementsIndirectCommand
+_COMMAND_FIELDS = 5
+_INSTANCE_COUNT = 1
+_BASE_INSTANCE = 4
+
+
+class StaticBatch:
+    """ Many small static meshes packed into shared buffers and drawn with one multi-draw.
+
+    Every mesh becomes one indirect draw command into the shared vertex and index
+    buffers, instanced over the visible shapes using it. The packed geometry and
+    the command buffer are only rebuilt when the set of meshes changes; culling
+    just rewrites the instance counts. Without glMultiDrawElementsIndirect the
+    commands are issued one by one from the shared vertex array, which still
+    saves a vertex array switch per mesh.
+    """
+
+    def __init__(self, meshes):
+        if not meshes:
+            raise ValueError('A batch needs at least one mesh')
+
+        self.meshes = list(meshes)
+        self.membership = frozenset(self.meshes)
+        self.multi_draw_indirect = supports(4, 3, 'GL_ARB_multi_draw_indirect')
+
+        vertex_counts = numpy.array([mesh.vertex_count() for mesh in self.meshes], numpy.int64)
+        index_counts = numpy.array([len(mesh.indices) for mesh in self.meshes], numpy.int64)
+
+        # The meshes' vertices already are in the batch's layout. Indices are relative to each mesh's
+        # base vertex, so they fit 16 bits however many meshes there are.
+        vertices = numpy.concatenate([mesh.vertex_buffer.data for mesh in self.meshes])
+        indices = numpy.concatenate([mesh.indices for mesh in self.meshes]).astype(numpy.uint16)
+
+        # Indices stay relative to their mesh, the base vertex of each command offsets them
+        self.commands = numpy.zeros((len(self.meshes), _COMMAND_FIELDS), numpy.uint32)
+        self.commands[:, 0] = index_counts
+        self.commands[:, 2] = numpy.cumsum(index_counts) - index_counts
+        self.commands[:, 3] = numpy.cumsum(vertex_counts) - vertex_counts
+
+        self.vao, self.vbo, self.ebo = Mesh._create_vao(vertices, indices, GL_STATIC_DRAW, STANDARD)
+        self.instances = InstanceBuffer(len(self.meshes))
+        self.instances.attach(self.vao)
+
+        # The indirect buffer binding is not vertex array state and is left bound for the draws
+        self.indirect_buffer = glGenBuffers(1)
+        gl_state.bind_buffer(GL_DRAW_INDIRECT_BUFFER, self.indirect_buffer)
+        glBufferData(GL_DRAW_INDIRECT_BUFFER, self.commands.nbytes, self.commands, GL_DYNAMIC_DRAW)
+
+        self._items = None
+        self._group_starts = None
+
+    @staticmethod
+    def supported():
+        # Instances of each command start at their own offset in the instance buffer
+        return supports(4, 2, 'GL_ARB_base_instance')
+
+    @staticmethod
+    def accepts(mesh):
+        """ Whether a mesh can go into a batch: static, fully uploaded, small, in the standard layout and without
+        levels of detail. """
+        return mesh.layout is STANDARD and not mesh.lods and mesh.vertex_buffer.usage == GL_STATIC_DRAW and \
+            not mesh.dirty() and mesh.vertex_count() <= _MAX_BATCH_VERTICES
+
+    def set_items(self, groups):
+        """ Take the scene item indices of the shapes using each mesh, {mesh: item index array}. """
+        items = [groups[mesh] for mesh in self.meshes]
+        sizes = numpy.array([len(group) for group in items], numpy.int64)
+
+        self._items = numpy.concatenate(items)
+        self._group_starts = numpy.cumsum(sizes) - sizes
+
+    def upload_instances(self, world_matrices, tints, visible=None):
+        if visible is None:
+            items = self._items
+            counts = numpy.diff(numpy.append(self._group_starts, len(self._items)))
+        else:
+            mask = visible[self._items]
+            items = self._items[mask]
+            counts = numpy.add.reduceat(mask.astype(numpy.int64), self._group_starts)
+
+        count = len(items)
+        self.instances.reserve(count)
+        self.instances.data['model'][:count] = world_matrices[items]
+        self.instances.data['tint'][:count] = tints[items]
+        self.instances.upload(count)
+
+        self.commands[:, _INSTANCE_COUNT] = counts
+        self.commands[:, _BASE_INSTANCE] = numpy.cumsum(counts) - counts
+
+        gl_state.bind_buffer(GL_DRAW_INDIRECT_BUFFER, self.indirect_buffer)
+        glBufferSubData(GL_DRAW_INDIRECT_BUFFER, 0, self.commands.nbytes, self.commands)
+
+    def render(self):
+        if self.instances.count == 0:
+            return
+
+        gl_state.bind_vertex_array(self.vao)
+        self.draw()
+
+    def draw(self):
+        """ Draw with the batch's vertex array already bound, as a render queue does. """
+        if self.multi_draw_indirect:
+            gl_state.bind_buffer(GL_DRAW_INDIRECT_BUFFER, self.indirect_buffer)
+            glMultiDrawElementsIndirect(GL_TRIANGLES, GL_UNSIGNED_SHORT, None, len(self.commands), 0)
+        else:
+            for count, instances, first, base_vertex, base_instance in self.commands[self.commands[:, 1] > 0]:
+                glDrawElementsInstancedBaseVertexBaseInstance(
+                    GL_TRIANGLES, int(count), GL_UNSIGNED_SHORT, ctypes.c_void_p(int(first) * 2), int(instances),
+                    int(base_vertex), int(base_instance))
+
+    def delete(self):
+        glDeleteVertexArrays(1, [self.vao])
+        glDeleteBuffers(3, [self.vbo, self.ebo, self.indirect_buffer])
+        gl_state.forget_vertex_array(self.vao)
+        gl_state.forget_buffer(self.indirect_buffer)
+        self.instances.delete()
+        self.vao = self.vbo = self.ebo = self.indirect_buffer = 0
@@ -0,0 +1,292 @@
+import numpy
+
+from modelplane.gfx.frustum import classify_aabbs
+
+_LEAF_SIZE = 4
+
+# Refitting node by node only pays off while few items moved
+_INCREMENTAL_REFIT_RATIO = 0.05
+
+
+def transform_aabbs(bounds, matrices):
+    """ World space boxes of N local (min, max) boxes under N model matrices in pyrr's layout. """
+    centers = (bounds[:, 0] + bounds[:, 1]) * 0.5
+    extents = (bounds[:, 1] - bounds[:, 0]) * 0.5
+    rotations = matrices[:, :3, :3]
+
+    world_centers = numpy.einsum('ni,nij->nj', centers, rotations) + matrices[:, 3, :3]
+    world_extents = numpy.einsum('ni,nij->nj', extents, numpy.abs(rotations))
+
+    return numpy.stack([world_centers - world_extents, world_centers + world_extents], axis=1)
+
+
+def intersect_ray_aabbs(origin, inverse_direction, mins, maxs):
+    """ Slab test of one ray against N boxes. Returns which boxes are hit and the distance the ray enters them. """
+    near = (mins - origin) * inverse_direction
+    far = (maxs - origin) * inverse_direction
+
+    t_enter = numpy.maximum(numpy.minimum(near, far).max(axis=1), 0.0)
+    t_exit = numpy.maximum(near, far).min(axis=1)
+
+    return t_exit >= t_enter, t_enter
+
+
+def inverse_direction(direction):
+    # Axis parallel rays would divide by zero, a tiny component keeps the slab test finite
+    direction = numpy.asarray(direction, numpy.float64)
+    direction = numpy.where(numpy.abs(direction) < 1e-12, 1e-12, direction)
+    return 1.0 / direction
+
+
+def _spread_bits(values):
+    """ Insert two zero bits between each of the lower 10 bits of the values. """
+    values = values.astype(numpy.uint32)
+    values = (values | (values << 16)) & 0x030000FF
+    values = (values | (values << 8)) & 0x0300F00F
+    values = (values | (values << 4)) & 0x030C30C3
+    values = (values | (values << 2)) & 0x09249249
+    return values
+
+
+def _morton_codes(points):
+    """ 30 bit Morton codes of points quantized to a 1024^3 grid over their bounds. """
+    if len(points) == 0:
+        return numpy.zeros(0, numpy.uint32)
+
+    low = points.min(axis=0)
+    extent = numpy.maximum(points.max(axis=0) - low, 1e-12)
+    cells = numpy.clip((points - low) / extent * 1023.0, 0.0, 1023.0)
+
+    return (_spread_bits(cells[:, 0]) << 2) | (_spread_bits(cells[:, 1]) << 1) | _spread_bits(cells[:, 2])
+
+
+class CullStats:
+
+    def __init__(self):
+        self.nodes_tested = 0
+        self.items_tested = 0
+        self.visible = 0
+        self.total = 0
+
+    def reset(self, total=0):
+        self.nodes_tested = 0
+        self.items_tested = 0
+        self.visible = 0
+        self.total = total
+
+    def __str__(self):
+        return f'visible {self.visible}/{self.total}, tested {self.nodes_tested} nodes and {self.items_tested} items'
+
+
+class BVH:
+    """ Bounding volume hierarchy over N axis aligned boxes, given as an N x 2 x 3 (min, max) array.
+
+    Nodes are stored in flat arrays one level after another, the two children
+    of a node next to each other. Every node covers a contiguous range of the
+    item order, so a node entirely inside a frustum accepts its whole range
+    without visiting its children.
+    """
+
+    def __init__(self, bounds, leaf_size=_LEAF_SIZE):
+        self.bounds = numpy.array(bounds, numpy.float32)
+        self.leaf_size = leaf_size
+        self._build()
+
+    def __len__(self):
+        return len(self.bounds)
+
+    def _build(self):
+        count = len(self.bounds)
+        centroids = (self.bounds[:, 0] + self.bounds[:, 1]) * 0.5
+
+        # Sorting the items along a Morton curve keeps spatially close items in nearby ranges,
+        # so the tree is a balanced split of that order and can be built a whole level at a time
+        self.order = numpy.argsort(_morton_codes(centroids), kind='stable')
+
+        starts = [numpy.zeros(1, numpy.int64)]
+        ends = [numpy.full(1, count, numpy.int64)]
+        parents = [numpy.full(1, -1, numpy.int64)]
+        lefts = []
+        first_node = 0
+
+        while True:
+            level_starts, level_ends = starts[-1], ends[-1]
+            split = numpy.flatnonzero(level_ends - level_starts > self.leaf_size)
+
+            next_first_node = first_node + len(level_starts)
+            level_lefts = numpy.full(len(level_starts), -1, numpy.int64)
+            level_lefts[split] = next_first_node + 2 * numpy.arange(len(split))
+            lefts.append(level_lefts)
+
+            if len(split) == 0:
+                break
+
+            middles = (level_starts[split] + level_ends[split]) // 2
+            starts.append(numpy.stack([level_starts[split], middles], axis=1).ravel())
+            ends.append(numpy.stack([middles, level_ends[split]], axis=1).ravel())
+            parents.append(numpy.repeat(first_node + split, 2))
+            first_node = next_first_node
+
+        self.node_start = numpy.concatenate(starts)
+        self.node_end = numpy.concatenate(ends)
+        self.node_parent = numpy.concatenate(parents)
+        self.node_left = numpy.concatenate(lefts)
+        self.node_right = numpy.where(self.node_left >= 0, self.node_left + 1, -1)
+        self.node_bounds = numpy.zeros((len(self.node_start), 2, 3), numpy.float32)
+
+        # Leaves sorted by where their range starts cover the item order back to back
+        leaves = numpy.flatnonzero(self.node_left < 0)
+        self._leaves = leaves[numpy.argsort(self.node_start[leaves])]
+        self.item_leaf = numpy.zeros(count, numpy.int64)
+        self.item_leaf[self.order] = numpy.repeat(self._leaves,
+                                                  self.node_end[self._leaves] - self.node_start[self._leaves])
+
+        # Internal nodes of each level, deepest first, for refitting level by level
+        level_offsets = numpy.cumsum([0] + [len(level) for level in lefts])
+        self._refit_levels = []
+        for level in range(len(lefts) - 1, -1, -1):
+            nodes = numpy.arange(level_offsets[level], level_offsets[level + 1])
+            self._refit_levels.append(nodes[self.node_left[nodes] >= 0])
+
+        self._refit_all()
+
+    def _refit_all(self):
+        if len(self.bounds) == 0:
+            return
+
+        # Leaves cover consecutive ranges of the item order, so they reduce in one call each for min and max
+        ordered = self.bounds[self.order]
+        leaf_starts = self.node_start[self._leaves]
+        self.node_bounds[self._leaves, 0] = numpy.minimum.reduceat(ordered[:, 0], leaf_starts)
+        self.node_bounds[self._leaves, 1] = numpy.maximum.reduceat(ordered[:, 1], leaf_starts)
+
+        for nodes in self._refit_levels:
+            left = self.node_bounds[self.node_left[nodes]]
+            right = self.node_bounds[self.node_right[nodes]]
+            self.node_bounds[nodes, 0] = numpy.minimum(left[:, 0], right[:, 0])
+            self.node_bounds[nodes, 1] = numpy.maximum(left[:, 1], right[:, 1])
+
+    def _refit_leaf(self, leaf):
+        items = self.order[self.node_start[leaf]:self.node_end[leaf]]
+        bounds = numpy.array([self.bounds[items, 0].min(axis=0), self.bounds[items, 1].max(axis=0)])
+        self.node_bounds[leaf] = bounds
+
+        node = self.node_parent[leaf]
+        while node >= 0:
+            left = self.node_bounds[self.node_left[node]]
+            right = self.node_bounds[self.node_right[node]]
+            bounds = numpy.array([numpy.minimum(left[0], right[0]), numpy.maximum(left[1], right[1])])
+
+            # Ancestors of an unchanged node are unchanged as well
+            if numpy.array_equal(bounds, self.node_bounds[node]):
+                break
+
+            self.node_bounds[node] = bounds
+            node = self.node_parent[node]
+
+    def refit(self, bounds, items=None):
+        """ Update the hierarchy for moved items without rebuilding it.
+
+        items, when known, are the only ones that may have moved, and the others are not compared.
+        """
+        bounds = numpy.asarray(bounds, numpy.float32)
+        if bounds.shape != self.bounds.shape:
+            raise ValueError('Refitting needs bounds for the same items the hierarchy was built with')
+
+        if items is None:
+            changed = numpy.flatnonzero((bounds != self.bounds).any(axis=(1, 2)))
+        else:
+            items = numpy.asarray(items, numpy.int64)
+            changed = items[(bounds[items] != self.bounds[items]).any(axis=(1, 2))]
+
+        if len(changed) == 0:
+            return
+
+        self.bounds[changed] = bounds[changed]
+
+        if len(changed) > _INCREMENTAL_REFIT_RATIO * len(bounds):
+            self._refit_all()
+        else:
+            for leaf in numpy.unique(self.item_leaf[changed]):
+                self._refit_leaf(leaf)
+
+    def _ranges(self, nodes):
+        """ Items covered by the given nodes, concatenated. """
+        starts = self.node_start[nodes]
+        lengths = self.node_end[nodes] - starts
+        offsets = numpy.repeat(starts - numpy.cumsum(lengths) + lengths, lengths)
+        return self.order[offsets + numpy.arange(lengths.sum())]
+
+    def cull(self, planes, stats=None):
+        """ Indices of the items whose boxes are at least partly inside the frustum planes.
+
+        The hierarchy is walked one level at a time, testing all nodes of a level at once.
+        """
+        if stats is None:
+            stats = CullStats()
+        stats.reset(len(self.bounds))
+
+        if len(self.bounds) == 0:
+            return numpy.zeros(0, numpy.int64)
+
+        visible = []
+        nodes = numpy.zeros(1, numpy.int64)
+
+        while len(nodes):
+            stats.nodes_tested += len(nodes)
+
+            node_bounds = self.node_bounds[nodes]
+            outside, inside = classify_aabbs(node_bounds[:, 0], node_bounds[:, 1], planes)
+
+            visible.append(self._ranges(nodes[inside]))
+
+            partial = nodes[~outside & ~inside]
+            is_leaf = self.node_left[partial] < 0
+
+            items = self._ranges(partial[is_leaf])
+            stats.items_tested += len(items)
+            outside, _ = classify_aabbs(self.bounds[items, 0], self.bounds[items, 1], planes)
+            visible.append(items[~outside])
+
+            internal = partial[~is_leaf]
+            nodes = numpy.concatenate([self.node_left[internal], self.node_right[internal]])
+
+        visible = numpy.concatenate(visible)
+        stats.visible = len(visible)
+
+        return visible
+
+    def ray_candidates(self, origin, direction):
+        """ Items in the leaves whose boxes the ray hits, without testing the items' own boxes. """
+        if len(self.bounds) == 0:
+            return numpy.zeros(0, numpy.int64)
+
+        origin = numpy.asarray(origin, numpy.float64)
+        inverse = inverse_direction(direction)
+
+        leaves = []
+        nodes = numpy.zeros(1, numpy.int64)
+
+        while len(nodes):
+            node_bounds = self.node_bounds[nodes]
+            hit, _ = intersect_ray_aabbs(origin, inverse, node_bounds[:, 0], node_bounds[:, 1])
+            nodes = nodes[hit]
+
+            is_leaf = self.node_left[nodes] < 0
+            leaves.append(nodes[is_leaf])
+
+            internal = nodes[~is_leaf]
+            nodes = numpy.concatenate([self.node_left[internal], self.node_right[internal]])
+
+        return self._ranges(numpy.concatenate(leaves))
+
+    def intersect_ray(self, origin, direction):
+        """ Items whose boxes the ray hits, and the distance along the ray at which it enters each box. """
+        items = self.ray_candidates(origin, direction)
+        if len(items) == 0:
+            return items, numpy.zeros(0)
+
+        hit, t_enter = intersect_ray_aabbs(numpy.asarray(origin, numpy.float64), inverse_direction(direction),
+                                           self.bounds[items, 0], self.bounds[items, 1])
+
+        return items[hit], t_enter[hit]
@@ -0,0 +1,169 @@
+import time
+
+import numpy
+
+from OpenGL.GL import *
+
+# Uploads go through the copy write target, which unlike the array and element targets is not vertex array state
+_UPLOAD_TARGET = GL_COPY_WRITE_BUFFER
+
+_MERGE_GAP = 256  # Bytes between two dirty ranges that are cheaper to upload than a second call
+_MAX_RANGES = 32  # Above this many separate ranges the whole dirty span goes up in one call
+_ORPHAN_FRACTION = 0.5  # Share of the buffer that makes replacing all of it the better deal
+
+# Average seconds between updates below which a buffer is treated as streamed
+_STREAM_INTERVAL = 0.1
+_INTERVAL_SMOOTHING = 0.25
+
+
+def merge_ranges(ranges, gap=_MERGE_GAP):
+    """ Sort [start, end) byte ranges and merge the ones overlapping or at most gap bytes apart. """
+    if not ranges:
+        return []
+
+    ranges = sorted(ranges)
+    merged = [list(ranges[0])]
+
+    for start, end in ranges[1:]:
+        if start <= merged[-1][1] + gap:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+
+    return [tuple(r) for r in merged]
+
+
+class DynamicBuffer:
+    """ A GL buffer with a CPU copy that is edited in place and uploaded in dirty ranges.
+
+    Edits only touch the CPU copy and record the changed byte range. flush()
+    merges the ranges and uploads them with glBufferSubData, or orphans and
+    replaces the whole buffer when most of it changed, so the driver never
+    waits for draws still reading the old contents.
+
+    The usage hint follows how the buffer is used: it starts as given, becomes
+    GL_DYNAMIC_DRAW once edited and GL_STREAM_DRAW while edited about every frame.
+    """
+
+    def __init__(self, data, usage=GL_STATIC_DRAW, buffer=None):
+        if data is None:
+            raise ValueError('Buffer data cannot be None')
+
+        self.data = data
+        self.usage = usage
+        self.upload_calls = 0
+        self.uploaded_bytes = 0
+
+        self._ranges = []
+        self._reallocate = False
+        self._last_update = None
+        self._update_interval = None
+
+        # An existing buffer, such as one set up along with a vertex array object, already holds the data
+        if buffer is None:
+            self.buffer = glGenBuffers(1)
+            self.allocated_bytes = 0
+            self._reallocate = True
+            self.flush()
+        else:
+            self.buffer = buffer
+            self.allocated_bytes = self.data.nbytes
+
+    def write(self, first, values):
+        """ Overwrite elements of the data starting at index first. """
+        values = numpy.asarray(values, self.data.dtype).ravel()
+        if first < 0 or first + len(values) > len(self.data):
+            raise ValueError('Write goes past the end of the buffer')
+
+        # Arrays mapped from the mesh cache are read-only, the first edit takes a private copy
+        if not self.data.flags.writeable:
+            self.data = self.data.copy()
+
+        self.data[first:first + len(values)] = values
+
+        itemsize = self.data.itemsize
+        self._ranges.append((first * itemsize, (first + len(values)) * itemsize))
+        self._touched()
+
+    def replace(self, data):
+        """ Swap in new data, which may have a different size. """
+        self.data = numpy.ascontiguousarray(data, self.data.dtype).ravel()
+        self._ranges = []
+        self._reallocate = True
+        self._touched()
+
+    def dirty(self):
+        return self._reallocate or bool(self._ranges)
+
+    def dirty_ranges(self):
+        return merge_ranges(self._ranges)
+
+    def _touched(self):
+        now = time.perf_counter()
+        if self._last_update is not None:
+            interval = now - self._last_update
+            if self._update_interval is None:
+                self._update_interval = interval
+            else:
+                self._update_interval += _INTERVAL_SMOOTHING * (interval - self._update_interval)
+        self._last_update = now
+
+        usage = self._observed_usage()
+        if usage != self.usage:
+            # The hint is only given along with glBufferData
+            self.usage = usage
+            self._reallocate = True
+
+    def _observed_usage(self):
+        if self._update_interval is None:  # Edited once so far
+            return GL_DYNAMIC_DRAW if self.usage == GL_STATIC_DRAW else self.usage
+        return GL_STREAM_DRAW if self._update_interval < _STREAM_INTERVAL else GL_DYNAMIC_DRAW
+
+    def flush(self):
+        """ Upload the dirty parts of the data. Returns the number of bytes uploaded. """
+        if not self.dirty():
+            return 0
+
+        ranges = merge_ranges(self._ranges)
+        if len(ranges) > _MAX_RANGES:
+            ranges = [(ranges[0][0], ranges[-1][1])]
+
+        nbytes = self.data.nbytes
+        dirty_bytes = sum(end - start for start, end in ranges)
+
+        glBindBuffer(_UPLOAD_TARGET, self.buffer)
+
+        if self._reallocate or nbytes != self.allocated_bytes or dirty_bytes >= _ORPHAN_FRACTION * nbytes:
+            # Orphaning: the driver hands out fresh storage and frees the old once the GPU is done with it
+            glBufferData(_UPLOAD_TARGET, nbytes, self.data, self.usage)
+            self.allocated_bytes = nbytes
+            self.upload_calls += 1
+            uploaded = nbytes
+        else:
+            view = self.data.view(numpy.uint8)
+            for start, end in ranges:
+                glBufferSubData(_UPLOAD_TARGET, start, end - start, view[start:end])
+            self.upload_calls += len(ranges)
+            uploaded = dirty_bytes
+
+        glBindBuffer(_UPLOAD_TARGET, 0)
+
+        self._ranges = []
+        self._reallocate = False
+        self.uploaded_bytes += uploaded
+
+        return uploaded
+
+    def upload(self, start, end):
+        """ Upload bytes [start, end) of the data into the buffer, which already has room for all of it. """
+        glBindBuffer(_UPLOAD_TARGET, self.buffer)
+        glBufferSubData(_UPLOAD_TARGET, start, end - start, self.data.view(numpy.uint8)[start:end])
+        glBindBuffer(_UPLOAD_TARGET, 0)
+
+        self.upload_calls += 1
+        self.uploaded_bytes += end - start
+
+    def delete(self):
+        if self.buffer:
+            glDeleteBuffers(1, [self.buffer])
+            self.buffer = 0
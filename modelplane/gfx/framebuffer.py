@@ -0,0 +1,69 @@
+import numpy
+
+from OpenGL.GL import *
+
+from modelplane.gfx.util.error import gl_error_check
+
+
+class Framebuffer:
+    """ A framebuffer object with an RGBA8 color and a depth/stencil renderbuffer. """
+
+    def __init__(self, width, height):
+        if not width or not height or width < 0 or height < 0:
+            raise ValueError('Width and height must be more than 0')
+
+        self.fbo = glGenFramebuffers(1)
+        self.color_buffer, self.depth_buffer = glGenRenderbuffers(2)
+        self.width = 0
+        self.height = 0
+        self.resize(width, height)
+
+    def resize(self, width, height):
+        if width == self.width and height == self.height:
+            return
+
+        self.width = width
+        self.height = height
+
+        glBindRenderbuffer(GL_RENDERBUFFER, self.color_buffer)
+        glRenderbufferStorage(GL_RENDERBUFFER, GL_RGBA8, width, height)
+        glBindRenderbuffer(GL_RENDERBUFFER, self.depth_buffer)
+        glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH24_STENCIL8, width, height)
+        glBindRenderbuffer(GL_RENDERBUFFER, 0)
+
+        glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+        glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_RENDERBUFFER, self.color_buffer)
+        glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_DEPTH_STENCIL_ATTACHMENT, GL_RENDERBUFFER, self.depth_buffer)
+
+        status = glCheckFramebufferStatus(GL_FRAMEBUFFER)
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+
+        if status != GL_FRAMEBUFFER_COMPLETE:
+            raise RuntimeError(f'ERROR: Framebuffer is incomplete: {status}')
+
+        gl_error_check()
+
+    def bind(self):
+        glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+        glViewport(0, 0, self.width, self.height)
+
+    @staticmethod
+    def unbind():
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+
+    def read_pixels(self):
+        """ The color buffer as a height x width x 4 uint8 array, top row first. """
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, self.fbo)
+        glPixelStorei(GL_PACK_ALIGNMENT, 1)
+        data = glReadPixels(0, 0, self.width, self.height, GL_RGBA, GL_UNSIGNED_BYTE)
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, 0)
+
+        pixels = numpy.frombuffer(data, numpy.uint8).reshape(self.height, self.width, 4)
+
+        # OpenGL's rows start at the bottom
+        return numpy.flipud(pixels).copy()
+
+    def delete(self):
+        glDeleteRenderbuffers(2, [self.color_buffer, self.depth_buffer])
+        glDeleteFramebuffers(1, [self.fbo])
+        self.fbo = self.color_buffer = self.depth_buffer = 0
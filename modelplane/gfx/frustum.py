@@ -0,0 +1,35 @@
+import numpy
+
+
+def frustum_planes(view_projection):
+    """ The six planes (left, right, bottom, top, near, far) of a view-projection matrix.
+
+    The matrix is in pyrr's layout, as uploaded to the shaders. Each plane is
+    a normalized (a, b, c, d) row with points inside satisfying ax + by + cz + d >= 0.
+    """
+    m = numpy.asarray(view_projection, numpy.float64).T  # Rows of the OpenGL matrix
+
+    planes = numpy.array([m[3] + m[0], m[3] - m[0],
+                          m[3] + m[1], m[3] - m[1],
+                          m[3] + m[2], m[3] - m[2]])
+    planes /= numpy.linalg.norm(planes[:, :3], axis=1)[:, None]
+
+    return planes
+
+
+def classify_aabbs(mins, maxs, planes):
+    """ Test N axis aligned boxes against the frustum planes at once.
+
+    Returns two boolean arrays: boxes entirely outside of the frustum, and
+    boxes entirely inside of it. Boxes that are in neither intersect it.
+    """
+    centers = (mins + maxs) * 0.5
+    extents = (maxs - mins) * 0.5
+
+    distances = centers @ planes[:, :3].T + planes[:, 3]
+    radii = extents @ numpy.abs(planes[:, :3]).T
+
+    outside = (distances + radii < 0.0).any(axis=1)
+    inside = (distances - radii >= 0.0).all(axis=1)
+
+    return outside, inside
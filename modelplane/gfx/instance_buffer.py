@@ -0,0 +1,103 @@
+import numpy
+
+from OpenGL.GL import *
+
+from modelplane.gfx.state import gl_state
+from modelplane.gfx.util.error import gl_error_check
+
+# Attribute locations of the per-instance data in the vertex shader. Locations
+# below these are left for per-vertex data. A mat4 attribute takes 4 locations.
+MODEL_ATTRIBUTE = 8
+TINT_ATTRIBUTE = 12
+
+INSTANCE_DTYPE = numpy.dtype([('model', numpy.float32, (4, 4)), ('tint', numpy.float32, 4)])
+
+_DEFAULT_CAPACITY = 64
+
+
+class InstanceBuffer:
+    """ Per-instance model matrices and tint colors streamed to the GPU for instanced draws. """
+
+    def __init__(self, capacity=_DEFAULT_CAPACITY):
+        if capacity is None or capacity <= 0:
+            raise ValueError('Instance buffer capacity must be more than 0')
+
+        self.data = numpy.zeros(capacity, INSTANCE_DTYPE)
+        self.count = 0
+        self.vbo = glGenBuffers(1)
+        self._attached_vaos = set()
+        self._allocate()
+
+    def _allocate(self):
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        glBufferData(GL_ARRAY_BUFFER, self.data.nbytes, None, GL_STREAM_DRAW)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    def capacity(self):
+        return len(self.data)
+
+    def reserve(self, count):
+        if count <= self.capacity():
+            return
+
+        # Grow geometrically so a growing scene does not reallocate every frame
+        capacity = self.capacity()
+        while capacity < count:
+            capacity *= 2
+
+        data = numpy.zeros(capacity, INSTANCE_DTYPE)
+        data[:self.count] = self.data[:self.count]
+        self.data = data
+        self._allocate()
+
+    def attach(self, vao):
+        """ Point the instance attributes of the given vertex array object at this buffer. """
+        if vao in self._attached_vaos:
+            return
+
+        gl_state.bind_vertex_array(vao)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+
+        stride = INSTANCE_DTYPE.itemsize
+        column_size = 4 * sizeof(ctypes.c_float)
+
+        for column in range(4):
+            location = MODEL_ATTRIBUTE + column
+            glVertexAttribPointer(location, 4, GL_FLOAT, GL_FALSE, stride, ctypes.c_void_p(column * column_size))
+            glEnableVertexAttribArray(location)
+            glVertexAttribDivisor(location, 1)
+
+        tint_start = ctypes.c_void_p(INSTANCE_DTYPE.fields['tint'][1])
+        glVertexAttribPointer(TINT_ATTRIBUTE, 4, GL_FLOAT, GL_FALSE, stride, tint_start)
+        glEnableVertexAttribArray(TINT_ATTRIBUTE)
+        glVertexAttribDivisor(TINT_ATTRIBUTE, 1)
+
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+        gl_error_check()
+
+        self._attached_vaos.add(vao)
+
+    def detach(self, vao):
+        self._attached_vaos.discard(vao)
+
+    def upload(self, count):
+        if count > self.capacity():
+            raise ValueError('More instances than the instance buffer can hold')
+
+        self.count = count
+
+        if count == 0:
+            return
+
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+        # Orphan the previous contents so the driver does not wait for draws still reading them
+        glBufferData(GL_ARRAY_BUFFER, self.data.nbytes, None, GL_STREAM_DRAW)
+        glBufferSubData(GL_ARRAY_BUFFER, 0, count * INSTANCE_DTYPE.itemsize, self.data[:count])
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+    def delete(self):
+        if self.vbo:
+            glDeleteBuffers(1, [self.vbo])
+            self.vbo = 0
+        self._attached_vaos.clear()
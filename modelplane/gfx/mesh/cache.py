@@ -0,0 +1,236 @@
+import argparse
+import hashlib
+import mmap
+import os
+import struct
+import sys
+
+import numpy
+
+from modelplane.gfx.mesh.registry import mesh_registry
+
+_MAGIC = b'MPMC'
+_VERSION = 1
+_EXTENSION = '.mpmesh'
+_ALIGNMENT = 64  # Vertex and index blocks start on cache line boundaries
+
+# magic, version, mesh count, source path length, source mtime in ns, source size, import options digest
+_HEADER = struct.Struct('<4sIIIqQ20s')
+# vertex block offset, float count, index block offset, index count, mesh registry key
+_MESH_ENTRY = struct.Struct('<QQQQ40s')
+
+VALID = 'valid'
+STALE = 'stale'  # The source file changed since it was cached
+ORPHANED = 'orphaned'  # The source file no longer exists
+CORRUPT = 'corrupt'
+
+
+def _default_directory():
+    return os.environ.get('MODELPLANE_MESH_CACHE',
+                          os.path.join(os.path.expanduser('~'), '.cache', 'modelplane', 'meshes'))
+
+
+def _align(offset):
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def _options_digest(options):
+    return hashlib.sha1(repr(options).encode()).digest()
+
+
+class MeshCache:
+    """ On-disk cache of imported meshes, opened with mmap for zero-copy reloads.
+
+    Each source file and set of import options maps to one cache file holding a
+    header, a table of meshes and the raw, aligned vertex and index blocks. Loading
+    returns NumPy views straight into the mapped file, which PrimitiveShape passes
+    on to glBufferData without copying or parsing anything.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory if directory is not None else _default_directory()
+
+    def path_for(self, source, options=None):
+        source = os.path.abspath(source)
+        name = hashlib.sha1(f'{source}|{options!r}'.encode()).hexdigest()
+        return os.path.join(self.directory, name + _EXTENSION)
+
+    def load(self, source, options=None):
+        """ The cached (vertices, indices, key) meshes for a source file, or None when missing or stale. """
+        cache_path = self.path_for(source, options)
+
+        if not os.path.exists(cache_path):
+            return None
+
+        try:
+            stat = os.stat(source)
+        except OSError:
+            return None
+
+        try:
+            with open(cache_path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+        header = self._read(mapped)
+        if header is None:
+            return None
+
+        mtime_ns, size, digest, entries = header
+        if mtime_ns != stat.st_mtime_ns or size != stat.st_size or digest != _options_digest(options):
+            return None
+
+        # The views keep the mapping alive for as long as the arrays are used
+        meshes = []
+        for vertex_offset, vertex_count, index_offset, index_count, key in entries:
+            vertices = numpy.frombuffer(mapped, numpy.float32, vertex_count, vertex_offset)
+            indices = numpy.frombuffer(mapped, numpy.int32, index_count, index_offset)
+            meshes.append((vertices, indices, key))
+
+        return meshes
+
+    def store(self, source, meshes, options=None):
+        """ Write (vertices, indices) meshes imported from a source file into the cache. """
+        os.makedirs(self.directory, exist_ok=True)
+
+        stat = os.stat(source)
+        source_bytes = os.path.abspath(source).encode()
+        meshes = [(numpy.ascontiguousarray(vertices, numpy.float32).ravel(),
+                   numpy.ascontiguousarray(indices, numpy.int32).ravel()) for vertices, indices, *_ in meshes]
+
+        offset = _align(_HEADER.size + len(source_bytes) + _MESH_ENTRY.size * len(meshes))
+        entries = []
+        for vertices, indices in meshes:
+            vertex_offset = offset
+            index_offset = _align(vertex_offset + vertices.nbytes)
+            offset = _align(index_offset + indices.nbytes)
+            key = mesh_registry.geometry_key(vertices, indices)
+            entries.append(_MESH_ENTRY.pack(vertex_offset, len(vertices), index_offset, len(indices), key.encode()))
+
+        cache_path = self.path_for(source, options)
+        temporary_path = f'{cache_path}.{os.getpid()}.tmp'
+
+        with open(temporary_path, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, _VERSION, len(meshes), len(source_bytes), stat.st_mtime_ns, stat.st_size,
+                                 _options_digest(options)))
+            f.write(source_bytes)
+            f.write(b''.join(entries))
+
+            for (vertices, indices), entry in zip(meshes, entries):
+                vertex_offset, _, index_offset, _, _ = _MESH_ENTRY.unpack(entry)
+                f.seek(vertex_offset)
+                f.write(vertices.tobytes())
+                f.seek(index_offset)
+                f.write(indices.tobytes())
+
+            f.truncate(offset)
+
+        # Readers only ever see a complete file
+        os.replace(temporary_path, cache_path)
+
+        return cache_path
+
+    @staticmethod
+    def _read(mapped):
+        """ Parse and bounds check the header and mesh table. Returns None for a damaged file. """
+        if len(mapped) < _HEADER.size:
+            return None
+
+        magic, version, mesh_count, path_length, mtime_ns, size, digest = _HEADER.unpack_from(mapped, 0)
+        if magic != _MAGIC or version != _VERSION:
+            return None
+
+        table_offset = _HEADER.size + path_length
+        if table_offset + mesh_count * _MESH_ENTRY.size > len(mapped):
+            return None
+
+        entries = []
+        for i in range(mesh_count):
+            vertex_offset, vertex_count, index_offset, index_count, key = \
+                _MESH_ENTRY.unpack_from(mapped, table_offset + i * _MESH_ENTRY.size)
+
+            if vertex_offset % _ALIGNMENT or index_offset % _ALIGNMENT or \
+                    vertex_offset + 4 * vertex_count > len(mapped) or index_offset + 4 * index_count > len(mapped):
+                return None
+
+            entries.append((vertex_offset, vertex_count, index_offset, index_count, key.decode()))
+
+        return mtime_ns, size, digest, entries
+
+    @staticmethod
+    def _source(mapped):
+        _, _, _, path_length, _, _, _ = _HEADER.unpack_from(mapped, 0)
+        return mapped[_HEADER.size:_HEADER.size + path_length].decode()
+
+    def entries(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                      if name.endswith(_EXTENSION))
+
+    def validate(self, cache_path):
+        """ One of VALID, STALE, ORPHANED or CORRUPT for a cache file. """
+        try:
+            with open(cache_path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return CORRUPT
+
+        with mapped:
+            header = self._read(mapped)
+            if header is None:
+                return CORRUPT
+
+            source = self._source(mapped)
+            mtime_ns, size, _, _ = header
+
+        try:
+            stat = os.stat(source)
+        except OSError:
+            return ORPHANED
+
+        if stat.st_mtime_ns != mtime_ns or stat.st_size != size:
+            return STALE
+
+        return VALID
+
+    def collect_garbage(self):
+        """ Delete every cache file that is not valid. Returns the deleted paths with their status. """
+        removed = []
+
+        for cache_path in self.entries():
+            status = self.validate(cache_path)
+            if status != VALID:
+                os.remove(cache_path)
+                removed.append((cache_path, status))
+
+        return removed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Validate or clean up the ModelPlane mesh cache.')
+    parser.add_argument('directory', nargs='?', default=None, help='Cache directory to check')
+    parser.add_argument('--gc', action='store_true', help='Delete stale, orphaned and corrupt cache files')
+    args = parser.parse_args(argv)
+
+    cache = MeshCache(args.directory)
+    print(f'Mesh cache: {cache.directory}')
+
+    if args.gc:
+        removed = cache.collect_garbage()
+        for cache_path, status in removed:
+            print(f'{status:9} removed {cache_path}')
+        print(f'{len(removed)} cache file(s) removed')
+        return
+
+    statuses = [(cache_path, cache.validate(cache_path)) for cache_path in cache.entries()]
+    for cache_path, status in statuses:
+        print(f'{status:9} {cache_path} ({os.path.getsize(cache_path)} bytes)')
+
+    invalid = sum(1 for _, status in statuses if status != VALID)
+    print(f'{len(statuses)} cache file(s), {invalid} invalid')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,228 @@
+from collections import namedtuple
+
+import numpy
+
+from OpenGL.GL import *
+
+from modelplane.gfx.instance_buffer import MODEL_ATTRIBUTE
+
+# Shader inputs the layouts are matched against, with their locations in the viewer shader
+POSITION = 'a_position'
+COLOR = 'a_color'
+NORMAL = 'a_normal'
+TEXCOORD = 'a_texcoord'
+
+# Name of the shader input, its location, number of components and storage format
+VertexAttribute = namedtuple('VertexAttribute', ['name', 'location', 'components', 'format'])
+
+# GL type, whether integers are normalized, and bytes per component. The packed
+# format stores 4 components in 4 bytes.
+_FORMATS = {
+    'f32': (GL_FLOAT, GL_FALSE, 4),
+    'f16': (GL_HALF_FLOAT, GL_FALSE, 2),
+    'snorm16': (GL_SHORT, GL_TRUE, 2),
+    'unorm16': (GL_UNSIGNED_SHORT, GL_TRUE, 2),
+    'snorm8': (GL_BYTE, GL_TRUE, 1),
+    'unorm8': (GL_UNSIGNED_BYTE, GL_TRUE, 1),
+    'snorm10_10_10_2': (GL_INT_2_10_10_10_REV, GL_TRUE, None),
+}
+
+_ALIGNMENT = 4  # Attributes start on 4 byte boundaries, as most hardware wants
+
+_MAX_UINT16_VERTICES = 1 << 16
+_COMPACT_VERTICES = 8192  # Meshes from this many vertices on are stored compact when no layout is asked for
+
+
+def index_dtype(vertex_count):
+    """ uint16 indices when every vertex can be addressed with them, otherwise 32 bit. """
+    return numpy.uint16 if vertex_count <= _MAX_UINT16_VERTICES else numpy.uint32
+
+
+def index_type(dtype):
+    return GL_UNSIGNED_SHORT if numpy.dtype(dtype) == numpy.uint16 else GL_UNSIGNED_INT
+
+
+def encode_indices(indices, vertex_count):
+    """ Indices in the smallest type for the vertex count, without a copy when they already are. """
+    dtype = index_dtype(vertex_count)
+    if dtype == numpy.uint32:
+        # Signed 32 bit indices from the importer are read as unsigned, valid indices look the same
+        return numpy.ascontiguousarray(indices).view(numpy.uint32) if indices.dtype.itemsize == 4 else \
+            numpy.ascontiguousarray(indices, numpy.uint32)
+    return numpy.ascontiguousarray(indices, dtype)
+
+
+def _pack_10_10_10_2(values):
+    values = numpy.clip(values, -1.0, 1.0)
+    packed = numpy.zeros(len(values), numpy.uint32)
+    for component in range(min(values.shape[1], 3)):
+        bits = numpy.round(values[:, component] * 511.0).astype(numpy.int32) & 0x3FF
+        packed |= bits.astype(numpy.uint32) << (10 * component)
+    if values.shape[1] > 3:
+        bits = numpy.round(values[:, 3]).astype(numpy.int32) & 0x3
+        packed |= bits.astype(numpy.uint32) << 30
+    return packed.view(numpy.uint8).reshape(-1, 4)
+
+
+def _encode(values, fmt):
+    """ (n, components) floats in a format, as (n, bytes) uint8. """
+    if fmt == 'f32':
+        encoded = values.astype(numpy.float32)
+    elif fmt == 'f16':
+        encoded = values.astype(numpy.float16)
+    elif fmt == 'snorm16':
+        encoded = numpy.round(numpy.clip(values, -1.0, 1.0) * 32767.0).astype(numpy.int16)
+    elif fmt == 'unorm16':
+        encoded = numpy.round(numpy.clip(values, 0.0, 1.0) * 65535.0).astype(numpy.uint16)
+    elif fmt == 'snorm8':
+        encoded = numpy.round(numpy.clip(values, -1.0, 1.0) * 127.0).astype(numpy.int8)
+    elif fmt == 'unorm8':
+        encoded = numpy.round(numpy.clip(values, 0.0, 1.0) * 255.0).astype(numpy.uint8)
+    else:
+        return _pack_10_10_10_2(values)
+
+    return numpy.ascontiguousarray(encoded).view(numpy.uint8).reshape(len(values), -1)
+
+
+class VertexLayout:
+    """ Declares how vertex attributes are stored and sets up vertex array objects for them.
+
+    Attributes are interleaved in the order given, each aligned to 4 bytes. A
+    position stored in a normalized integer format is quantized over the mesh's
+    bounding box; the matching decode matrix maps it back and is folded into
+    the model matrices of the instances drawing the mesh.
+    """
+
+    def __init__(self, name, attributes):
+        if not attributes:
+            raise ValueError('A vertex layout needs at least one attribute')
+
+        self.name = name
+        self.attributes = [VertexAttribute(*attribute) for attribute in attributes]
+        self.offsets = []
+
+        offset = 0
+        for attribute in self.attributes:
+            if attribute.format not in _FORMATS:
+                raise ValueError(f"Unknown vertex format '{attribute.format}' for '{attribute.name}'")
+            if attribute.format == 'snorm10_10_10_2' and attribute.components != 4:
+                raise ValueError(f"Packed '{attribute.name}' needs 4 components")
+            if attribute.location >= MODEL_ATTRIBUTE:
+                raise ValueError(f"Location {attribute.location} of '{attribute.name}' is taken by instance data")
+
+            self.offsets.append(offset)
+            offset += (self._size(attribute) + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+        self.stride = offset
+
+    @staticmethod
+    def _size(attribute):
+        _, _, component_size = _FORMATS[attribute.format]
+        return 4 if component_size is None else attribute.components * component_size
+
+    def attribute(self, name):
+        for attribute in self.attributes:
+            if attribute.name == name:
+                return attribute
+        return None
+
+    def quantizes_positions(self):
+        position = self.attribute(POSITION)
+        return position is not None and _FORMATS[position.format][1] == GL_TRUE
+
+    def encode(self, streams, bounds=None):
+        """ Interleave {name: (n, components) float array} streams into (n, stride) uint8 vertices.
+
+        Returns the vertices and the decode matrix for quantized positions, or
+        None. bounds, the (2, 3) box positions are quantized over, defaults to
+        the box of the positions.
+        """
+        count = None
+        decode = None
+        vertices = None
+
+        for attribute, offset in zip(self.attributes, self.offsets):
+            if attribute.name not in streams:
+                raise ValueError(f"No '{attribute.name}' data for the '{self.name}' vertex layout")
+
+            values = numpy.asarray(streams[attribute.name], numpy.float32)
+            values = values.reshape(len(values), -1)
+
+            if count is None:
+                count = len(values)
+                vertices = numpy.zeros((count, self.stride), numpy.uint8)
+            elif len(values) != count:
+                raise ValueError(f"'{attribute.name}' has {len(values)} values instead of {count}")
+
+            # Missing components, such as w of a packed normal, are 0
+            if values.shape[1] < attribute.components:
+                values = numpy.hstack([values, numpy.zeros((count, attribute.components - values.shape[1]),
+                                                           numpy.float32)])
+            values = values[:, :attribute.components]
+
+            if attribute.name == POSITION and self.quantizes_positions():
+                values, decode = self._quantize(values, bounds)
+
+            encoded = _encode(values, attribute.format)
+            vertices[:, offset:offset + encoded.shape[1]] = encoded
+
+        return vertices, decode
+
+    @staticmethod
+    def _quantize(positions, bounds):
+        if bounds is None:
+            bounds = numpy.array([positions.min(axis=0), positions.max(axis=0)]) if len(positions) else \
+                numpy.zeros((2, 3))
+
+        center = (bounds[0] + bounds[1]) * 0.5
+        # Flat boxes still need a scale that can be inverted
+        extent = numpy.maximum((bounds[1] - bounds[0]) * 0.5, 1e-6)
+
+        quantized = positions.copy()
+        quantized[:, :3] = (positions[:, :3] - center) / extent
+
+        # Row vector layout, as pyrr and the instance buffer use: local = quantized @ decode
+        decode = numpy.identity(4, numpy.float32)
+        decode[0, 0], decode[1, 1], decode[2, 2] = extent
+        decode[3, :3] = center
+
+        return quantized, decode
+
+    def apply(self):
+        """ Point the attributes at the bound GL_ARRAY_BUFFER, with the vertex array object bound. """
+        for attribute, offset in zip(self.attributes, self.offsets):
+            gl_type, normalized, _ = _FORMATS[attribute.format]
+            glVertexAttribPointer(attribute.location, attribute.components, gl_type, normalized, self.stride,
+                                  ctypes.c_void_p(offset))
+            glEnableVertexAttribArray(attribute.location)
+
+    def check(self, shader):
+        """ Raise a ValueError when the shader reads a vertex input the layout does not provide where it expects. """
+        for name, variable in shader.attributes.items():
+            if variable.location < 0 or variable.location >= MODEL_ATTRIBUTE:
+                continue
+
+            attribute = self.attribute(name)
+            if attribute is None:
+                raise ValueError(f"Vertex layout '{self.name}' has no '{name}' for the shader")
+            if attribute.location != variable.location:
+                raise ValueError(f"Vertex layout '{self.name}' has '{name}' at location {attribute.location}, "
+                                 f"the shader reads it from {variable.location}")
+
+    def __repr__(self):
+        return f"VertexLayout('{self.name}', stride={self.stride})"
+
+
+# Interleaved x, y, z, r, g, b floats, as the importer and the mesh cache store vertices
+STANDARD = VertexLayout('p3f_c3f', [(POSITION, 0, 3, 'f32'), (COLOR, 1, 3, 'f32')])
+
+# Positions quantized to 16 bits over the mesh box and 8 bit colors: 12 instead of 24 bytes a vertex
+COMPACT = VertexLayout('p3s16_c3u8', [(POSITION, 0, 3, 'snorm16'), (COLOR, 1, 3, 'unorm8')])
+
+# Half float positions, which need no decode matrix but lose precision far from the origin
+HALF = VertexLayout('p3h_c3u8', [(POSITION, 0, 3, 'f16'), (COLOR, 1, 3, 'unorm8')])
+
+
+def choose_layout(vertex_count):
+    """ STANDARD for small meshes, COMPACT for the big ones where memory and bandwidth matter. """
+    return COMPACT if vertex_count >= _COMPACT_VERTICES else STANDARD
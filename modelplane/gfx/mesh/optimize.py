@@ -0,0 +1,259 @@
+import argparse
+import sys
+import time
+
+from collections import namedtuple
+
+import numpy
+
+_FLOATS_PER_VERTEX = 6  # x, y, z, r, g, b
+_DEFAULT_CACHE_SIZE = 16  # Post-transform cache entries to optimize for, small enough to suit most GPUs
+_MAX_CLUSTER = 256  # Triangles in one cluster that is moved as a whole by the overdraw ordering
+
+OptimizationReport = namedtuple('OptimizationReport', [
+    'vertices_before', 'vertices_after', 'triangles_before', 'triangles_after',
+    'acmr_before', 'acmr_after', 'seconds'])
+
+
+def _report_str(report):
+    return (f'{report.vertices_before} -> {report.vertices_after} vertices, '
+            f'{report.triangles_before} -> {report.triangles_after} triangles, '
+            f'ACMR {report.acmr_before:.3f} -> {report.acmr_after:.3f} in {report.seconds:.2f} s')
+
+
+OptimizationReport.__str__ = _report_str
+
+
+def acmr(indices, cache_size=_DEFAULT_CACHE_SIZE):
+    """ Average cache miss ratio: vertices transformed per triangle with a FIFO post-transform cache.
+
+    1.0 or a bit less is about the best a regular mesh gets, 3.0 means no reuse at all.
+    """
+    indices = numpy.asarray(indices).ravel()
+    if len(indices) < 3:
+        return 0.0
+
+    # A vertex is still cached when fewer than cache_size misses happened since it was loaded
+    loaded = [-cache_size] * (int(indices.max()) + 1)
+    misses = 0
+    for vertex in indices.tolist():
+        if misses - loaded[vertex] >= cache_size:
+            loaded[vertex] = misses
+            misses += 1
+
+    return misses / (len(indices) // 3)
+
+
+def weld(vertices, indices, tolerance=None):
+    """ Merge duplicate vertices and drop the triangles that become degenerate.
+
+    Vertices are equal when every component matches exactly, or with a
+    tolerance when they fall into the same grid cell of that size.
+    """
+    vertices = numpy.asarray(vertices, numpy.float32).reshape(-1, _FLOATS_PER_VERTEX)
+    indices = numpy.asarray(indices, numpy.int64).reshape(-1, 3)
+
+    if tolerance:
+        keys = numpy.round(vertices / tolerance).astype(numpy.int64)
+    else:
+        keys = vertices + numpy.float32(0.0)  # -0.0 and 0.0 are the same vertex
+
+    # Each row viewed as one opaque value, so the rows are compared as a whole
+    rows = numpy.ascontiguousarray(keys).view(numpy.dtype((numpy.void, keys.dtype.itemsize * keys.shape[1])))
+    _, first, remap = numpy.unique(rows.ravel(), return_index=True, return_inverse=True)
+
+    welded = vertices[first]
+    triangles = remap.ravel()[indices]
+
+    degenerate = (triangles[:, 0] == triangles[:, 1]) | (triangles[:, 1] == triangles[:, 2]) | \
+        (triangles[:, 0] == triangles[:, 2])
+
+    return welded.ravel(), triangles[~degenerate].astype(numpy.int32).ravel()
+
+
+def tipsify(indices, vertex_count, cache_size=_DEFAULT_CACHE_SIZE):
+    """ Triangle order for vertex cache reuse, after Sander, Nehab and Barczak's Tipsify.
+
+    Returns the triangle order and the positions in it where the walk ran out
+    of nearby triangles and jumped elsewhere, which the overdraw ordering uses
+    as cluster boundaries.
+    """
+    triangles = numpy.asarray(indices, numpy.int64).reshape(-1, 3)
+    triangle_count = len(triangles)
+
+    # Triangles around every vertex, as offsets into one flat array
+    corners = triangles.ravel()
+    order = numpy.argsort(corners, kind='stable')
+    adjacency = (order // 3).tolist()
+    live = numpy.bincount(corners, minlength=vertex_count)
+    starts = numpy.concatenate([[0], numpy.cumsum(live)]).tolist()
+    live = live.tolist()
+    triangle_list = triangles.tolist()
+
+    stamps = [0] * vertex_count
+    emitted = [False] * triangle_count
+    dead_ends = []
+    output = []
+    boundaries = [0]
+
+    time_stamp = cache_size + 1
+    cursor = 0
+    fanning = 0 if vertex_count > 0 else -1
+
+    while fanning >= 0:
+        candidates = []
+
+        for triangle in adjacency[starts[fanning]:starts[fanning + 1]]:
+            if emitted[triangle]:
+                continue
+
+            emitted[triangle] = True
+            output.append(triangle)
+
+            for vertex in triangle_list[triangle]:
+                dead_ends.append(vertex)
+                candidates.append(vertex)
+                live[vertex] -= 1
+                if time_stamp - stamps[vertex] > cache_size:
+                    stamps[vertex] = time_stamp
+                    time_stamp += 1
+
+        # The next fanning vertex is the one still in the cache with the most triangles left
+        fanning = -1
+        best = 0
+        for vertex in candidates:
+            if live[vertex] > 0:
+                priority = 0
+                if time_stamp - stamps[vertex] + 2 * live[vertex] <= cache_size:
+                    priority = time_stamp - stamps[vertex]
+                if priority > best:
+                    best = priority
+                    fanning = vertex
+
+        if fanning >= 0:
+            continue
+
+        # Dead end, go back to a recently used vertex or on to the next unfinished one
+        while dead_ends:
+            vertex = dead_ends.pop()
+            if live[vertex] > 0:
+                fanning = vertex
+                break
+
+        if fanning < 0:
+            while cursor < vertex_count:
+                if live[cursor] > 0:
+                    fanning = cursor
+                    break
+                cursor += 1
+
+            # Nothing cached is of use any more, a good place for a cluster to end
+            if fanning >= 0:
+                boundaries.append(len(output))
+
+    return numpy.array(output, numpy.int64), numpy.array(boundaries, numpy.int64)
+
+
+def order_overdraw(vertices, indices, order, boundaries, max_cluster=_MAX_CLUSTER):
+    """ Reorder clusters of triangles so the outward facing ones are drawn first.
+
+    Clusters keep their inner order, so the vertex cache reuse is preserved.
+    Clusters facing away from the middle of the mesh tend to be in front of the
+    rest and hide it, which saves shading the pixels drawn over later.
+    """
+    positions = numpy.asarray(vertices, numpy.float32).reshape(-1, _FLOATS_PER_VERTEX)[:, :3].astype(numpy.float64)
+    triangles = numpy.asarray(indices, numpy.int64).reshape(-1, 3)[order]
+
+    if len(triangles) == 0:
+        return order
+
+    # Long runs without a jump are cut up, so the sort has something to work with
+    starts = numpy.union1d(boundaries, numpy.arange(0, len(triangles), max_cluster))
+    starts = starts[starts < len(triangles)]
+
+    v0, v1, v2 = positions[triangles[:, 0]], positions[triangles[:, 1]], positions[triangles[:, 2]]
+    normals = numpy.cross(v1 - v0, v2 - v0)  # Twice the area in length
+    areas = numpy.linalg.norm(normals, axis=1)[:, None]
+    centroids = (v0 + v1 + v2) / 3.0
+
+    cluster_areas = numpy.add.reduceat(areas, starts)
+    cluster_centroids = numpy.add.reduceat(centroids * areas, starts) / numpy.maximum(cluster_areas, 1e-20)
+    cluster_normals = numpy.add.reduceat(normals, starts)
+    cluster_normals /= numpy.maximum(numpy.linalg.norm(cluster_normals, axis=1)[:, None], 1e-20)
+
+    mesh_centroid = (centroids * areas).sum(axis=0) / max(areas.sum(), 1e-20)
+    facing = ((cluster_centroids - mesh_centroid) * cluster_normals).sum(axis=1)
+
+    ends = numpy.append(starts[1:], len(triangles))
+    clusters = numpy.argsort(-facing, kind='stable')
+
+    return numpy.concatenate([order[starts[c]:ends[c]] for c in clusters])
+
+
+def remap_fetch(vertices, indices):
+    """ Renumber vertices in the order the indices first use them, dropping unused ones.
+
+    Vertex fetches then walk through memory mostly forward.
+    """
+    vertices = numpy.asarray(vertices, numpy.float32).reshape(-1, _FLOATS_PER_VERTEX)
+    indices = numpy.asarray(indices, numpy.int64).ravel()
+
+    used, first = numpy.unique(indices, return_index=True)
+    fetch_order = used[numpy.argsort(first)]
+
+    remap = numpy.full(len(vertices), -1, numpy.int64)
+    remap[fetch_order] = numpy.arange(len(fetch_order))
+
+    return vertices[fetch_order].ravel(), remap[indices].astype(numpy.int32)
+
+
+def optimize_mesh(vertices, indices, cache_size=_DEFAULT_CACHE_SIZE, weld_tolerance=None, overdraw=True):
+    """ Weld, reorder for the vertex cache and overdraw, and remap vertex fetches.
+
+    Takes and returns interleaved x, y, z, r, g, b float vertices and int32
+    triangle indices, along with an OptimizationReport.
+    """
+    start = time.perf_counter()
+
+    vertices = numpy.asarray(vertices, numpy.float32).ravel()
+    indices = numpy.asarray(indices, numpy.int32).ravel()
+    vertices_before = len(vertices) // _FLOATS_PER_VERTEX
+    triangles_before = len(indices) // 3
+    acmr_before = acmr(indices, cache_size)
+
+    vertices, indices = weld(vertices, indices, weld_tolerance)
+    vertex_count = len(vertices) // _FLOATS_PER_VERTEX
+
+    order, boundaries = tipsify(indices, vertex_count, cache_size)
+    if overdraw:
+        order = order_overdraw(vertices, indices, order, boundaries)
+
+    indices = indices.reshape(-1, 3)[order].ravel()
+    vertices, indices = remap_fetch(vertices, indices)
+
+    report = OptimizationReport(vertices_before, len(vertices) // _FLOATS_PER_VERTEX, triangles_before,
+                                len(indices) // 3, acmr_before, acmr(indices, cache_size),
+                                time.perf_counter() - start)
+
+    return vertices, indices, report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Optimize the meshes of model files and report the vertex cache '
+                                                 'miss ratio before and after.')
+    parser.add_argument('models', nargs='+', help='Model files to optimize')
+    parser.add_argument('--cache-size', type=int, default=_DEFAULT_CACHE_SIZE, help='Vertex cache entries')
+    parser.add_argument('--weld-tolerance', type=float, default=None, help='Merge vertices closer than this')
+    args = parser.parse_args(argv)
+
+    from modelplane.importer import load_meshes
+
+    for path in args.models:
+        print(path)
+        for i, (vertices, indices) in enumerate(load_meshes(path)):
+            _, _, report = optimize_mesh(vertices, indices, args.cache_size, args.weld_tolerance)
+            print(f'  mesh {i}: {report}')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,400 @@
+import hashlib
+
+import numpy
+from OpenGL.GL import *
+
+from modelplane.gfx.dynamic_buffer import DynamicBuffer
+from modelplane.gfx.mesh.layout import COLOR, POSITION, STANDARD, encode_indices, index_type
+from modelplane.gfx.mesh.triangle_bvh import TriangleBVH
+from modelplane.gfx.state import gl_state
+from modelplane.gfx.util.error import gl_error_check
+
+_DRAW_STYLES = [GL_STATIC_DRAW, GL_DYNAMIC_DRAW, GL_STREAM_DRAW]
+
+# Interleaved x, y, z, r, g, b float vertices, the form all geometry is handed over in
+_FLOATS_PER_VERTEX = 6
+
+
+class Mesh:
+    """ GPU buffers for one piece of geometry, shared by every shape with the same vertex data.
+
+    Vertices are given as interleaved x, y, z, r, g, b floats and stored on the
+    GPU in the mesh's VertexLayout, with 16 bit indices when the vertex count
+    allows. The float vertices are kept for bounds and picking.
+
+    The vertex and index data can be edited in place. Edits are uploaded in
+    dirty ranges by flush(), which the scene calls through the registry before
+    drawing.
+
+    A static mesh may carry a chain of simplified levels of detail in lods,
+    coarsest last, which are deleted along with it.
+
+    A streamed mesh starts out with empty buffers, which stream() fills a chunk
+    at a time, so a big mesh can go up over several frames. It must not be
+    drawn while streaming() is true.
+    """
+
+    # Bumped on every geometry edit of any mesh, so scenes know when to refresh bounds
+    geometry_revision = 0
+
+    def __init__(self, key, vertices, indices, draw_style, layout=STANDARD, streamed=False):
+        self.key = key
+        self.layout = layout
+        self.references = 0
+        self.revision = 0
+        self._vertices = vertices
+        self._indices = indices
+        self._bounds_cache = None
+        self._triangle_bvh = None
+        self.lods = []
+
+        vertex_data, self.decode_matrix = self._encode_vertices(vertices)
+        index_data = encode_indices(indices, self.vertex_count())
+        self.index_type = index_type(index_data.dtype)
+
+        self.vao, self.vbo, self.ebo = self._create_vao(vertex_data, index_data, draw_style, layout, streamed)
+        self.vertex_buffer = DynamicBuffer(vertex_data, draw_style, self.vbo)
+        self.index_buffer = DynamicBuffer(index_data, draw_style, self.ebo)
+
+        # (buffer, first byte not uploaded yet) of each buffer a streamed mesh still has to fill
+        self._stream = [(self.vertex_buffer, 0), (self.index_buffer, 0)] if streamed else []
+
+    @property
+    def vertices(self):
+        return self._vertices
+
+    @property
+    def indices(self):
+        return self._indices
+
+    @property
+    def index_count(self):
+        # What the GPU holds, edits only count once flushed
+        return self.index_buffer.allocated_bytes // self.index_buffer.data.itemsize
+
+    @property
+    def bounds(self):
+        if self._bounds_cache is None:
+            self._bounds_cache = self._bounds(self.positions())
+        return self._bounds_cache
+
+    def lod(self, level):
+        """ The mesh for a level of detail, 0 being this mesh. """
+        return self if level == 0 else self.lods[level - 1]
+
+    def triangle_counts(self):
+        """ Triangles of every level of detail, this mesh first. """
+        return [len(self._indices) // 3] + [len(lod.indices) // 3 for lod in self.lods]
+
+    def vertex_count(self):
+        return len(self._vertices) // _FLOATS_PER_VERTEX
+
+    def positions(self):
+        return self._vertices.reshape(-1, _FLOATS_PER_VERTEX)[:, :3]  # x, y, z, r, g, b
+
+    def _encode_vertices(self, vertices, bounds=None):
+        # The standard layout is the input format itself, mapped cache files go to the GPU as they are
+        if self.layout is STANDARD:
+            return numpy.ascontiguousarray(vertices, numpy.float32).view(numpy.uint8), None
+
+        vertices = vertices.reshape(-1, _FLOATS_PER_VERTEX)
+        encoded, decode = self.layout.encode({POSITION: vertices[:, :3], COLOR: vertices[:, 3:]}, bounds)
+        return encoded.ravel(), decode
+
+    def triangle_bvh(self):
+        """ BVH over the mesh's triangles for picking, built on first use and kept with the mesh. """
+        if self._triangle_bvh is None:
+            self._triangle_bvh = TriangleBVH(self.positions(), self.indices)
+        return self._triangle_bvh
+
+    def update_vertices(self, first, vertices):
+        """ Overwrite interleaved vertices from vertex index first on. """
+        vertices = numpy.asarray(vertices, numpy.float32).reshape(-1, _FLOATS_PER_VERTEX)
+        if first < 0 or first + len(vertices) > self.vertex_count():
+            raise ValueError('Vertex update goes past the last vertex')
+
+        # Arrays mapped from the mesh cache are read-only, the first edit takes a private copy
+        if not self._vertices.flags.writeable:
+            self._vertices = self._vertices.copy()
+        self._vertices.reshape(-1, _FLOATS_PER_VERTEX)[first:first + len(vertices)] = vertices
+
+        quantized = self.decode_matrix is not None
+        if quantized and not self._inside_quantization(vertices[:, :3]):
+            # Positions outside the quantized box need a new box for the whole mesh
+            self._reencode()
+        else:
+            encoded, _ = self._encode_vertices(vertices, self._quantization_bounds() if quantized else None)
+            self.vertex_buffer.write(first * self.layout.stride, encoded)
+
+        self._geometry_changed()
+
+    def update_indices(self, first, indices):
+        indices = numpy.asarray(indices, numpy.int32).ravel()
+        if first < 0 or first + len(indices) > len(self._indices):
+            raise ValueError('Index update goes past the last index')
+
+        if not self._indices.flags.writeable:
+            self._indices = self._indices.copy()
+        self._indices[first:first + len(indices)] = indices
+
+        self.index_buffer.write(first, indices.astype(self.index_buffer.data.dtype))
+        self._geometry_changed()
+
+    def set_geometry(self, vertices=None, indices=None):
+        """ Replace the vertices, the indices or both, which may change their count. """
+        if vertices is not None:
+            self._vertices = numpy.array(vertices, numpy.float32).ravel()
+            self._reencode()
+
+        # A new vertex count may need wider indices
+        if indices is not None or vertices is not None:
+            if indices is not None:
+                self._indices = numpy.array(indices, numpy.int32).ravel()
+            index_data = encode_indices(self._indices, self.vertex_count())
+            self.index_type = index_type(index_data.dtype)
+            self.index_buffer.replace(index_data)
+
+        self._geometry_changed()
+
+    def _reencode(self):
+        vertex_data, self.decode_matrix = self._encode_vertices(self._vertices)
+        self.vertex_buffer.replace(vertex_data)
+
+    def _quantization_bounds(self):
+        center = self.decode_matrix[3, :3]
+        extent = self.decode_matrix.diagonal()[:3]
+        return numpy.array([center - extent, center + extent])
+
+    def _inside_quantization(self, positions):
+        bounds = self._quantization_bounds()
+        return bool((positions >= bounds[0]).all() and (positions <= bounds[1]).all())
+
+    def _geometry_changed(self):
+        self._bounds_cache = None
+        self._triangle_bvh = None
+        self.revision += 1
+        Mesh.geometry_revision += 1
+
+    def dirty(self):
+        return self.vertex_buffer.dirty() or self.index_buffer.dirty()
+
+    def streaming(self):
+        """ Whether the buffers of the mesh or its levels of detail are still being streamed. """
+        return bool(self._stream) or any(lod.streaming() for lod in self.lods)
+
+    def stream(self, max_bytes=None):
+        """ Upload up to max_bytes more of a streamed mesh, then of its levels of detail, or all that is left.
+
+        Returns the number of bytes uploaded.
+        """
+        uploaded = 0
+
+        for mesh in [self] + self.lods:
+            while mesh._stream and (max_bytes is None or uploaded < max_bytes):
+                buffer, start = mesh._stream[0]
+                end = buffer.data.nbytes if max_bytes is None else min(buffer.data.nbytes, start + max_bytes - uploaded)
+
+                if end > start:
+                    buffer.upload(start, end)
+                    uploaded += end - start
+
+                if end == buffer.data.nbytes:
+                    mesh._stream.pop(0)
+                else:
+                    mesh._stream[0] = (buffer, end)
+
+        if uploaded:
+            gl_error_check()
+
+        return uploaded
+
+    def flush(self):
+        """ Upload pending edits. Returns the number of bytes uploaded. """
+        return self.vertex_buffer.flush() + self.index_buffer.flush()
+
+    @staticmethod
+    def _bounds(positions):
+        if len(positions) == 0:
+            return numpy.zeros((2, 3), numpy.float32)
+
+        return numpy.array([positions.min(axis=0), positions.max(axis=0)], numpy.float32)
+
+    def byte_size(self):
+        return self.vertex_buffer.allocated_bytes + self.index_buffer.allocated_bytes + \
+            sum(lod.byte_size() for lod in self.lods)
+
+    def render_instanced(self, count):
+        """ Draw count instances, with their model matrices in an instance buffer attached to the vertex array.
+
+        There is no other way to draw a mesh, the viewer shader reads the model matrix, with any decode matrix
+        folded in, from the instance attribute.
+        """
+        # The vertex array stays bound, the next draw from this mesh does not bind it again
+        gl_state.bind_vertex_array(self.vao)
+        self.draw_instanced(count)
+
+    def draw_instanced(self, count):
+        """ Draw with the vertex array already bound, as a render queue does. """
+        glDrawElementsInstanced(GL_TRIANGLES, self.index_count, self.index_type, ctypes.c_void_p(0), count)
+
+    def delete(self):
+        for lod in self.lods:
+            lod.delete()
+        self.lods = []
+
+        glDeleteVertexArrays(1, [self.vao])
+        glDeleteBuffers(2, [self.vbo, self.ebo])
+        gl_state.forget_vertex_array(self.vao)
+        self.vao = self.vbo = self.ebo = 0
+
+    @staticmethod
+    def _create_vao(vertices, indices, draw_style, layout=STANDARD, streamed=False):
+        if vertices is None or indices is None or draw_style is None:
+            raise ValueError("Shape's vertices, indices, and change rate cannot be None")
+
+        if draw_style not in _DRAW_STYLES:
+            raise ValueError('Draw style invalid')
+
+        vao = glGenVertexArrays(1)  # Vertex array object - stores the vbo and ebo and will bind them automatically
+        vbo = glGenBuffers(1)  # Vertex buffer object - stores vertices
+        ebo = glGenBuffers(1)  # Element buffer object - stores the indices to the vertices to render
+
+        gl_state.bind_vertex_array(vao)
+
+        # Streamed buffers are only allocated here and filled later
+        glBindBuffer(GL_ARRAY_BUFFER, vbo)
+        glBufferData(GL_ARRAY_BUFFER, vertices.nbytes, None if streamed else vertices, draw_style)
+
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, ebo)
+        glBufferData(GL_ELEMENT_ARRAY_BUFFER, indices.nbytes, None if streamed else indices, draw_style)
+
+        layout.apply()
+
+        # Unbind all buffers
+        gl_state.bind_vertex_array(0)
+
+        gl_error_check()
+
+        return vao, vbo, ebo
+
+
+class MeshRegistry:
+    """ Hands out reference-counted meshes keyed by geometry content.
+
+    Shapes with identical vertices, indices and layout share one set of GPU
+    buffers, which are deleted when the last shape releases them.
+    """
+
+    def __init__(self):
+        self._meshes = {}
+        self._dirty = set()
+        self._unique_count = 0
+        self.live_meshes = 0
+        self.live_buffers = 0
+        self.live_bytes = 0
+
+    @staticmethod
+    def geometry_key(vertices, indices):
+        """ Digest of x, y, z, r, g, b float vertices and their indices. """
+        digest = hashlib.sha1(STANDARD.name.encode())
+        digest.update(vertices.tobytes())
+        digest.update(indices.tobytes())
+        return digest.hexdigest()
+
+    def acquire(self, vertices, indices, draw_style=GL_STATIC_DRAW, layout=STANDARD, key=None, lods=None,
+                streamed=False):
+        """ The mesh for some geometry, created on first use.
+
+        lods, simplified (vertices, indices) levels coarsest last, are stored
+        with the mesh unless it already has some. A new mesh acquired streamed
+        has its buffers filled by Mesh.stream(); acquiring it otherwise finishes
+        the streaming first, so the mesh can be drawn right away.
+        """
+        # A key stored along with the geometry, such as in the mesh cache, saves hashing large meshes again
+        if key is None:
+            key = self.geometry_key(vertices, indices)
+
+        # The same geometry in another layout is another set of buffers
+        if layout is not STANDARD:
+            key = f'{key}/{layout.name}'
+
+        mesh = self._meshes.get(key)
+
+        if mesh is None:
+            mesh = Mesh(key, vertices, indices, draw_style, layout, streamed)
+            self._meshes[key] = mesh
+            self.live_meshes += 1
+            self.live_buffers += 2  # vbo and ebo
+            self.live_bytes += mesh.byte_size()
+
+        # Levels added to a mesh that may already be drawn have to be complete
+        if lods and not mesh.lods:
+            self._add_lods(mesh, lods, draw_style, streamed and mesh.streaming())
+
+        if not streamed and mesh.streaming():
+            mesh.stream()
+
+        mesh.references += 1
+        return mesh
+
+    def acquire_unique(self, vertices, indices, draw_style=GL_DYNAMIC_DRAW, layout=STANDARD):
+        """ A mesh that is never shared, for geometry that is going to be edited. """
+        self._unique_count += 1
+        return self.acquire(vertices, indices, draw_style, layout, key=f'unique:{self._unique_count}')
+
+    def _add_lods(self, mesh, lods, draw_style, streamed=False):
+        for level, (vertices, indices, *_) in enumerate(lods, 1):
+            vertices = numpy.ascontiguousarray(vertices, numpy.float32).ravel()
+            indices = numpy.ascontiguousarray(indices, numpy.int32).ravel()
+            lod = Mesh(f'{mesh.key}/lod{level}', vertices, indices, draw_style, mesh.layout, streamed)
+            mesh.lods.append(lod)
+
+            # Counted with the mesh, a level is only ever released along with it
+            self.live_buffers += 2
+            self.live_bytes += lod.byte_size()
+
+    def mark_dirty(self, mesh):
+        """ Have the next flush() upload the edits made to a mesh. """
+        if self._meshes.get(mesh.key) is mesh:
+            self._dirty.add(mesh)
+
+    def dirty(self):
+        return bool(self._dirty)
+
+    def flush(self):
+        """ Upload the edits of every dirty mesh. Returns the number of bytes uploaded. """
+        uploaded = 0
+
+        for mesh in self._dirty:
+            self.live_bytes -= mesh.byte_size()
+            uploaded += mesh.flush()
+            self.live_bytes += mesh.byte_size()
+
+        self._dirty.clear()
+        return uploaded
+
+    def release(self, mesh):
+        if mesh is None or self._meshes.get(mesh.key) is not mesh:
+            return
+
+        mesh.references -= 1
+
+        if mesh.references > 0:
+            return
+
+        del self._meshes[mesh.key]
+        self._dirty.discard(mesh)
+        self.live_meshes -= 1
+        self.live_buffers -= 2 * (1 + len(mesh.lods))
+        self.live_bytes -= mesh.byte_size()
+        mesh.delete()
+
+    def __contains__(self, key):
+        return key in self._meshes
+
+    def __len__(self):
+        return len(self._meshes)
+
+
+# Registry shared by all shapes
+mesh_registry = MeshRegistry()
@@ -0,0 +1,277 @@
+import numpy
+
+_FLOATS_PER_VERTEX = 6  # x, y, z, r, g, b
+_DIMENSIONS = 6  # Quadrics are over position and color together
+
+_COLOR_WEIGHT = 0.05  # Color difference against distance in units of the mesh size
+_REGULARIZATION = 1e-9  # Keeps the quadrics of flat areas invertible
+_MAX_FLIP_CHECKS = 4
+_MATCHING_ROUNDS = 3  # Rounds of picking collapses that share no vertices, per pass
+
+_DEFAULT_LEVELS = 4
+_DEFAULT_RATIO = 0.5  # Triangles of each level against the one before
+_MIN_SOURCE_TRIANGLES = 4096  # Smaller meshes are cheap enough to draw as they are
+_MIN_LOD_TRIANGLES = 256
+_MIN_REDUCTION = 0.9  # A level has to lose at least 10% of the triangles, or the chain ends
+
+
+def _triangle_quadrics(points, triangles):
+    """ Area weighted generalized quadrics of the triangles, after Garland and Heckbert's attribute extension.
+
+    Returns A (m, 6, 6), b (m, 6) and c (m,) so a point's squared distance
+    from the triangle's plane in position and color space is vAv + 2bv + c.
+    """
+    p, q, r = points[triangles[:, 0]], points[triangles[:, 1]], points[triangles[:, 2]]
+
+    e1 = q - p
+    e1_length = numpy.linalg.norm(e1, axis=1)
+    e1 /= numpy.maximum(e1_length, 1e-20)[:, None]
+
+    e2 = r - p
+    e2 -= (e2 * e1).sum(axis=1)[:, None] * e1
+    e2_length = numpy.linalg.norm(e2, axis=1)
+    e2 /= numpy.maximum(e2_length, 1e-20)[:, None]
+
+    # Weighted by the geometric area, so color alone does not make a triangle count more
+    areas = 0.5 * numpy.linalg.norm(numpy.cross(q[:, :3] - p[:, :3], r[:, :3] - p[:, :3]), axis=1)
+    areas[(e1_length < 1e-20) | (e2_length < 1e-20)] = 0.0
+
+    pe1 = (p * e1).sum(axis=1)
+    pe2 = (p * e2).sum(axis=1)
+
+    a = numpy.identity(_DIMENSIONS) - e1[:, :, None] * e1[:, None, :] - e2[:, :, None] * e2[:, None, :]
+    b = pe1[:, None] * e1 + pe2[:, None] * e2 - p
+    c = (p * p).sum(axis=1) - pe1 * pe1 - pe2 * pe2
+
+    return a * areas[:, None, None], b * areas[:, None], c * areas
+
+
+def _vertex_quadrics(points, triangles):
+    """ Sum of the quadrics of the triangles around every vertex. """
+    a, b, c = _triangle_quadrics(points, triangles)
+    count = len(points)
+
+    vertex_a = numpy.zeros((count, _DIMENSIONS, _DIMENSIONS))
+    vertex_b = numpy.zeros((count, _DIMENSIONS))
+    vertex_c = numpy.zeros(count)
+
+    for corner in range(3):
+        numpy.add.at(vertex_a, triangles[:, corner], a)
+        numpy.add.at(vertex_b, triangles[:, corner], b)
+        numpy.add.at(vertex_c, triangles[:, corner], c)
+
+    return vertex_a, vertex_b, vertex_c
+
+
+def _error(a, b, c, points):
+    return (numpy.matmul(a, points[:, :, None])[:, :, 0] * points).sum(axis=1) + 2.0 * (b * points).sum(axis=1) + c
+
+
+def _edges(triangles, count):
+    """ Unique edges as (e, 2) vertex pairs, and how many triangles use each. """
+    pairs = numpy.concatenate([triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [2, 0]]])
+    pairs.sort(axis=1)
+    codes, uses = numpy.unique(pairs[:, 0] * count + pairs[:, 1], return_counts=True)
+    return numpy.stack([codes // count, codes % count], axis=1), uses
+
+
+def _collapse_targets(a, b, c, points, edges):
+    """ Cheapest point for each edge to collapse to, and its error.
+
+    The quadric's minimum is used when it lies near the edge, otherwise the
+    best of the two ends and the middle.
+    """
+    first, second = points[edges[:, 0]], points[edges[:, 1]]
+    middle = (first + second) * 0.5
+
+    regularized = a + _REGULARIZATION * numpy.identity(_DIMENSIONS)
+    optimal = numpy.linalg.solve(regularized, -b[:, :, None])[:, :, 0]
+
+    # Flat and straight areas have a whole line or plane of minima, far away ones are no good
+    length = numpy.linalg.norm(second - first, axis=1)
+    far = ~numpy.isfinite(optimal).all(axis=1) | (numpy.linalg.norm(optimal - middle, axis=1) > length)
+    optimal[far] = middle[far]
+
+    candidates = numpy.stack([optimal, first, second, middle])
+    errors = numpy.stack([_error(a, b, c, candidate) for candidate in candidates])
+    best = numpy.argmin(errors, axis=0)
+    edge_range = numpy.arange(len(edges))
+
+    return candidates[best, edge_range], errors[best, edge_range]
+
+
+def _independent(edges, costs, count, rounds=_MATCHING_ROUNDS):
+    """ Cheap edges of which no two share a vertex, cheapest first.
+
+    Each round takes the edges that are the cheapest around both of their ends
+    among those not touching an edge taken before.
+    """
+    # Ranks instead of costs, flat areas have many collapses that cost nothing
+    ranks = numpy.empty(len(edges), numpy.int64)
+    ranks[numpy.argsort(costs, kind='stable')] = numpy.arange(len(edges))
+
+    used = numpy.zeros(count, bool)
+    candidates = numpy.arange(len(edges))
+    selected = []
+
+    for _ in range(rounds):
+        first, second = edges[candidates, 0], edges[candidates, 1]
+        candidates = candidates[~(used[first] | used[second])]
+        if len(candidates) == 0:
+            break
+
+        first, second = edges[candidates, 0], edges[candidates, 1]
+        cheapest = numpy.full(count, len(edges), numpy.int64)
+        numpy.minimum.at(cheapest, first, ranks[candidates])
+        numpy.minimum.at(cheapest, second, ranks[candidates])
+
+        taken = candidates[(cheapest[first] == ranks[candidates]) & (cheapest[second] == ranks[candidates])]
+        used[edges[taken].ravel()] = True
+        selected.append(taken)
+
+    selected = numpy.concatenate(selected) if selected else candidates[:0]
+    return selected[numpy.argsort(ranks[selected])]
+
+
+def _normals(positions, triangles):
+    return numpy.cross(positions[triangles[:, 1]] - positions[triangles[:, 0]],
+                       positions[triangles[:, 2]] - positions[triangles[:, 0]])
+
+
+def _flipped(points, triangles, edges, targets):
+    """ Indices into edges of the collapses that would turn a triangle around. """
+    count = len(points)
+    collapse = numpy.full(count, -1, numpy.int64)
+    collapse[edges[:, 0]] = numpy.arange(len(edges))
+    collapse[edges[:, 1]] = numpy.arange(len(edges))
+
+    touched = (collapse[triangles] >= 0).any(axis=1)
+    around = triangles[touched]
+
+    remap = numpy.arange(count)
+    remap[edges[:, 1]] = edges[:, 0]
+    moved = points[:, :3].copy()
+    moved[edges[:, 0]] = targets[:, :3]
+
+    collapsed = remap[around]
+    kept = (collapsed[:, 0] != collapsed[:, 1]) & (collapsed[:, 1] != collapsed[:, 2]) & \
+        (collapsed[:, 0] != collapsed[:, 2])
+
+    before = _normals(points[:, :3], around[kept])
+    after = _normals(moved, collapsed[kept])
+    flipped = (before * after).sum(axis=1) <= 0.0
+
+    culprits = collapse[around[kept][flipped]].ravel()
+    return numpy.unique(culprits[culprits >= 0])
+
+
+def simplify(vertices, indices, target_triangles, color_weight=_COLOR_WEIGHT, lock_border=True):
+    """ Collapse edges by quadric error until at most target_triangles are left.
+
+    Vertices are interleaved x, y, z, r, g, b floats, colors being part of the
+    error so color borders are kept where possible. Each pass collapses a set of
+    cheap edges that share no vertices at once, skipping those that would turn
+    triangles around. Border edges, including the seams between vertices split
+    for their attributes, are kept with lock_border. May stop above the target
+    when nothing more can be collapsed.
+
+    Returns the simplified vertices and int32 indices.
+    """
+    vertices = numpy.asarray(vertices, numpy.float32).reshape(-1, _FLOATS_PER_VERTEX)
+    triangles = numpy.asarray(indices, numpy.int64).reshape(-1, 3)
+    count = len(vertices)
+
+    if len(triangles) <= target_triangles or count == 0:
+        return vertices.ravel().copy(), triangles.astype(numpy.int32).ravel()
+
+    # Positions scaled to the unit box, so the color weight means the same for any mesh size
+    low = vertices[:, :3].min(axis=0).astype(numpy.float64)
+    scale = max(float((vertices[:, :3].max(axis=0) - low).max()), 1e-20)
+
+    points = numpy.empty((count, _DIMENSIONS))
+    points[:, :3] = (vertices[:, :3] - low) / scale
+    points[:, 3:] = vertices[:, 3:] * color_weight
+
+    a, b, c = _vertex_quadrics(points, triangles)
+
+    locked = numpy.zeros(count, bool)
+    if lock_border:
+        edges, uses = _edges(triangles, count)
+        locked[edges[uses == 1].ravel()] = True
+
+    while len(triangles) > target_triangles:
+        edges, _ = _edges(triangles, count)
+        edges = edges[~(locked[edges[:, 0]] | locked[edges[:, 1]])]
+        if len(edges) == 0:
+            break
+
+        edge_a = a[edges[:, 0]] + a[edges[:, 1]]
+        edge_b = b[edges[:, 0]] + b[edges[:, 1]]
+        edge_c = c[edges[:, 0]] + c[edges[:, 1]]
+        targets, costs = _collapse_targets(edge_a, edge_b, edge_c, points, edges)
+
+        # An interior collapse removes two triangles
+        selected = _independent(edges, costs, count)[:max((len(triangles) - target_triangles + 1) // 2, 1)]
+
+        for _ in range(_MAX_FLIP_CHECKS):
+            flipped = _flipped(points, triangles, edges[selected], targets[selected])
+            if len(flipped) == 0:
+                break
+            selected = numpy.delete(selected, flipped)
+        else:
+            selected = selected[:0]
+
+        if len(selected) == 0:
+            break
+
+        kept, removed = edges[selected, 0], edges[selected, 1]
+        points[kept] = targets[selected]
+        a[kept], b[kept], c[kept] = edge_a[selected], edge_b[selected], edge_c[selected]
+
+        remap = numpy.arange(count)
+        remap[removed] = kept
+        triangles = remap[triangles]
+
+        degenerate = (triangles[:, 0] == triangles[:, 1]) | (triangles[:, 1] == triangles[:, 2]) | \
+            (triangles[:, 0] == triangles[:, 2])
+        triangles = triangles[~degenerate]
+
+        # Collapses around a thin part can leave two triangles on the same corners
+        _, first = numpy.unique(numpy.sort(triangles, axis=1), axis=0, return_index=True)
+        triangles = triangles[numpy.sort(first)]
+
+    # Only the vertices still in use are returned
+    used, remap = numpy.unique(triangles.ravel(), return_inverse=True)
+
+    simplified = numpy.empty((len(used), _FLOATS_PER_VERTEX), numpy.float32)
+    simplified[:, :3] = points[used, :3] * scale + low
+    simplified[:, 3:] = numpy.clip(points[used, 3:] / color_weight, 0.0, 1.0)
+
+    return simplified.ravel(), remap.astype(numpy.int32).ravel()
+
+
+def build_lods(vertices, indices, levels=_DEFAULT_LEVELS, ratio=_DEFAULT_RATIO):
+    """ Chain of simplified (vertices, indices) levels, each about ratio times the triangles of the one before.
+
+    Every level is simplified from the previous one. The chain is empty for
+    small meshes and ends early once a level can hardly be reduced any more.
+    """
+    triangle_count = len(indices) // 3
+    if triangle_count < _MIN_SOURCE_TRIANGLES:
+        return []
+
+    lods = []
+
+    for _ in range(levels):
+        target = int(triangle_count * ratio)
+        if target < _MIN_LOD_TRIANGLES:
+            break
+
+        vertices, indices = simplify(vertices, indices, target)
+        if len(indices) // 3 > triangle_count * _MIN_REDUCTION:
+            break
+
+        lods.append((vertices, indices))
+        triangle_count = len(indices) // 3
+
+    return lods
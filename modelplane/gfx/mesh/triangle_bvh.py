@@ -0,0 +1,67 @@
+import numpy
+
+from modelplane.gfx.bvh import BVH
+
+_LEAF_SIZE = 16
+_EPSILON = 1e-9
+
+
+def _cross(a, b):
+    return numpy.stack([a[..., 1] * b[..., 2] - a[..., 2] * b[..., 1],
+                        a[..., 2] * b[..., 0] - a[..., 0] * b[..., 2],
+                        a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]], axis=-1)
+
+
+def intersect_triangles(origin, direction, v0, v1, v2):
+    """ Möller–Trumbore intersection of one ray with N triangles given by their corner arrays.
+
+    Returns the distance along the ray to each triangle, infinity where it is missed.
+    """
+    edge1 = v1 - v0
+    edge2 = v2 - v0
+    p = _cross(direction, edge2)
+    determinant = numpy.einsum('ij,ij->i', edge1, p)
+
+    # Rays parallel to a triangle's plane never hit it
+    valid = numpy.abs(determinant) > _EPSILON
+    inverse = numpy.divide(1.0, determinant, out=numpy.zeros_like(determinant), where=valid)
+
+    s = origin - v0
+    u = numpy.einsum('ij,ij->i', s, p) * inverse
+    q = _cross(s, edge1)
+    v = (q @ direction) * inverse
+    t = numpy.einsum('ij,ij->i', edge2, q) * inverse
+
+    hit = valid & (u >= 0.0) & (v >= 0.0) & (u + v <= 1.0) & (t > _EPSILON)
+
+    return numpy.where(hit, t, numpy.inf)
+
+
+class TriangleBVH:
+    """ BVH over the triangles of a mesh for ray queries in the mesh's local space. """
+
+    def __init__(self, positions, indices, leaf_size=_LEAF_SIZE):
+        self.triangles = numpy.asarray(positions, numpy.float64)[numpy.asarray(indices).reshape(-1, 3)]
+        bounds = numpy.stack([self.triangles.min(axis=1), self.triangles.max(axis=1)], axis=1)
+        self.bvh = BVH(bounds, leaf_size)
+
+    def __len__(self):
+        return len(self.triangles)
+
+    def intersect(self, origin, direction):
+        """ The nearest triangle the ray hits as (triangle index, distance), or None. """
+        origin = numpy.asarray(origin, numpy.float64)
+        direction = numpy.asarray(direction, numpy.float64)
+
+        candidates = self.bvh.ray_candidates(origin, direction)
+        if len(candidates) == 0:
+            return None
+
+        corners = self.triangles[candidates]
+        distances = intersect_triangles(origin, direction, corners[:, 0], corners[:, 1], corners[:, 2])
+
+        nearest = int(numpy.argmin(distances))
+        if not numpy.isfinite(distances[nearest]):
+            return None
+
+        return int(candidates[nearest]), float(distances[nearest])
@@ -0,0 +1,166 @@
+import ctypes
+import ctypes.util
+import os
+import sys
+
+EGL = 'egl'
+OSMESA = 'osmesa'
+
+_PLATFORM_VARIABLE = 'PYOPENGL_PLATFORM'
+_EGL_PLATFORM_SURFACELESS_MESA = 0x31DD
+_EGL_CONTEXT_OPENGL_DEBUG = 0x31B0
+
+# OpenGL 3.3 core, the same as the windowed viewer asks GLFW for
+_GL_MAJOR = 3
+_GL_MINOR = 3
+
+
+def select_platform(backend=None):
+    """ Make PyOpenGL load a headless platform. Returns the chosen backend.
+
+    PyOpenGL binds to a platform the first time OpenGL is imported, so this has
+    to run before anything imports OpenGL.GL. Without a backend, EGL is used
+    when libEGL is installed and OSMesa otherwise.
+    """
+    if backend is None:
+        backend = os.environ.get(_PLATFORM_VARIABLE)
+    if backend is None:
+        backend = EGL if ctypes.util.find_library('EGL') else OSMESA
+
+    if backend not in [EGL, OSMESA]:
+        raise ValueError(f"Unknown headless backend '{backend}'")
+
+    if 'OpenGL.GL' in sys.modules and os.environ.get(_PLATFORM_VARIABLE) != backend:
+        raise RuntimeError(f"OpenGL was already imported, the '{backend}' platform has to be selected before")
+
+    os.environ[_PLATFORM_VARIABLE] = backend
+    return backend
+
+
+def _import_egl():
+    # PyOpenGL's EGL bindings fail to load with its error checking turned off, as the release profile does,
+    # for want of an error checker. None leaves the EGL calls unchecked like the GL ones.
+    from OpenGL.raw.EGL import _errors
+    if not hasattr(_errors, '_error_checker'):
+        _errors._error_checker = None
+
+    from OpenGL import EGL
+    return EGL
+
+
+class OffscreenContext:
+    """ An OpenGL context without a window, through EGL surfaceless or OSMesa.
+
+    Rendering has to go into a Framebuffer, as there is no default framebuffer
+    to draw to. With software=True, or when EGL finds no usable GPU, Mesa's
+    software rasterizer is used instead.
+    """
+
+    def __init__(self, width, height, software=False):
+        if not width or not height or width < 0 or height < 0:
+            raise ValueError('Width and height must be more than 0')
+
+        self.width = width
+        self.height = height
+        self.backend = os.environ.get(_PLATFORM_VARIABLE)
+
+        if self.backend not in [EGL, OSMESA]:
+            raise RuntimeError('Call select_platform() before OpenGL is imported to render headless')
+
+        if software:
+            os.environ['LIBGL_ALWAYS_SOFTWARE'] = '1'
+
+        if self.backend == EGL:
+            self._create_egl(software)
+        else:
+            self._create_osmesa()
+
+    def _create_egl(self, software):
+        try:
+            self._egl_display, self._egl_context = self._egl_context_for(software)
+        except RuntimeError:
+            if software:
+                raise
+            # No usable GPU, try again with the software rasterizer
+            os.environ['LIBGL_ALWAYS_SOFTWARE'] = '1'
+            self._egl_display, self._egl_context = self._egl_context_for(True)
+
+    @staticmethod
+    def _egl_context_for(software):
+        egl = _import_egl()
+
+        display = egl.EGL_NO_DISPLAY
+        try:
+            display = egl.eglGetPlatformDisplayEXT(_EGL_PLATFORM_SURFACELESS_MESA, egl.EGL_DEFAULT_DISPLAY, None)
+        except Exception:
+            pass
+        if display == egl.EGL_NO_DISPLAY:
+            display = egl.eglGetDisplay(egl.EGL_DEFAULT_DISPLAY)
+
+        major, minor = egl.EGLint(), egl.EGLint()
+        if not egl.eglInitialize(display, ctypes.pointer(major), ctypes.pointer(minor)):
+            raise RuntimeError('ERROR: Failed to initialize EGL')
+
+        config_attribs = (egl.EGLint * 5)(egl.EGL_RENDERABLE_TYPE, egl.EGL_OPENGL_BIT,
+                                          egl.EGL_SURFACE_TYPE, 0, egl.EGL_NONE)
+        config = egl.EGLConfig()
+        config_count = egl.EGLint()
+        if not egl.eglChooseConfig(display, config_attribs, ctypes.pointer(config), 1, ctypes.pointer(config_count)) \
+                or config_count.value == 0:
+            egl.eglTerminate(display)
+            raise RuntimeError('ERROR: No EGL config supports desktop OpenGL')
+
+        egl.eglBindAPI(egl.EGL_OPENGL_API)
+
+        # The debug profile asks for a debug context, which makes drivers report more through KHR_debug
+        from modelplane.gfx import runtime
+        debug = int(runtime.current_profile() == runtime.DEBUG)
+
+        context_attribs = (egl.EGLint * 9)(egl.EGL_CONTEXT_MAJOR_VERSION, _GL_MAJOR,
+                                           egl.EGL_CONTEXT_MINOR_VERSION, _GL_MINOR,
+                                           egl.EGL_CONTEXT_OPENGL_PROFILE_MASK,
+                                           egl.EGL_CONTEXT_OPENGL_CORE_PROFILE_BIT,
+                                           _EGL_CONTEXT_OPENGL_DEBUG, debug,
+                                           egl.EGL_NONE)
+        context = egl.eglCreateContext(display, config, egl.EGL_NO_CONTEXT, context_attribs)
+        if context == egl.EGL_NO_CONTEXT:
+            egl.eglTerminate(display)
+            raise RuntimeError('ERROR: Failed to create an EGL context')
+
+        # Surfaceless: the context is made current without any draw or read surface
+        if not egl.eglMakeCurrent(display, egl.EGL_NO_SURFACE, egl.EGL_NO_SURFACE, context):
+            egl.eglDestroyContext(display, context)
+            egl.eglTerminate(display)
+            raise RuntimeError('ERROR: Failed to make the EGL context current')
+
+        return display, context
+
+    def _create_osmesa(self):
+        from OpenGL import GL, arrays
+        from OpenGL import osmesa
+
+        attribs = [osmesa.OSMESA_FORMAT, osmesa.OSMESA_RGBA,
+                   osmesa.OSMESA_DEPTH_BITS, 24,
+                   osmesa.OSMESA_PROFILE, osmesa.OSMESA_CORE_PROFILE,
+                   osmesa.OSMESA_CONTEXT_MAJOR_VERSION, _GL_MAJOR,
+                   osmesa.OSMESA_CONTEXT_MINOR_VERSION, _GL_MINOR,
+                   0]
+        self._osmesa_context = osmesa.OSMesaCreateContextAttribs(attribs, None)
+        if not self._osmesa_context:
+            raise RuntimeError('ERROR: Failed to create an OSMesa context')
+
+        # OSMesa always renders into client memory; the viewer still draws into its own framebuffer object
+        self._osmesa_buffer = arrays.GLubyteArray.zeros((self.height, self.width, 4))
+        if not osmesa.OSMesaMakeCurrent(self._osmesa_context, self._osmesa_buffer, GL.GL_UNSIGNED_BYTE,
+                                        self.width, self.height):
+            raise RuntimeError('ERROR: Failed to make the OSMesa context current')
+
+    def destroy(self):
+        if self.backend == EGL:
+            egl = _import_egl()
+            egl.eglMakeCurrent(self._egl_display, egl.EGL_NO_SURFACE, egl.EGL_NO_SURFACE, egl.EGL_NO_CONTEXT)
+            egl.eglDestroyContext(self._egl_display, self._egl_context)
+            egl.eglTerminate(self._egl_display)
+        else:
+            from OpenGL import osmesa
+            osmesa.OSMesaDestroyContext(self._osmesa_context)
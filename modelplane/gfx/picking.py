@@ -0,0 +1,36 @@
+from collections import namedtuple
+
+import numpy
+
+# The picked shape, the index of the hit triangle within its mesh, the world space hit point,
+# and the distance along the ray in units of the ray's direction vector
+PickResult = namedtuple('PickResult', ['shape', 'triangle', 'point', 'distance'])
+
+
+def ray_from_screen(x, y, width, height, view_projection):
+    """ World space ray through a window position, y measured from the bottom as in OpenGL.
+
+    Returns the ray's origin on the near plane and its direction towards the far plane.
+    """
+    if width <= 0 or height <= 0:
+        raise ValueError('Width and height must be more than 0')
+
+    ndc_x = 2.0 * x / width - 1.0
+    ndc_y = 2.0 * y / height - 1.0
+
+    # Pyrr's layout multiplies row vectors from the left
+    inverse = numpy.linalg.inv(numpy.asarray(view_projection, numpy.float64))
+    near = numpy.array([ndc_x, ndc_y, -1.0, 1.0]) @ inverse
+    far = numpy.array([ndc_x, ndc_y, 1.0, 1.0]) @ inverse
+    near = near[:3] / near[3]
+    far = far[:3] / far[3]
+
+    return near, far - near
+
+
+def to_local_ray(origin, direction, world_matrix):
+    """ Express a world space ray in the space of a model matrix. Distances along it are unchanged. """
+    inverse = numpy.linalg.inv(numpy.asarray(world_matrix, numpy.float64))
+    local_origin = numpy.append(origin, 1.0) @ inverse
+    local_direction = numpy.append(direction, 0.0) @ inverse
+    return local_origin[:3], local_direction[:3]
@@ -0,0 +1,183 @@
+import collections
+import contextlib
+import ctypes
+import json
+import time
+
+import numpy
+
+from OpenGL.GL import *
+
+_DEFAULT_HISTORY = 300  # Frames kept for percentiles and the trace
+_GPU_LATENCY = 3  # Frames a GPU query gets before its result is read back
+_PERCENTILES = (50, 90, 99)
+
+FRAME = 'frame'
+
+
+class FrameProfiler:
+    """ CPU and GPU timings of the stages of each frame.
+
+    Stages are timed on the CPU with perf_counter and on the GPU with
+    GL_TIME_ELAPSED queries. The queries are spread over a ring of frames and a
+    result is only read once the GPU has it available, so profiling never waits
+    for the GPU; a frame whose results are late simply has no GPU time.
+    Stages must not nest, as only one GL_TIME_ELAPSED query can be active.
+    """
+
+    def __init__(self, enabled=True, gpu=True, history=_DEFAULT_HISTORY):
+        if history is None or history < 1:
+            raise ValueError('Profiler history must be at least 1 frame')
+
+        self.enabled = enabled
+        self.gpu = gpu
+        self.history = history
+        self.frame_count = 0
+
+        self.cpu_times = collections.defaultdict(lambda: collections.deque(maxlen=self.history))
+        self.gpu_times = collections.defaultdict(lambda: collections.deque(maxlen=self.history))
+        self._trace = collections.deque(maxlen=self.history)
+
+        self._epoch = time.perf_counter()
+        self._frame_start = None
+        self._frame_events = []
+
+        # Per ring slot: the trace events of the frame issued in it, its query objects and the queries in use
+        self._query_events = [None] * _GPU_LATENCY
+        self._queries = [[] for _ in range(_GPU_LATENCY)]
+        self._pending = [[] for _ in range(_GPU_LATENCY)]
+
+    def begin_frame(self):
+        if not self.enabled:
+            return
+
+        self._frame_start = time.perf_counter()
+        self._frame_events = []
+
+        if self.gpu:
+            self._collect_gpu(self.frame_count % _GPU_LATENCY)
+
+    def end_frame(self):
+        """ Close the current frame. Returns its CPU time in seconds. """
+        if not self.enabled or self._frame_start is None:
+            return 0.0
+
+        end = time.perf_counter()
+        frame_time = end - self._frame_start
+        self.cpu_times[FRAME].append(frame_time)
+        self._frame_events.append(self._event(FRAME, 'cpu', self._frame_start, frame_time))
+
+        self._query_events[self.frame_count % _GPU_LATENCY] = self._frame_events
+        self._trace.append(self._frame_events)
+
+        self._frame_start = None
+        self.frame_count += 1
+
+        return frame_time
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Time the enclosed block as one stage of the current frame. """
+        if not self.enabled or self._frame_start is None:
+            yield
+            return
+
+        # The first frame carries driver warm-up and some drivers report a bogus time for it
+        query = None
+        if self.gpu and self.frame_count > 0:
+            query = self._query(self.frame_count % _GPU_LATENCY)
+            glBeginQuery(GL_TIME_ELAPSED, query)
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if query is not None:
+                glEndQuery(GL_TIME_ELAPSED)
+                self._pending[self.frame_count % _GPU_LATENCY].append((name, query, start))
+
+            self.cpu_times[name].append(elapsed)
+            self._frame_events.append(self._event(name, 'cpu', start, elapsed))
+
+    def _query(self, slot):
+        queries = self._queries[slot]
+        index = len(self._pending[slot])
+        if index == len(queries):
+            queries.append(int(glGenQueries(1)[0]))
+        return queries[index]
+
+    def _collect_gpu(self, slot):
+        pending = self._pending[slot]
+        if not pending:
+            return
+
+        # The ring slot is about to be reused, anything not available by now is dropped
+        if all(glGetQueryObjectiv(query, GL_QUERY_RESULT_AVAILABLE) for _, query, _ in pending):
+            frame_total = 0.0
+            result = ctypes.c_uint64()
+            for name, query, start in pending:
+                glGetQueryObjectui64v(query, GL_QUERY_RESULT, ctypes.byref(result))
+                elapsed = result.value / 1e9
+                frame_total += elapsed
+                self.gpu_times[name].append(elapsed)
+                # GPU work is drawn under the CPU stage that issued it, the GPU runs later than shown
+                self._query_events[slot].append(self._event(name, 'gpu', start, elapsed))
+            self.gpu_times[FRAME].append(frame_total)
+
+        pending.clear()
+
+    def _event(self, name, category, start, duration):
+        return {'name': name, 'cat': category, 'ph': 'X', 'pid': 0, 'tid': 0 if category == 'cpu' else 1,
+                'ts': (start - self._epoch) * 1e6, 'dur': duration * 1e6}
+
+    @staticmethod
+    def percentiles(times, percentiles=_PERCENTILES):
+        """ The given percentiles of a sequence of times, in milliseconds. """
+        if len(times) == 0:
+            return [0.0] * len(percentiles)
+        return list(numpy.percentile(numpy.fromiter(times, numpy.float64, len(times)), percentiles) * 1e3)
+
+    def summary(self):
+        """ {stage: {'cpu': [p50, p90, p99], 'gpu': [...]}} in milliseconds over the kept history. """
+        stages = list(self.cpu_times.keys())
+        stages += [name for name in self.gpu_times.keys() if name not in stages]
+
+        return {name: {'cpu': self.percentiles(self.cpu_times.get(name, ())),
+                       'gpu': self.percentiles(self.gpu_times.get(name, ()))} for name in stages}
+
+    def report(self):
+        header = ' / '.join(f'p{p}' for p in _PERCENTILES)
+        lines = [f'{"stage":14} {"cpu ms " + header:>28} {"gpu ms " + header:>28}']
+
+        for name, times in self.summary().items():
+            cpu = ' / '.join(f'{t:.2f}' for t in times['cpu'])
+            gpu = ' / '.join(f'{t:.2f}' for t in times['gpu']) if self.gpu_times.get(name) else '-'
+            lines.append(f'{name:14} {cpu:>28} {gpu:>28}')
+
+        # The CPU frame time hides behind the GPU when the GPU takes longer, and the other way around
+        cpu_frame = self.percentiles(self.cpu_times.get(FRAME, ()), [50])[0]
+        gpu_frame = self.percentiles(self.gpu_times.get(FRAME, ()), [50])[0]
+        if self.gpu_times.get(FRAME):
+            lines.append('GPU bound' if gpu_frame > cpu_frame else 'CPU bound')
+
+        return '\n'.join(lines)
+
+    def chrome_trace(self):
+        """ The kept frames in the Chrome trace event format, for chrome://tracing or Perfetto. """
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': 0, 'args': {'name': 'CPU'}},
+                  {'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': 1, 'args': {'name': 'GPU'}}]
+        for frame_events in self._trace:
+            events.extend(frame_events)
+
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write_chrome_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+    def delete(self):
+        for queries in self._queries:
+            if queries:
+                glDeleteQueries(len(queries), queries)
+            queries.clear()
@@ -0,0 +1,59 @@
+import operator
+
+from modelplane.gfx.state import gl_state
+
+# Bits of the 64 bit sort key, from the most significant end: the costliest state change sorts first
+_PROGRAM_BITS = 16
+_VERTEX_ARRAY_BITS = 24
+_MATERIAL_BITS = 24
+
+_MATERIAL_SHIFT = 0
+_VERTEX_ARRAY_SHIFT = _MATERIAL_BITS
+_PROGRAM_SHIFT = _MATERIAL_BITS + _VERTEX_ARRAY_BITS
+
+_KEY = operator.itemgetter(0)
+
+
+def sort_key(program, vertex_array, material=0):
+    """ Pack the state a draw needs into a 64 bit integer, draws sharing state sort next to each other. """
+    # GL names may come as numpy integers, which would overflow when shifted
+    program, vertex_array, material = int(program), int(vertex_array), int(material)
+    if not 0 <= program < 1 << _PROGRAM_BITS or not 0 <= vertex_array < 1 << _VERTEX_ARRAY_BITS or \
+            not 0 <= material < 1 << _MATERIAL_BITS:
+        raise ValueError('Program, vertex array or material does not fit the sort key')
+
+    return program << _PROGRAM_SHIFT | vertex_array << _VERTEX_ARRAY_SHIFT | material << _MATERIAL_SHIFT
+
+
+class RenderQueue:
+    """ Draws sorted by their state, so each program and vertex array is bound once however many draws use it.
+
+    A draw is a function called with its arguments once its program and vertex
+    array are bound. The queue is kept until cleared, a scene that did not
+    change submits the same draws again every frame.
+    """
+
+    def __init__(self):
+        self._draws = []
+        self._sorted = True
+
+    def __len__(self):
+        return len(self._draws)
+
+    def clear(self):
+        self._draws.clear()
+        self._sorted = True
+
+    def add(self, program, vertex_array, draw, *args, material=0):
+        self._draws.append((sort_key(program, vertex_array, material), program, vertex_array, draw, args))
+        self._sorted = False
+
+    def submit(self, state=gl_state):
+        if not self._sorted:
+            self._draws.sort(key=_KEY)
+            self._sorted = True
+
+        for _, program, vertex_array, draw, args in self._draws:
+            state.use_program(program)
+            state.bind_vertex_array(vertex_array)
+            draw(*args)
@@ -0,0 +1,125 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+DEBUG = 'debug'
+RELEASE = 'release'
+
+_PROFILE_VARIABLE = 'MODELPLANE_GL_PROFILE'
+
+# PyOpenGL switches that check or log every call, turned off in the release profile. The debug profile keeps
+# PyOpenGL's defaults, which check errors and array sizes.
+_CHECK_FLAGS = ['ERROR_CHECKING', 'ERROR_LOGGING', 'ARRAY_SIZE_CHECKING', 'CONTEXT_CHECKING']
+
+_BENCHMARK_CALLS = 20000
+
+
+def select_profile(profile=None):
+    """ Choose how much OpenGL checking is done. Returns the chosen profile.
+
+    DEBUG keeps PyOpenGL's checks of every call and reports driver messages
+    through KHR_debug with the Python line that caused them. RELEASE turns the
+    checks off and makes gl_error_check() do nothing. PyOpenGL reads its
+    switches when OpenGL.GL is first imported, so this has to run before that.
+    Without a profile, the MODELPLANE_GL_PROFILE variable or else DEBUG is used.
+    """
+    if profile is None:
+        profile = os.environ.get(_PROFILE_VARIABLE, DEBUG)
+
+    if profile not in [DEBUG, RELEASE]:
+        raise ValueError(f"Unknown OpenGL profile '{profile}'")
+
+    if 'OpenGL.GL' in sys.modules and current_profile() != profile:
+        raise RuntimeError(f"OpenGL was already imported, the '{profile}' profile has to be selected before")
+
+    if profile == RELEASE:
+        import OpenGL
+        for flag in _CHECK_FLAGS:
+            setattr(OpenGL, flag, False)
+
+    global checking
+    checking = profile != RELEASE
+
+    os.environ[_PROFILE_VARIABLE] = profile
+    return profile
+
+
+def current_profile():
+    return os.environ.get(_PROFILE_VARIABLE, DEBUG)
+
+
+# Whether gl_error_check() asks the driver, read on every call so a profile selected later still applies
+checking = current_profile() != RELEASE
+
+
+def _measure(calls):
+    """ Seconds per call of a few typical GL calls and of gl_error_check, in the profile this process runs. """
+    from modelplane.gfx.offscreen import OffscreenContext, select_platform
+    select_platform()
+
+    from OpenGL.GL import GL_FLOAT_VEC4, glBindVertexArray, glGenVertexArrays, glUniform4f, glUseProgram
+    from modelplane.gfx.shader.shader import Shader, bundled
+    from modelplane.gfx.util.error import gl_error_check
+
+    context = OffscreenContext(16, 16)
+    shader = Shader(bundled('viewer_shader.vert'), bundled('viewer_shader.frag'))
+    vao = glGenVertexArrays(1)
+    uniform = next((variable.location for variable in shader.uniforms.values() if variable.type == GL_FLOAT_VEC4), -1)
+
+    def bind():
+        glBindVertexArray(vao)
+
+    def use():
+        glUseProgram(shader.program)
+
+    def set_uniform():
+        glUniform4f(uniform, 0.0, 0.0, 0.0, 1.0)
+
+    results = {}
+    for name, call in [('glBindVertexArray', bind), ('glUseProgram', use), ('glUniform4f', set_uniform),
+                       ('gl_error_check', gl_error_check)]:
+        start = time.perf_counter()
+        for _ in range(calls):
+            call()
+        results[name] = (time.perf_counter() - start) / calls
+
+    context.destroy()
+    return results
+
+
+def _benchmark(calls):
+    # The profile can only be chosen before OpenGL is imported, so each runs in a process of its own
+    results = {}
+    for profile in [DEBUG, RELEASE]:
+        output = subprocess.run([sys.executable, '-m', 'modelplane.gfx.runtime', '--measure', profile,
+                                 '--calls', str(calls)], check=True, capture_output=True, text=True).stdout
+        results[profile] = {name: float(seconds) for name, seconds in
+                            (line.split() for line in output.splitlines() if line)}
+
+    print(f'{"call":18} {"debug us":>10} {"release us":>10} {"speedup":>8}')
+    for name, seconds in results[DEBUG].items():
+        release = results[RELEASE][name]
+        speedup = f'{seconds / release:.1f}x' if release > 0 else '-'
+        print(f'{name:18} {seconds * 1e6:>10.2f} {release * 1e6:>10.2f} {speedup:>8}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure the per call cost of the debug and release OpenGL profiles '
+                                                 'on a headless context.')
+    parser.add_argument('--calls', type=int, default=_BENCHMARK_CALLS, help='Calls timed for each function')
+    parser.add_argument('--measure', choices=[DEBUG, RELEASE], default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.measure is None:
+        _benchmark(args.calls)
+        return
+
+    select_profile(args.measure)
+    for name, seconds in _measure(args.calls).items():
+        print(name, seconds)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,31 +1,483 @@
+import numpy
+
 from OpenGL.GL import *
 
+from modelplane.gfx.batch import StaticBatch
+from modelplane.gfx.bvh import BVH, CullStats, transform_aabbs
+from modelplane.gfx.frustum import frustum_planes
+from modelplane.gfx.instance_buffer import InstanceBuffer
+from modelplane.gfx.mesh.registry import Mesh, mesh_registry
+from modelplane.gfx.picking import PickResult, to_local_ray
+from modelplane.gfx.render_queue import RenderQueue
+from modelplane.gfx.shapes.shape import Shape
 from modelplane.gfx.util.color import Color
 
+_TRIANGLES_PER_PIXEL = 0.5  # Detail wanted for the square a shape's bounding sphere covers on screen
+_LOD_HYSTERESIS = 0.25  # How far past a switching point the covered area has to go before the level changes
+_PARTIAL_TRANSFORM_RATIO = 0.25  # Share of changed items above which every transform is refreshed in one go
+
+
+class _ViewState:
+    """ Culling and level of detail results the scene keeps for each view it is drawn from. """
+
+    def __init__(self, item_count):
+        self.view_projection = None
+        self.visible = None
+        self.lod_levels = numpy.zeros(item_count, numpy.int64)
+        self.lod_view = None
+
 
 class Scene:
 
     _DEFAULT_COLOR = Color(0.24, 0.25, 0.27, 1.0)
 
-    def __init__(self, bg_color=_DEFAULT_COLOR):
+    def __init__(self, bg_color=_DEFAULT_COLOR, transform_store=None, culling=True, batching=True, lod=True):
         self.color = bg_color
         self.shapes = []
         self.selected_shape = None
+        self._instance_buffers = {}
+
+        # With a TransformStore all model matrices are computed in batches and copied
+        # into the instance buffers without touching the shapes one by one
+        self.transform_store = transform_store
+
+        # Frustum culling against a BVH over the world space boxes of the items
+        self.culling = culling
+        self.cull_stats = CullStats()
+        self.bvh = None
+
+        # Small static meshes are packed into one batch drawn with a single multi-draw call
+        self.batching = batching
+        self.batch = None
+
+        # Meshes with levels of detail are drawn at the level their size on screen calls for
+        self.lod = lod
+        self._lod_items = None
+        self._lod_triangles = None
+
+        # Every primitive shape in the scene, hierarchies flattened, with its world matrix,
+        # tint and world space box. Rebuilt when shapes are added or removed.
+        self.items = []
+        self._item_groups = {}
+        self._draw_groups = {}
+        self._layouts = set()
+        self._checked_layouts = set()
+        self._item_slots = None
+        self._local_bounds = None
+        self.world_matrices = None
+        self.world_bounds = None
+        self._tints = None
+
+        # Shapes moved or recolored since the last update and the item rows of each shape, so
+        # moving one shape only refreshes its rows
+        self._changed_shapes = Shape.watch_changes()
+        self._item_rows = {}
+        self._all_transforms_dirty = True
+
+        self._structure_dirty = True
+        self._structure_revision = None
+        self._transform_revision = None
+        self._geometry_revision = None
+
+        # A scene can be drawn from several cameras a frame, each view keeps its own culling and
+        # levels of detail. The instance buffers hold the data of the view drawn last.
+        self._views = {}
+        self._view = _ViewState(0)
+        self._instances_view = None
+        self._instances_dirty = True
+
+        # Draws of the current instance buffers, sorted by program and vertex array
+        self._queue = RenderQueue()
+        self._program = 0
+        self._queue_program = None
 
     def add_shape(self, shape):
         if shape is not None:
+            # Shapes hold GPU buffers only while in a scene, added again they acquire them back
+            shape.acquire()
+            if self.transform_store is not None:
+                shape.bind_transform_store(self.transform_store)
             self.shapes.append(shape)
+            self._structure_dirty = True
 
     def remove_shape(self, shape):
         if shape is not None:
             self.shapes.remove(shape)
+            shape.release()
+            shape.unbind_transform_store()
+            self._structure_dirty = True
 
     def shape_count(self):
         return len(self.shapes)
 
-    def render(self, shader, view_matrix):
+    def changed(self):
+        """ Whether shapes were added, removed, moved or recolored since the last update. """
+        return self._structure_dirty or self._structure_revision != Shape.structure_revision or \
+            self._transform_revision != Shape.revision or self._geometry_revision != Mesh.geometry_revision
+
+    def update(self):
+        """ Bring the world matrices, world boxes and BVH up to date with the shapes. """
+        if self._structure_dirty or self._structure_revision != Shape.structure_revision:
+            self._rebuild_items()
+
+        if self._geometry_revision != Mesh.geometry_revision:
+            self._update_geometry()
+
+        # Nothing is recomputed for a static scene
+        if self._transform_revision != Shape.revision:
+            self._update_transforms()
+
+    @property
+    def lod_levels(self):
+        """ Level of detail of every item in the view drawn last. """
+        return self._view.lod_levels
+
+    def render(self, shader, view_projection=None, viewport_height=None):
+        """ Draw the scene. Culling needs the view_projection matrix, picking levels of detail the viewport_height. """
+        self.prepare(shader)
+        self.draw(view_projection, viewport_height)
+
+    def prepare(self, shader):
+        """ The work shared by all views of a frame: bring the scene up to date and upload mesh edits. """
         glClearColor(self.color.r, self.color.g, self.color.b, self.color.a)
 
+        self.update()
+        self._check_layouts(shader)
+        self._program = shader.program
+
+        # Edited meshes upload their dirty ranges before anything draws from them
+        mesh_registry.flush()
+
+    def draw(self, view_projection=None, viewport_height=None, view=None):
+        """ Draw the prepared scene from one view, any hashable key such as its camera. """
+        self._use_view(view)
+
+        if self.culling and view_projection is not None:
+            self._cull(view_projection)
+        elif self._view.visible is not None:
+            self._view.visible = None
+            self._instances_dirty = True
+
+        if self.lod and view_projection is not None and viewport_height:
+            self._select_lods(view_projection, viewport_height)
+
+        if self._instances_dirty:
+            self._upload_instances()
+
+        if self._queue_program != self._program:
+            self._build_queue()
+
+        # The queue is only rebuilt when the instances change, a static view replays it
+        self._queue.submit()
+
+    def pick(self, origin, direction):
+        """ The nearest shape hit by a world space ray as a PickResult, or None. """
+        self.update()
+
+        if not self.items:
+            return None
+
+        origin = numpy.asarray(origin, numpy.float64)
+        direction = numpy.asarray(direction, numpy.float64)
+
+        candidates, distances = self.bvh.intersect_ray(origin, direction)
+        nearest = None
+
+        # Shapes are tried front to back, so the search ends at the first box behind the nearest hit
+        for i in numpy.argsort(distances):
+            if nearest is not None and distances[i] > nearest.distance:
+                break
+
+            item = candidates[i]
+            shape = self.items[item]
+            local_origin, local_direction = to_local_ray(origin, direction, self.world_matrices[item])
+            hit = shape.mesh.triangle_bvh().intersect(local_origin, local_direction)
+
+            if hit is not None and (nearest is None or hit[1] < nearest.distance):
+                triangle, distance = hit
+                nearest = PickResult(shape, triangle, origin + distance * direction, distance)
+
+        return nearest
+
+    def select(self, shape):
+        if self.selected_shape is not None:
+            self.selected_shape.selected = False
+
+        self.selected_shape = shape
+
+        if shape is not None:
+            shape.selected = True
+
+    def _rebuild_items(self):
+        groups = {}
         for shape in self.shapes:
-            shader['u_modelview'] = view_matrix * shape.model_matrix()
-            shape.render()
+            shape.collect_instances(groups)
+
+        self.items = []
+        self._item_groups = {}
+        for mesh, shapes in groups.items():
+            first = len(self.items)
+            self.items.extend(shapes)
+            self._item_groups[mesh] = numpy.arange(first, len(self.items))
+
+        self._item_rows = {}
+        for i, shape in enumerate(self.items):
+            self._item_rows.setdefault(shape, []).append(i)
+
+        count = len(self.items)
+        self._local_bounds = numpy.array([shape.mesh.bounds for shape in self.items], numpy.float32).reshape(-1, 2, 3)
+        self.world_matrices = numpy.zeros((count, 4, 4), numpy.float32)
+        self._tints = numpy.zeros((count, 4), numpy.float32)
+
+        if self.transform_store is not None:
+            self._item_slots = numpy.fromiter((shape.transform_slot for shape in self.items), numpy.int64, count)
+
+        self._layouts = {mesh.layout for mesh in self._item_groups}
+        self._draw_groups = self._update_batch(self._item_groups)
+        self._release_instance_buffers(self._draw_groups)
+        self._update_lod_items()
+
+        # Culling and levels of detail are per item, every view starts over
+        self._views = {}
+        self._view = _ViewState(count)
+        self._instances_view = None
+
+        self.bvh = None
+        self._all_transforms_dirty = True
+        self._structure_dirty = False
+        self._structure_revision = Shape.structure_revision
+        self._transform_revision = None
+        self._geometry_revision = Mesh.geometry_revision
+
+    def _check_layouts(self, shader):
+        # A mesh whose layout does not feed the shader's inputs would draw garbage, better to fail loudly once
+        for layout in self._layouts:
+            if (shader.program, layout.name) not in self._checked_layouts:
+                layout.check(shader)
+                self._checked_layouts.add((shader.program, layout.name))
+
+    def _update_batch(self, groups):
+        """ Put the meshes that fit into the static batch. Returns the groups left to draw one by one. """
+        batched = []
+        if self.batching and StaticBatch.supported():
+            batched = [mesh for mesh in groups if StaticBatch.accepts(mesh)]
+
+        # A single mesh gains nothing from a batch
+        if len(batched) < 2:
+            batched = []
+
+        if self.batch is not None and self.batch.membership != frozenset(batched):
+            self.batch.delete()
+            self.batch = None
+
+        if batched and self.batch is None:
+            self.batch = StaticBatch(batched)
+
+        if self.batch is not None:
+            self.batch.set_items(groups)
+
+        return {mesh: items for mesh, items in groups.items()
+                if self.batch is None or mesh not in self.batch.membership}
+
+    def _use_view(self, view):
+        state = self._views.get(view)
+        if state is None:
+            state = _ViewState(len(self.items))
+            self._views[view] = state
+
+        self._view = state
+
+        # The instance buffers were last filled for another view
+        if view != self._instances_view:
+            self._instances_view = view
+            self._instances_dirty = True
+
+    def _update_lod_items(self):
+        meshes = [mesh for mesh in self._draw_groups if mesh.lods]
+        if not meshes:
+            self._lod_items = self._lod_triangles = None
+            return
+
+        # Triangles of every level for each item, -1 past the coarsest level of its mesh
+        levels = max(len(mesh.lods) for mesh in meshes) + 1
+        triangles = numpy.full((len(meshes), levels), -1, numpy.int64)
+        for i, mesh in enumerate(meshes):
+            counts = mesh.triangle_counts()
+            triangles[i, :len(counts)] = counts
+
+        sizes = [len(self._draw_groups[mesh]) for mesh in meshes]
+        self._lod_items = numpy.concatenate([self._draw_groups[mesh] for mesh in meshes])
+        self._lod_triangles = numpy.repeat(triangles, sizes, axis=0)
+
+    def _lod_level(self, areas):
+        # The coarsest level that still has the triangles the area on screen calls for
+        wanted = areas * _TRIANGLES_PER_PIXEL
+        return numpy.maximum((self._lod_triangles >= wanted[:, None]).sum(axis=1) - 1, 0)
+
+    def _select_lods(self, view_projection, viewport_height):
+        if self._lod_items is None:
+            return
+
+        view_projection = numpy.asarray(view_projection, numpy.float64)
+
+        state = self._view
+        if state.lod_view is not None and state.lod_view[0] == viewport_height and \
+                numpy.array_equal(view_projection, state.lod_view[1]):
+            return
+
+        state.lod_view = viewport_height, view_projection
+
+        bounds = self.world_bounds[self._lod_items].astype(numpy.float64)
+        centers = (bounds[:, 0] + bounds[:, 1]) * 0.5
+        diameters = numpy.linalg.norm(bounds[:, 1] - bounds[:, 0], axis=1)
+
+        # In pyrr's layout clip w is the dot with the last column, and the length of the y column
+        # is the projection's y scale as long as the view matrix does not scale
+        w = centers @ view_projection[:3, 3] + view_projection[3, 3]
+        scale = numpy.linalg.norm(view_projection[:3, 1])
+
+        # Shapes around or behind the camera are as big as it gets
+        pixels = diameters * scale / numpy.maximum(w, 1e-6) * viewport_height * 0.5
+        areas = pixels * pixels
+
+        current = state.lod_levels[self._lod_items]
+        wanted = self._lod_level(areas)
+
+        # A switch has to hold with the area a bit off towards the current level, so shapes
+        # sitting at a switching point do not flicker between two levels
+        coarser = numpy.maximum(current, self._lod_level(areas * (1.0 + _LOD_HYSTERESIS)))
+        finer = numpy.minimum(current, self._lod_level(areas * (1.0 - _LOD_HYSTERESIS)))
+        levels = numpy.where(wanted > current, coarser, numpy.where(wanted < current, finer, current))
+
+        if not numpy.array_equal(levels, current):
+            state.lod_levels[self._lod_items] = levels
+            self._instances_dirty = True
+
+    def _update_geometry(self):
+        # Edited meshes have new local boxes, the world boxes and BVH follow with the transforms
+        for mesh, items in self._item_groups.items():
+            self._local_bounds[items] = mesh.bounds
+
+        self._geometry_revision = Mesh.geometry_revision
+        self._transform_revision = None
+        self._all_transforms_dirty = True
+
+    def _update_transforms(self):
+        rows = None
+        if self.transform_store is not None:
+            self.transform_store.update()
+            self.world_matrices[:] = self.transform_store.world_matrices[self._item_slots]
+            self._tints[:] = self.transform_store.tints[self._item_slots]
+        elif not self._all_transforms_dirty and \
+                len(self._changed_shapes) <= _PARTIAL_TRANSFORM_RATIO * len(self.items):
+            # Only the rows of shapes that changed, any change elsewhere in the hierarchy marked them too
+            rows = numpy.array([i for shape in self._changed_shapes for i in self._item_rows.get(shape, ())],
+                               numpy.int64)
+            for i in rows:
+                shape = self.items[i]
+                self.world_matrices[i] = shape.world_matrix()
+                self._tints[i] = shape.color[0], shape.color[1], shape.color[2], shape.color[3]
+        else:
+            for i, shape in enumerate(self.items):
+                self.world_matrices[i] = shape.world_matrix()
+                self._tints[i] = shape.color[0], shape.color[1], shape.color[2], shape.color[3]
+
+        self._changed_shapes.clear()
+        self._all_transforms_dirty = False
+
+        if rows is None:
+            self.world_bounds = transform_aabbs(self._local_bounds, self.world_matrices)
+        elif len(rows):
+            self.world_bounds[rows] = transform_aabbs(self._local_bounds[rows], self.world_matrices[rows])
+
+        if self.bvh is None:
+            self.bvh = BVH(self.world_bounds)
+        else:
+            self.bvh.refit(self.world_bounds, rows)
+
+        self._transform_revision = Shape.revision
+        for state in self._views.values():
+            state.view_projection = None
+            state.lod_view = None
+        self._instances_dirty = True
+
+    def _cull(self, view_projection):
+        view_projection = numpy.asarray(view_projection, numpy.float32)
+
+        state = self._view
+        if state.view_projection is not None and numpy.array_equal(view_projection, state.view_projection):
+            return
+
+        state.view_projection = view_projection
+
+        visible = numpy.zeros(len(self.items), bool)
+        visible[self.bvh.cull(frustum_planes(view_projection), self.cull_stats)] = True
+
+        if state.visible is None or not numpy.array_equal(visible, state.visible):
+            state.visible = visible
+            self._instances_dirty = True
+
+    def _upload_instances(self):
+        if self.batch is not None:
+            self.batch.upload_instances(self.world_matrices, self._tints, self._view.visible)
+
+        for mesh, items in self._draw_groups.items():
+            visible = self._view.visible
+            if visible is not None:
+                items = items[visible[items]]
+
+            if mesh.lods:
+                levels = self._view.lod_levels[items]
+                for level in range(len(mesh.lods) + 1):
+                    self._upload_group(mesh.lod(level), items[levels == level])
+            else:
+                self._upload_group(mesh, items)
+
+        self._instances_dirty = False
+        self._queue_program = None
+
+    def _build_queue(self):
+        # Shapes sharing a mesh are drawn with one instanced call. The view and projection
+        # matrices are uploaded once per frame through the FrameData uniform block.
+        self._queue.clear()
+
+        for mesh, buffer in self._instance_buffers.items():
+            if buffer.count == 0:
+                continue
+            buffer.attach(mesh.vao)
+            self._queue.add(self._program, mesh.vao, mesh.draw_instanced, buffer.count)
+
+        if self.batch is not None and self.batch.instances.count > 0:
+            self._queue.add(self._program, self.batch.vao, self.batch.draw)
+
+        self._queue_program = self._program
+
+    def _upload_group(self, mesh, items):
+        count = len(items)
+        buffer = self._instance_buffer(mesh, count)
+        if mesh.decode_matrix is None:
+            buffer.data['model'][:count] = self.world_matrices[items]
+        else:
+            # Quantized positions are scaled back to the mesh's box before the model matrix applies
+            buffer.data['model'][:count] = numpy.matmul(mesh.decode_matrix, self.world_matrices[items])
+        buffer.data['tint'][:count] = self._tints[items]
+        buffer.upload(count)
+
+    def _instance_buffer(self, mesh, count):
+        buffer = self._instance_buffers.get(mesh)
+
+        if buffer is None:
+            buffer = InstanceBuffer(max(count, 1))
+            self._instance_buffers[mesh] = buffer
+
+        buffer.reserve(count)
+        return buffer
+
+    def _release_instance_buffers(self, groups):
+        # Meshes that are no longer drawn may have been deleted along with their vertex arrays
+        drawn = set(groups)
+        drawn.update(lod for mesh in groups for lod in mesh.lods)
+
+        for mesh in list(self._instance_buffers):
+            if mesh not in drawn:
+                self._instance_buffers.pop(mesh).delete()
@@ -0,0 +1,93 @@
+import argparse
+import importlib.resources
+import sys
+
+_VERTEX_EXTENSION = '.vert'
+_FRAGMENT_EXTENSION = '.frag'
+
+
+def bundled_programs():
+    """ Names of the vertex and fragment shader pairs shipped in this package, without their extensions. """
+    files = {resource.name for resource in importlib.resources.files(__package__).iterdir()}
+    return sorted(name[:-len(_VERTEX_EXTENSION)] for name in files
+                  if name.endswith(_VERTEX_EXTENSION) and name[:-len(_VERTEX_EXTENSION)] + _FRAGMENT_EXTENSION in files)
+
+
+def precompile(cache):
+    """ Build every bundled program through the cache in the current context. Returns (name, cached) pairs. """
+    from modelplane.gfx.shader.shader import Shader, bundled
+
+    results = []
+    for name in bundled_programs():
+        shader = Shader(bundled(name + _VERTEX_EXTENSION), bundled(name + _FRAGMENT_EXTENSION), cache=cache)
+        results.append((name, shader.from_cache))
+
+    return results
+
+
+def _hidden_window():
+    import glfw
+
+    if not glfw.init():
+        sys.exit('Error: Failed to initialize GLFW.')
+
+    # The same context the viewer asks for, so the driver and its binaries match
+    glfw.window_hint(glfw.VISIBLE, glfw.FALSE)
+    glfw.window_hint(glfw.CONTEXT_VERSION_MAJOR, 3)
+    glfw.window_hint(glfw.CONTEXT_VERSION_MINOR, 3)
+    glfw.window_hint(glfw.OPENGL_PROFILE, glfw.OPENGL_CORE_PROFILE)
+    if 'darwin' in sys.platform:
+        glfw.window_hint(glfw.OPENGL_FORWARD_COMPAT, glfw.TRUE)
+
+    window = glfw.create_window(16, 16, 'precompile', None, None)
+    if not window:
+        glfw.terminate()
+        sys.exit('Error: Failed to create GLFW window.')
+
+    glfw.make_context_current(window)
+    return window
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Warm the ModelPlane shader program cache with every bundled shader.')
+    parser.add_argument('directory', nargs='?', default=None, help='Cache directory to fill')
+    parser.add_argument('--headless', action='store_true',
+                        help='Compile on an offscreen context instead of a hidden window')
+    parser.add_argument('--clear', action='store_true', help='Delete the cached binaries first')
+    args = parser.parse_args(argv)
+
+    # PyOpenGL picks its platform on first import, so nothing here imports OpenGL before this
+    if args.headless:
+        from modelplane.gfx.offscreen import select_platform
+        select_platform()
+
+    from modelplane.gfx.shader.program_cache import ProgramCache
+
+    if args.headless:
+        from modelplane.gfx.offscreen import OffscreenContext
+        context = OffscreenContext(16, 16)
+    else:
+        window = _hidden_window()
+
+    cache = ProgramCache(args.directory)
+    print(f'Shader cache: {cache.directory}')
+
+    if args.clear:
+        print(f'{cache.clear()} cached program(s) removed')
+
+    if not cache.supported():
+        print('The driver cannot save program binaries, nothing is cached')
+    else:
+        for name, cached in precompile(cache):
+            print(f'{"cached" if cached else "compiled":9} {name}')
+
+    if args.headless:
+        context.destroy()
+    else:
+        import glfw
+        glfw.destroy_window(window)
+        glfw.terminate()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
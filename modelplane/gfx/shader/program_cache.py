@@ -0,0 +1,158 @@
+import hashlib
+import os
+import struct
+
+import numpy
+
+from OpenGL.GL import *
+
+from modelplane.gfx.util.capabilities import supports
+
+_MAGIC = b'MPPB'
+_VERSION = 1
+_EXTENSION = '.mpprog'
+
+# magic, version, binary format, binary length
+_HEADER = struct.Struct('<4sIII')
+
+
+def _default_directory():
+    return os.environ.get('MODELPLANE_SHADER_CACHE',
+                          os.path.join(os.path.expanduser('~'), '.cache', 'modelplane', 'shaders'))
+
+
+class ProgramCache:
+    """ On-disk cache of linked program binaries, to skip compiling and linking GLSL on startup.
+
+    A binary is only good for the driver that made it, so each file is named by
+    a hash of the program's sources, with any defines already in them, and the
+    GL vendor, renderer and version. A binary the driver still rejects, as after
+    an update that kept the version string, is deleted and the program is built
+    from source again. Needs OpenGL 4.1 or ARB_get_program_binary, without them
+    nothing is cached.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory if directory is not None else _default_directory()
+        self.hits = 0
+        self.misses = 0
+
+        self._formats = None
+        self._driver = None
+
+    def supported(self):
+        if self._formats is None:
+            self._formats = set()
+            if supports(4, 1, 'GL_ARB_get_program_binary'):
+                count = glGetIntegerv(GL_NUM_PROGRAM_BINARY_FORMATS)
+                if count > 0:
+                    formats = numpy.zeros(count, numpy.int32)
+                    glGetIntegerv(GL_PROGRAM_BINARY_FORMATS, formats)
+                    self._formats = set(formats.tolist())
+
+        return bool(self._formats)
+
+    def _driver_string(self):
+        if self._driver is None:
+            self._driver = '|'.join(glGetString(name).decode(errors='replace')
+                                    for name in [GL_VENDOR, GL_RENDERER, GL_VERSION])
+        return self._driver
+
+    def path_for(self, sources):
+        digest = hashlib.sha1(self._driver_string().encode())
+        for source in sources:
+            # Separated, so moving text from one stage to the next is a different program
+            digest.update(b'\0' + source.encode())
+
+        return os.path.join(self.directory, digest.hexdigest() + _EXTENSION)
+
+    def prepare(self, program):
+        """ Ask the driver to keep the binary of a program about to be linked, so it can be stored. """
+        if self.supported():
+            glProgramParameteri(program, GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL_TRUE)
+
+    def load(self, program, sources):
+        """ Link program from the binary cached for its sources. Returns whether it could. """
+        if not self.supported():
+            return False
+
+        cache_path = self.path_for(sources)
+        try:
+            with open(cache_path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            self.misses += 1
+            return False
+
+        binary = self._read(data)
+        if binary is None:
+            self._discard(cache_path)
+            return False
+
+        binary_format, binary = binary
+        glProgramBinary(program, binary_format, binary, len(binary))
+
+        if glGetProgramiv(program, GL_LINK_STATUS) == GL_FALSE:
+            self._discard(cache_path)
+            return False
+
+        self.hits += 1
+        return True
+
+    def _read(self, data):
+        if len(data) < _HEADER.size:
+            return None
+
+        magic, version, binary_format, length = _HEADER.unpack_from(data)
+        if magic != _MAGIC or version != _VERSION or binary_format not in self._formats or \
+                len(data) != _HEADER.size + length:
+            return None
+
+        return binary_format, numpy.frombuffer(data, numpy.uint8, length, _HEADER.size)
+
+    def _discard(self, cache_path):
+        self.misses += 1
+        try:
+            os.remove(cache_path)
+        except OSError:
+            pass
+
+    def store(self, program, sources):
+        """ Write the binary of a program linked after prepare() into the cache. """
+        if not self.supported():
+            return
+
+        length = glGetProgramiv(program, GL_PROGRAM_BINARY_LENGTH)
+        if length <= 0:
+            return
+
+        binary = numpy.zeros(length, numpy.uint8)
+        written = GLsizei()
+        binary_format = GLenum()
+        glGetProgramBinary(program, length, written, binary_format, binary)
+
+        os.makedirs(self.directory, exist_ok=True)
+        cache_path = self.path_for(sources)
+        temporary_path = f'{cache_path}.{os.getpid()}.tmp'
+
+        with open(temporary_path, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, _VERSION, binary_format.value, written.value))
+            f.write(binary[:written.value].tobytes())
+
+        # Another process starting at the same time may write the same file, either copy is good
+        os.replace(temporary_path, cache_path)
+
+    def entries(self):
+        if not os.path.isdir(self.directory):
+            return []
+
+        return sorted(os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                      if name.endswith(_EXTENSION))
+
+    def clear(self):
+        """ Delete every cached binary. Returns how many there were. """
+        entries = self.entries()
+        for cache_path in entries:
+            os.remove(cache_path)
+
+        return len(entries)
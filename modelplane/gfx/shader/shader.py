@@ -1,24 +1,57 @@
+import importlib.resources
+from collections import namedtuple
+
 import numpy
 
 from pyrr import Matrix33, Matrix44
 
+from modelplane.gfx.state import gl_state
 from modelplane.gfx.util.error import *
 
+# Location, GL type and array size of an active uniform or attribute, queried once at link time
+ShaderVariable = namedtuple('ShaderVariable', ['location', 'type', 'size'])
+
+
+def bundled(name):
+    """ A shader file shipped in this package, found wherever the package was installed or run from. """
+    return importlib.resources.files(__package__).joinpath(name)
+
 
 class Shader:
 
-    def __init__(self, vert_shader_path, frag_shader_path):
+    def __init__(self, vert_shader_path, frag_shader_path, defines=None, cache=None):
+        """ defines are name: value pairs #defined at the top of both stages. With a ProgramCache the program is
+        loaded from the binary an earlier run stored, and only compiled when there is none. """
         if vert_shader_path is None or frag_shader_path is None:
             sys.exit('Vertex or fragment shader path is None')
 
-        vertex_shader = self._create_shader(vert_shader_path, GL_VERTEX_SHADER)
-        fragment_shader = self._create_shader(frag_shader_path, GL_FRAGMENT_SHADER)
+        self.sources = [self._with_defines(self._read_source(vert_shader_path), defines),
+                        self._with_defines(self._read_source(frag_shader_path), defines)]
 
         self.program = glCreateProgram()
 
         if self.program == 0:
             sys.exit('ERROR: Failed to create program')
 
+        self.from_cache = cache is not None and cache.load(self.program, self.sources)
+
+        if not self.from_cache:
+            if cache is not None:
+                cache.prepare(self.program)
+
+            self._link(*self.sources)
+
+            if cache is not None:
+                cache.store(self.program, self.sources)
+
+        self.uniforms = self._introspect_uniforms(self.program)
+        self.attributes = self._introspect_attributes(self.program)
+        self.uniform_blocks = {}
+
+    def _link(self, vertex_source, fragment_source):
+        vertex_shader = self._create_shader(vertex_source, GL_VERTEX_SHADER)
+        fragment_shader = self._create_shader(fragment_source, GL_FRAGMENT_SHADER)
+
         glAttachShader(self.program, vertex_shader)
         glAttachShader(self.program, fragment_shader)
 
@@ -39,10 +72,27 @@ class Shader:
         glDeleteShader(fragment_shader)
 
     @staticmethod
-    def _create_shader(shader_file, shader_type):
+    def _read_source(shader_file):
+        # Bundled shaders are package resources, which need not be plain files
+        if hasattr(shader_file, 'read_text'):
+            return shader_file.read_text()
+
         with open(shader_file, 'r') as f:
-            shader_code = f.read()
+            return f.read()
+
+    @staticmethod
+    def _with_defines(source, defines):
+        if not defines:
+            return source
 
+        # Nothing but comments may come before the #version line
+        lines = source.splitlines(keepends=True)
+        first = next((i + 1 for i, line in enumerate(lines) if line.lstrip().startswith('#version')), 0)
+        define_lines = [f'#define {name} {value}\n' for name, value in sorted(defines.items())]
+        return ''.join(lines[:first] + define_lines + lines[first:])
+
+    @staticmethod
+    def _create_shader(shader_code, shader_type):
         shader = glCreateShader(shader_type)
         glShaderSource(shader, shader_code)
         gl_error_check()
@@ -60,18 +110,77 @@ class Shader:
 
         return shader
 
+    @staticmethod
+    def _variable_name(name):
+        if isinstance(name, bytes):
+            name = name.decode()
+        # Arrays are reported as 'name[0]', but are set by their base name
+        if name.endswith('[0]'):
+            name = name[:-3]
+        return name
+
+    @classmethod
+    def _introspect_uniforms(cls, program):
+        uniforms = {}
+
+        for index in range(glGetProgramiv(program, GL_ACTIVE_UNIFORMS)):
+            name, size, uniform_type = glGetActiveUniform(program, index)
+            location = glGetUniformLocation(program, name)
+
+            # Uniforms that live in a uniform block have no location and are set through a UniformBuffer
+            if location < 0:
+                continue
+
+            uniforms[cls._variable_name(name)] = ShaderVariable(location, uniform_type, size)
+
+        gl_error_check()
+
+        return uniforms
+
+    @classmethod
+    def _introspect_attributes(cls, program):
+        attributes = {}
+
+        for index in range(glGetProgramiv(program, GL_ACTIVE_ATTRIBUTES)):
+            name, size, attr_type = glGetActiveAttrib(program, index)
+            location = glGetAttribLocation(program, name)
+
+            if location < 0:
+                continue
+
+            attributes[cls._variable_name(name)] = ShaderVariable(location, attr_type, size)
+
+        gl_error_check()
+
+        return attributes
+
     def get_program(self):
         return self.program
 
     def attrib_location(self, attr):
-        if attr is None:
+        if attr is None or attr not in self.attributes:
             return -1
-        return glGetAttribLocation(self.program, attr)
+        return self.attributes[attr].location
 
     def uniform_location(self, uniform):
-        if uniform is None:
+        if uniform is None or uniform not in self.uniforms:
             return -1
-        return glGetUniformLocation(self.program, uniform)
+        return self.uniforms[uniform].location
+
+    def bind_uniform_block(self, block, binding):
+        if block is None or binding is None or binding < 0:
+            raise ValueError('Uniform block name and binding point cannot be None or negative')
+
+        if block not in self.uniform_blocks:
+            index = glGetUniformBlockIndex(self.program, block)
+
+            if index == GL_INVALID_INDEX:
+                raise ValueError(f"ERROR: Uniform block '{block}' is not in the shader")
+
+            self.uniform_blocks[block] = index
+
+        glUniformBlockBinding(self.program, self.uniform_blocks[block], binding)
+        gl_error_check()
 
     def set_uniformi(self, uniform, *integers):
         if uniform is None or integers is None or len(integers) not in range(5):
@@ -82,6 +191,9 @@ class Shader:
         if location < 0:
             return
 
+        if not self._uniform_changed(location, integers):
+            return
+
         if len(integers) == 1:
             glUniform1i(location, *integers)
         elif len(integers) == 2:
@@ -100,6 +212,9 @@ class Shader:
         if location < 0:
             return
 
+        if not self._uniform_changed(location, self._value_key(vector)):
+            return
+
         vector = numpy.array(vector, numpy.int32)
         glUniform1iv(location, vector)
 
@@ -112,6 +227,9 @@ class Shader:
         if location < 0:
             return
 
+        if not self._uniform_changed(location, floats):
+            return
+
         if len(floats) == 1:
             glUniform1f(location, *floats)
         elif len(floats) == 2:
@@ -130,6 +248,9 @@ class Shader:
         if location < 0:
             return
 
+        if not self._uniform_changed(location, self._value_key(vector)):
+            return
+
         vector = numpy.array(vector, numpy.float32)
         glUniform1fv(location, vector)
 
@@ -142,6 +263,9 @@ class Shader:
         if location < 0:
             return
 
+        if not self._uniform_changed(location, self._value_key(matrix)):
+            return
+
         glUniformMatrix3fv(location, 1, GL_FALSE, matrix)
 
     def set_uniform_matrix4fv(self, uniform, matrix):
@@ -153,18 +277,30 @@ class Shader:
         if location < 0:
             return
 
+        if not self._uniform_changed(location, self._value_key(matrix)):
+            return
+
         glUniformMatrix4fv(location, 1, GL_FALSE, matrix)
 
+    def _uniform_changed(self, location, value):
+        # glUniform sets the bound program's uniforms, so this program is bound first
+        gl_state.use_program(self.program)
+        return gl_state.uniform_changed(self.program, location, value)
+
+    @staticmethod
+    def _value_key(value):
+        return numpy.asarray(value).tobytes()
+
     def use(self):
-        glUseProgram(self.program)
+        gl_state.use_program(self.program)
 
     @staticmethod
     def end_use():
-        glUseProgram(0)
+        gl_state.use_program(0)
 
     def __setitem__(self, key, value):
         # Given name is a uniform within the shader
-        if key is not None and value is not None and self.uniform_location(key) >= 0:
+        if key is not None and value is not None and key in self.uniforms:
             if type(value) == Matrix44:
                 self.set_uniform_matrix4fv(key, value)
             elif type(value) == Matrix33:
@@ -178,7 +314,7 @@ class Shader:
             else:
                 self.set_uniformf(key, value)
         # Given name is an attribute within the shader
-        elif key is not None and value is not None and self.attrib_location(key) >= 0:
+        elif key is not None and value is not None and key in self.attributes:
             return
         else:
             raise ValueError(f"ERROR: Attempting to set '{key},' which is not in the shader")
@@ -0,0 +1,119 @@
+import numpy
+
+from modelplane.gfx.state import gl_state
+from modelplane.gfx.util.error import *
+
+# (base alignment, size) in bytes of each supported GLSL type under the std140 layout rules.
+# Matrices are stored as arrays of column vectors, each column padded to a vec4.
+_STD140 = {
+    'float': (4, 4),
+    'int': (4, 4),
+    'uint': (4, 4),
+    'bool': (4, 4),
+    'vec2': (8, 8),
+    'vec3': (16, 12),
+    'vec4': (16, 16),
+    'ivec4': (16, 16),
+    'mat3': (16, 48),
+    'mat4': (16, 64),
+}
+
+_INT_TYPES = ['int', 'uint', 'bool', 'ivec4']
+
+
+class UniformBuffer:
+    """ A std140 uniform block backed by a uniform buffer object.
+
+    Values are written into a CPU side copy of the block and the changed byte
+    range is uploaded with a single glBufferSubData call when flush() is called,
+    so data shared by every draw (camera, projection) is sent once per frame.
+    """
+
+    def __init__(self, fields, binding=0, usage=GL_DYNAMIC_DRAW):
+        if not fields:
+            raise ValueError('Uniform buffer needs at least one field')
+
+        if binding is None or binding < 0:
+            raise ValueError('Uniform buffer binding point must be 0 or more')
+
+        self.binding = binding
+        self.layout, size = self._std140_layout(fields)
+        self.data = numpy.zeros(size, numpy.uint8)
+
+        self._dirty_start = size
+        self._dirty_end = 0
+
+        self.ubo = glGenBuffers(1)
+        glBindBuffer(GL_UNIFORM_BUFFER, self.ubo)
+        glBufferData(GL_UNIFORM_BUFFER, size, None, usage)
+        glBindBuffer(GL_UNIFORM_BUFFER, 0)
+        glBindBufferBase(GL_UNIFORM_BUFFER, self.binding, self.ubo)
+
+        gl_error_check()
+
+    @staticmethod
+    def _std140_layout(fields):
+        layout = {}
+        offset = 0
+
+        for name, glsl_type in fields:
+            if glsl_type not in _STD140:
+                raise ValueError(f"Unsupported std140 type '{glsl_type}' for '{name}'")
+
+            alignment, size = _STD140[glsl_type]
+            offset = (offset + alignment - 1) // alignment * alignment
+            layout[name] = (offset, glsl_type)
+            offset += size
+
+        # The size of a block is rounded up to the base alignment of a vec4
+        return layout, (offset + 15) // 16 * 16
+
+    @staticmethod
+    def _pack(glsl_type, value):
+        dtype = numpy.int32 if glsl_type in _INT_TYPES else numpy.float32
+        packed = numpy.asarray(value, dtype)
+
+        if glsl_type == 'mat3':
+            padded = numpy.zeros((3, 4), dtype)
+            padded[:, :3] = packed.reshape(3, 3)
+            packed = padded
+
+        return packed.tobytes()
+
+    def __setitem__(self, key, value):
+        if key not in self.layout:
+            raise ValueError(f"ERROR: Attempting to set '{key},' which is not in the uniform block")
+
+        offset, glsl_type = self.layout[key]
+        packed = numpy.frombuffer(self._pack(glsl_type, value), numpy.uint8)
+        end = offset + len(packed)
+
+        # Unchanged values do not need to be uploaded again
+        if numpy.array_equal(self.data[offset:end], packed):
+            return
+
+        self.data[offset:end] = packed
+        self._dirty_start = min(self._dirty_start, offset)
+        self._dirty_end = max(self._dirty_end, end)
+
+    def dirty(self):
+        return self._dirty_end > self._dirty_start
+
+    def flush(self):
+        if not self.dirty():
+            gl_state.count('glBufferSubData', issued=False)
+            return
+
+        gl_state.count('glBufferSubData')
+        glBindBuffer(GL_UNIFORM_BUFFER, self.ubo)
+        glBufferSubData(GL_UNIFORM_BUFFER, self._dirty_start, self._dirty_end - self._dirty_start,
+                        self.data[self._dirty_start:self._dirty_end])
+        glBindBuffer(GL_UNIFORM_BUFFER, 0)
+
+        self._dirty_start = len(self.data)
+        self._dirty_end = 0
+
+    def delete(self):
+        if self.ubo:
+            glDeleteBuffers(1, [self.ubo])
+            self.ubo = 0
@@ -3,12 +3,19 @@
 layout (location = 0) in vec3 a_position;
 layout (location = 1) in vec3 a_color;
 
+// Per-instance data, see InstanceBuffer
+layout (location = 8) in mat4 a_model;
+layout (location = 12) in vec4 a_tint;
+
 out vec3 color;
 
-uniform mat4 u_modelview;
-uniform mat4 u_projection;
+// Per-frame data shared by every draw, uploaded once per frame
+layout (std140) uniform FrameData {
+    mat4 u_view;
+    mat4 u_projection;
+};
 
 void main() {
-    gl_Position = u_projection * u_modelview * vec4(a_position, 1.0f);
-    color = a_color;
+    gl_Position = u_projection * u_view * a_model * vec4(a_position, 1.0f);
+    color = mix(a_color, a_tint.rgb, a_tint.a);
 }
\ No newline at end of file
@@ -1,125 +1,356 @@
+import weakref
+
 import numpy
-from pyrr import matrix44, Matrix44, aabb, Vector3
+from pyrr import Matrix44, aabb, Vector3
 from OpenGL.GL import *
 from math import radians
 
+from modelplane.gfx.bvh import transform_aabbs
+from modelplane.gfx.mesh.layout import choose_layout
+from modelplane.gfx.mesh.registry import mesh_registry
 from modelplane.gfx.shader.shader import Shader
 from modelplane.gfx.util.color import Color
-from modelplane.gfx.util.error import gl_error_check
 
-_DRAW_STYLES = [GL_STATIC_DRAW, GL_DYNAMIC_DRAW, GL_STREAM_DRAW]
+
+class _ChangeSet(set):
+    # A plain set cannot be weakly referenced
+    pass
 
 
 class Shape:
 
+    # Bumped whenever the transform, color or hierarchy of any shape changes, so renderers
+    # can tell that nothing needs to be uploaded again for a static scene
+    revision = 0
+
+    # Bumped whenever shapes are added to or removed from a hierarchy or transform store
+    structure_revision = 0
+
+    # The sets handed out by watch_changes(), for as long as they are referenced
+    _change_sets = weakref.WeakValueDictionary()
+
+    @staticmethod
+    def watch_changes():
+        """ A set collecting every shape whose world matrix or tint changes from now on.
+
+        The holder clears it once it handled the changes, so a renderer only has to
+        look at the shapes in it instead of all of its shapes.
+        """
+        changes = _ChangeSet()
+        Shape._change_sets[id(changes)] = changes
+        return changes
+
+    def _record_change(self):
+        for changes in Shape._change_sets.values():
+            changes.add(self)
+
     def __init__(self):
-        self.color = Color(0.0, 0.0, 0.0)
-        self.aabb = aabb.create_from_bounds([0.0, 0.0, 0.0], [0.5, 0.5, 0.5])
-        self.translation_matrix = Matrix44.identity()
-        self.scale_matrix = Matrix44.identity()
-        self.rotation_matrix = Matrix44.identity()
+        # Tint mixed over the vertex colors by its alpha; fully transparent leaves them untouched
+        self._color = Color(0.0, 0.0, 0.0, 0.0)
+        self._color.on_change = self._color_changed
+        self._translation_matrix = Matrix44.identity()
+        self._scale_matrix = Matrix44.identity()
+        self._rotation_matrix = Matrix44.identity()
         self.selected = False
 
-    def render(self):
-        self.render_self()
-
+        # Local and world matrices are cached and only rebuilt after this shape or an ancestor changes
+        self.parent = None
+        self._local_matrix = Matrix44.identity()
+        self._world_matrix = Matrix44.identity()
+        self._local_dirty = False
+        self._world_dirty = False
+
+        # Optional scene-level TransformStore that mirrors this shape's transform
+        self.transform_store = None
+        self.transform_slot = -1
+
+        # How many times the shape is in a scene, directly or through a hierarchy. GPU resources are
+        # held while it is more than 0.
+        self.acquired = 0
+
+    @property
+    def color(self):
+        return self._color
+
+    @color.setter
+    def color(self, color):
+        # A copy of its own, which tells the shape when its channels are set. Editing a color
+        # that was given to several shapes does not change them.
+        self._color = Color(color[0], color[1], color[2], color[3])
+        self._color.on_change = self._color_changed
+        self._color_changed()
+
+    def _color_changed(self):
+        if self.transform_store is not None:
+            self.transform_store.set_tint(self.transform_slot, self._tint())
+        self._record_change()
+        Shape.revision += 1
+
+    @property
+    def translation_matrix(self):
+        return self._translation_matrix
+
+    @translation_matrix.setter
+    def translation_matrix(self, matrix):
+        self._translation_matrix = matrix
+        if self.transform_store is not None:
+            self.transform_store.set_translation(self.transform_slot, matrix[3, :3])
+        self._mark_local_dirty()
+
+    @property
+    def rotation_matrix(self):
+        return self._rotation_matrix
+
+    @rotation_matrix.setter
+    def rotation_matrix(self, matrix):
+        self._rotation_matrix = matrix
+        if self.transform_store is not None:
+            self.transform_store.set_rotation_matrix(self.transform_slot, matrix)
+        self._mark_local_dirty()
+
+    @property
+    def scale_matrix(self):
+        return self._scale_matrix
+
+    @scale_matrix.setter
+    def scale_matrix(self, matrix):
+        self._scale_matrix = matrix
+        if self.transform_store is not None:
+            self.transform_store.set_scale(self.transform_slot, matrix.diagonal()[:3])
+        self._mark_local_dirty()
+
+    @property
+    def aabb(self):
+        """ World space bounding box, None for a shape without geometry. """
+        boxes = [child.aabb for child in self.children()]
+        boxes = [box for box in boxes if box is not None]
+
+        if not boxes:
+            return None
+
+        return aabb.create_from_aabbs(numpy.array(boxes))
+
+    def _tint(self):
+        return self._color[0], self._color[1], self._color[2], self._color[3]
+
+    def bind_transform_store(self, store):
+        if self.transform_store is not None:
+            self.unbind_transform_store()
+
+        parent_slot = -1
+        if self.parent is not None and self.parent.transform_store is store:
+            parent_slot = self.parent.transform_slot
+
+        self.transform_store = store
+        self.transform_slot = store.allocate(parent_slot)
+
+        store.set_translation(self.transform_slot, self._translation_matrix[3, :3])
+        store.set_rotation_matrix(self.transform_slot, self._rotation_matrix)
+        store.set_scale(self.transform_slot, self._scale_matrix.diagonal()[:3])
+        store.set_tint(self.transform_slot, self._tint())
+
+        for child in self.children():
+            child.bind_transform_store(store)
+
+        Shape.revision += 1
+        Shape.structure_revision += 1
+
+    def unbind_transform_store(self):
+        if self.transform_store is None:
+            return
+
+        for child in self.children():
+            child.unbind_transform_store()
+
+        self.transform_store.free(self.transform_slot)
+        self.transform_store = None
+        self.transform_slot = -1
+
+        Shape.revision += 1
+        Shape.structure_revision += 1
+
+    # The Matrix44 objects (rather than the plain arrays of the matrix44 module) are used
+    # throughout, as only they multiply as matrices instead of element-wise.
     def translate(self, x, y, z):
-        self.translation_matrix = matrix44.create_from_translation(Vector3([x, y, z]))
+        self.translation_matrix = Matrix44.from_translation(Vector3([x, y, z]))
 
     def rotate(self, xrot, yrot, zrot):
-        xrot_mat = matrix44.create_from_x_rotation(radians(xrot))
-        yrot_mat = matrix44.create_from_y_rotation(radians(yrot))
-        zrot_mat = matrix44.create_from_z_rotation(radians(zrot))
+        xrot_mat = Matrix44.from_x_rotation(radians(xrot))
+        yrot_mat = Matrix44.from_y_rotation(radians(yrot))
+        zrot_mat = Matrix44.from_z_rotation(radians(zrot))
         self.rotation_matrix = xrot_mat * yrot_mat * zrot_mat
 
     def scale(self, scale):
         if type(scale) == Matrix44:
             self.scale_matrix = scale
         else:
-            self.scale_matrix = matrix44.create_from_scale(Vector3(scale))
+            self.scale_matrix = Matrix44.from_scale(Vector3(scale))
 
-    # Scale first, rotate, then translate
-    # TODO CHECK AND MAKE SURE THIS MULTIPLICATION FOLLOWS THE ORDER ABOVE
-    def model_matrix(self):
-        return self.scale_matrix * self.rotation_matrix * self.translation_matrix
+    def _mark_local_dirty(self):
+        self._local_dirty = True
+        self._mark_world_dirty()
 
-    def render_self(self):
-        raise NotImplementedError("Abstract Shape Class does not implement 'render_self'")
+    def _mark_world_dirty(self):
+        self._record_change()
+        Shape.revision += 1
 
+        # A dirty shape always has dirty descendants, so there is nothing further down to mark
+        if self._world_dirty:
+            return
 
-class PrimitiveShape(Shape):
+        self._world_dirty = True
+        for child in self.children():
+            child._mark_world_dirty()
 
-    def __init__(self, vertices, indices):
-        super().__init__()
+    def children(self):
+        return ()
 
-        self.vertices = numpy.array(vertices, numpy.float32)
-        self.indices = numpy.array(indices, numpy.int32)
-        self.vao = self._create_vao(self.vertices, self.indices, GL_DYNAMIC_DRAW)
+    # Scale first, rotate, then translate. Pyrr multiplies like OpenGL, so the
+    # right-most matrix is the first one applied to a vertex.
+    def model_matrix(self):
+        if self._local_dirty:
+            self._local_matrix = self._translation_matrix * self._rotation_matrix * self._scale_matrix
+            self._local_dirty = False
+        return self._local_matrix
 
-    def render_self(self):
-        glBindVertexArray(self.vao)
-        ebo_offset = ctypes.c_void_p(0)
-        glDrawElements(GL_TRIANGLES, len(self.indices), GL_UNSIGNED_INT, ebo_offset)
-        glBindVertexArray(0)
+    def world_matrix(self):
+        if self._world_dirty:
+            if self.parent is None:
+                self._world_matrix = self.model_matrix()
+            else:
+                self._world_matrix = self.parent.world_matrix() * self.model_matrix()
+            self._world_dirty = False
+        return self._world_matrix
 
-    @staticmethod
-    def _create_vao(vertices, indices, draw_style):
-        if vertices is None or indices is None or draw_style is None:
-            raise ValueError("Shape's vertices, indices, and change rate cannot be None")
+    def acquire(self):
+        self.acquired += 1
 
-        if draw_style not in _DRAW_STYLES:
-            raise ValueError('Draw style invalid')
+    def release(self):
+        self.acquired = max(self.acquired - 1, 0)
 
-        vao = glGenVertexArrays(1)  # Vertex array object - stores the vbo and ebo and will bind them automatically
-        vbo = glGenBuffers(1)  # Vertex buffer object - stores vertices
-        ebo = glGenBuffers(1)  # Element buffer object - stores the indices to the vertices to render
+    def collect_instances(self, instances):
+        raise NotImplementedError("Abstract Shape Class does not implement 'collect_instances'")
 
-        glBindVertexArray(vao)
 
-        glBindBuffer(GL_ARRAY_BUFFER, vbo)
-        glBufferData(GL_ARRAY_BUFFER, len(vertices) * sizeof(ctypes.c_float), vertices, draw_style)
+class PrimitiveShape(Shape):
 
-        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, ebo)
-        glBufferData(GL_ELEMENT_ARRAY_BUFFER, len(indices) * sizeof(ctypes.c_int32), indices, draw_style)
+    def __init__(self, vertices, indices, geometry_key=None, layout=None, lods=None):
+        """ Vertices are interleaved x, y, z, r, g, b floats. Without a layout, big meshes are stored compact.
 
-        vert_attr_idx = 0
-        vert_size = 3  # x, y, z
-        vert_data_type = GL_FLOAT
-        vert_normalize = GL_FALSE
-        stride = 6 * sizeof(ctypes.c_float)  # x, y, z, r, g, b
-        pos_data_start = ctypes.c_void_p(0)
+        lods are simplified (vertices, indices) levels of detail, coarsest last, as build_lods makes them.
+        The GPU mesh is only acquired once the shape is in a scene, directly or through a hierarchy,
+        and released when it leaves the last one, so a shape that is never added holds no GPU buffers.
+        """
+        super().__init__()
 
-        glVertexAttribPointer(vert_attr_idx, vert_size, vert_data_type, vert_normalize, stride, pos_data_start)
-        glEnableVertexAttribArray(vert_attr_idx)
+        # Arrays already in the right type, such as imported meshes, are used without a copy
+        self.vertices = numpy.ascontiguousarray(vertices, numpy.float32).ravel()
+        self.indices = numpy.ascontiguousarray(indices, numpy.int32).ravel()
+        self.layout = layout if layout is not None else choose_layout(len(self.vertices) // 6)
+        self.mesh = None
+        self.editable = False
+        self.lods = lods
+        self._geometry_key = geometry_key
+
+    @property
+    def vao(self):
+        return self.mesh.vao
+
+    @property
+    def geometry_key(self):
+        return self.mesh.key
+
+    @property
+    def aabb(self):
+        if self.mesh is None:
+            return None
+
+        return transform_aabbs(self.mesh.bounds[None], numpy.asarray(self.world_matrix())[None])[0]
+
+    def acquire(self):
+        super().acquire()
+        if self.mesh is not None:
+            return
+
+        if self.editable:
+            self.mesh = mesh_registry.acquire_unique(self.vertices, self.indices, layout=self.layout)
+        else:
+            self.mesh = mesh_registry.acquire(self.vertices, self.indices, GL_STATIC_DRAW, self.layout,
+                                              self._geometry_key, self.lods)
 
-        # TODO ATTRIBUTE ENGINE?
+    def release(self):
+        super().release()
+        if self.acquired > 0:
+            return
 
-        color_attr_idx = 1
-        color_size = 3  # r, g, b
-        color_data_type = GL_FLOAT
-        color_normalize = GL_FALSE
-        stride = 6 * sizeof(ctypes.c_float)  # x, y, z, r, g, b
-        color_data_start = ctypes.c_void_p(3 * sizeof(ctypes.c_float))
+        if self.mesh is not None and self.editable:
+            # The edited geometry lives in the mesh, keep it for when the shape is added again
+            self.vertices = self.mesh.vertices
+            self.indices = self.mesh.indices
 
-        glVertexAttribPointer(color_attr_idx, color_size, color_data_type, color_normalize, stride, color_data_start)
-        glEnableVertexAttribArray(color_attr_idx)
+        mesh_registry.release(self.mesh)
+        self.mesh = None
 
-        '''tex_attr_idx = 2
-        tex_size = 2  # s, t
-        tex_data_type = GL_FLOAT
-        tex_normalize = GL_FALSE
-        stride = 8 * sizeof(ctypes.c_float)  # x, y, z, r, g, b, s, t
-        tex_data_start = ctypes.c_void_p(6 * sizeof(ctypes.c_float))
+    def make_editable(self):
+        """ Move the shape onto a mesh of its own, so edits do not show on shapes sharing its geometry. """
+        if self.editable:
+            return
 
-        glVertexAttribPointer(tex_attr_idx, tex_size, tex_data_type, tex_normalize, stride, tex_data_start)
-        glEnableVertexAttribArray(tex_attr_idx)'''
+        self.editable = True
 
-        # Unbind all buffers
-        glBindVertexArray(0)
+        if self.mesh is None:
+            # Edits go into the arrays until the shape is added, they may be shared or mapped read-only
+            self.vertices = self.vertices.copy()
+            self.indices = self.indices.copy()
+        else:
+            mesh = mesh_registry.acquire_unique(self.mesh.vertices.copy(), self.mesh.indices.copy(),
+                                                layout=self.layout)
+            mesh_registry.release(self.mesh)
+            self.mesh = mesh
+
+            # Instances are grouped by mesh
+            Shape.structure_revision += 1
+
+    def update_vertices(self, first, vertices):
+        """ Overwrite interleaved x, y, z, r, g, b vertices from vertex index first on. """
+        self.make_editable()
+        if self.mesh is None:
+            self._overwrite(self.vertices, first * 6, numpy.asarray(vertices, numpy.float32).ravel())
+            return
+
+        self.mesh.update_vertices(first, vertices)
+        mesh_registry.mark_dirty(self.mesh)
+
+    def update_indices(self, first, indices):
+        self.make_editable()
+        if self.mesh is None:
+            self._overwrite(self.indices, first, numpy.asarray(indices, numpy.int32).ravel())
+            return
+
+        self.mesh.update_indices(first, indices)
+        mesh_registry.mark_dirty(self.mesh)
+
+    def set_geometry(self, vertices=None, indices=None):
+        """ Replace the vertices, the indices or both, which may change their count. """
+        self.make_editable()
+        if self.mesh is None:
+            if vertices is not None:
+                self.vertices = numpy.array(vertices, numpy.float32).ravel()
+            if indices is not None:
+                self.indices = numpy.array(indices, numpy.int32).ravel()
+            return
+
+        self.mesh.set_geometry(vertices, indices)
+        mesh_registry.mark_dirty(self.mesh)
 
-        gl_error_check()
+    @staticmethod
+    def _overwrite(array, first, values):
+        if first < 0 or first + len(values) > len(array):
+            raise ValueError('Update goes past the end of the geometry')
+        array[first:first + len(values)] = values
 
-        return vao
+    def collect_instances(self, instances):
+        instances.setdefault(self.mesh, []).append(self)
 
 
 class HierarchicalShape(Shape):
@@ -128,14 +359,57 @@ class HierarchicalShape(Shape):
         super().__init__()
         self.child_shapes = []
 
-    def render_self(self):
+    # Children are acquired as often as the hierarchy, also when added to it later
+    def acquire(self):
+        super().acquire()
+        for child in self.child_shapes:
+            child.acquire()
+
+    def release(self):
+        if self.acquired == 0:
+            return
+
+        super().release()
+        for child in self.child_shapes:
+            child.release()
+
+    def children(self):
+        return self.child_shapes
+
+    def collect_instances(self, instances):
         for child in self.child_shapes:
-            child.render()
+            child.collect_instances(instances)
 
     def add_child(self, child):
         if child:
-            self.child_shapes.append(child)
+            self._attach(child)
+            Shape.structure_revision += 1
+
+    def add_children(self, children):
+        """ Add several children in one structural change. """
+        children = [child for child in children if child]
+        for child in children:
+            self._attach(child)
+        if children:
+            Shape.structure_revision += 1
+
+    def _attach(self, child):
+        if child.parent is not None:
+            child.parent.remove_child(child)
+        self.child_shapes.append(child)
+        child.parent = self
+        child._mark_world_dirty()
+        for _ in range(self.acquired):
+            child.acquire()
+        if self.transform_store is not None:
+            child.bind_transform_store(self.transform_store)
 
     def remove_child(self, child):
         if child:
             self.child_shapes.remove(child)
+            child.parent = None
+            child._mark_world_dirty()
+            Shape.structure_revision += 1
+            for _ in range(self.acquired):
+                child.release()
+            child.unbind_transform_store()
@@ -0,0 +1,129 @@
+import collections
+
+from OpenGL.GL import *
+
+
+class GLState:
+    """ Shadow copy of the GL bindings the renderer changes, to skip calls that would change nothing.
+
+    Every call PyOpenGL makes costs microseconds, so binding the program or
+    vertex array that is already bound, or uploading a uniform value the
+    program already has, is worth avoiding. Code that changes these bindings
+    without going through here has to call invalidate() afterwards. Deleted
+    objects have to be forgotten, GL reuses their names.
+
+    issued and skipped count the calls by GL function name.
+    """
+
+    def __init__(self):
+        self.program = None
+        self.vertex_array = None
+        self.active_texture = None
+        self._buffers = {}
+        self._textures = {}
+        self._uniforms = {}
+
+        self.issued = collections.Counter()
+        self.skipped = collections.Counter()
+
+    def use_program(self, program):
+        if program == self.program:
+            self.skipped['glUseProgram'] += 1
+            return
+
+        glUseProgram(program)
+        self.program = program
+        self.issued['glUseProgram'] += 1
+
+    def bind_vertex_array(self, vertex_array):
+        if vertex_array == self.vertex_array:
+            self.skipped['glBindVertexArray'] += 1
+            return
+
+        glBindVertexArray(vertex_array)
+        self.vertex_array = vertex_array
+        self.issued['glBindVertexArray'] += 1
+
+    def bind_buffer(self, target, buffer):
+        """ Bind a buffer to a target that is not vertex array state, such as GL_DRAW_INDIRECT_BUFFER. """
+        if self._buffers.get(target) == buffer:
+            self.skipped['glBindBuffer'] += 1
+            return
+
+        glBindBuffer(target, buffer)
+        self._buffers[target] = buffer
+        self.issued['glBindBuffer'] += 1
+
+    def bind_texture(self, unit, texture, target=GL_TEXTURE_2D):
+        """ Bind a texture to texture unit GL_TEXTURE0 + unit. """
+        if self._textures.get((unit, target)) == texture:
+            self.skipped['glBindTexture'] += 1
+            return
+
+        if unit != self.active_texture:
+            glActiveTexture(GL_TEXTURE0 + unit)
+            self.active_texture = unit
+            self.issued['glActiveTexture'] += 1
+
+        glBindTexture(target, texture)
+        self._textures[(unit, target)] = texture
+        self.issued['glBindTexture'] += 1
+
+    def uniform_changed(self, program, location, value):
+        """ Whether value, anything comparable such as a tuple or bytes, differs from the last one set. Counts the
+        call as issued or skipped. """
+        key = (program, location)
+        if self._uniforms.get(key) == value:
+            self.skipped['glUniform'] += 1
+            return False
+
+        self._uniforms[key] = value
+        self.issued['glUniform'] += 1
+        return True
+
+    def count(self, function, issued=True):
+        """ Count a call made elsewhere, such as a uniform block upload. """
+        (self.issued if issued else self.skipped)[function] += 1
+
+    def forget_program(self, program):
+        if self.program == program:
+            self.program = None
+        self._uniforms = {key: value for key, value in self._uniforms.items() if key[0] != program}
+
+    def forget_vertex_array(self, vertex_array):
+        # Deleting the bound vertex array binds 0
+        if self.vertex_array == vertex_array:
+            self.vertex_array = 0
+
+    def forget_buffer(self, buffer):
+        for target, bound in list(self._buffers.items()):
+            if bound == buffer:
+                self._buffers[target] = 0
+
+    def forget_texture(self, texture):
+        # Deleting a bound texture binds 0 on every unit it was bound to
+        for key, bound in list(self._textures.items()):
+            if bound == texture:
+                self._textures[key] = 0
+
+    def invalidate(self):
+        """ Forget every binding, for after GL calls made around the cache or a context change. """
+        self.program = None
+        self.vertex_array = None
+        self.active_texture = None
+        self._buffers.clear()
+        self._textures.clear()
+        self._uniforms.clear()
+
+    def reset_counters(self):
+        self.issued.clear()
+        self.skipped.clear()
+
+    def report(self):
+        functions = sorted(set(self.issued) | set(self.skipped))
+        lines = [f'{"gl call":18} {"issued":>10} {"skipped":>10}']
+        lines += [f'{name:18} {self.issued[name]:>10} {self.skipped[name]:>10}' for name in functions]
+        return '\n'.join(lines)
+
+
+gl_state = GLState()
@@ -0,0 +1,494 @@
+import collections
+import ctypes
+import hashlib
+import io
+import queue
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+from OpenGL.GL import *
+
+from modelplane.gfx.state import gl_state
+from modelplane.gfx.util.error import gl_error_check
+
+QUEUED = 'queued'
+DECODING = 'decoding'
+UPLOADING = 'uploading'
+DONE = 'done'
+CANCELLED = 'cancelled'
+FAILED = 'failed'
+
+_DEFAULT_WORKERS = 2
+_DEFAULT_UPLOAD_BUDGET = 0.002  # Seconds of each frame that may be spent uploading textures
+_DEFAULT_VRAM_BUDGET = 256 * 1024 * 1024  # Bytes of texture memory kept before the least recently drawn go
+_UPLOAD_CHUNK = 256 * 1024  # Bytes of rows staged through the pixel buffer per glTexSubImage2D
+_UPLOAD_UNIT = 0
+
+
+def build_mipmaps(pixels):
+    """ A height x width x 4 uint8 image and its smaller levels down to 1 x 1, each averaged from the one above.
+
+    Sizes halve rounding down as GL expects, an odd last row or column is dropped.
+    """
+    levels = [numpy.ascontiguousarray(pixels, numpy.uint8)]
+
+    while levels[-1].shape[0] > 1 or levels[-1].shape[1] > 1:
+        levels.append(_downsample(levels[-1]))
+
+    return levels
+
+
+def _downsample(pixels):
+    height, width = pixels.shape[:2]
+    pixels = pixels.astype(numpy.uint16)
+
+    if height > 1:
+        pixels = pixels[0:height // 2 * 2:2] + pixels[1:height // 2 * 2:2]
+    else:
+        pixels = pixels * 2
+
+    if width > 1:
+        pixels = pixels[:, 0:width // 2 * 2:2] + pixels[:, 1:width // 2 * 2:2]
+    else:
+        pixels = pixels * 2
+
+    return ((pixels + 2) // 4).astype(numpy.uint8)
+
+
+def decode_texture(data):
+    """ Decode image file contents with Pillow into RGBA8 mip levels, bottom row first as GL expects. """
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as image:
+        pixels = numpy.asarray(image.convert('RGBA'), numpy.uint8)
+
+    return build_mipmaps(pixels[::-1])
+
+
+class Texture:
+    """ A mip-mapped RGBA8 texture, identified by a hash of the image file it came from.
+
+    Levels go up from the smallest, and the texture can be sampled as soon as
+    the first one is in, sharpening as the larger levels follow. An evicted
+    texture keeps its key and path, drawing it again loads it back.
+    """
+
+    def __init__(self, key, path):
+        self.key = key
+        self.path = path
+        self.name = 0
+        self.width = 0
+        self.height = 0
+        self.byte_size = 0
+        self.uploaded_bytes = 0
+        self.base_level = None  # Largest level uploaded so far
+        self.last_drawn = -1  # Frame of the last bind
+        self.pending = False  # Being decoded or uploaded
+        self.error = None  # Why the last decode or upload failed
+
+        self._mipmaps = None
+        self._level = 0
+        self._row = 0
+
+    @property
+    def resident(self):
+        return self.name != 0
+
+    def ready(self):
+        """ Whether there is at least one level to sample. """
+        return self.base_level is not None
+
+
+class TextureJob:
+    """ Progress of one texture load, from decoding on a worker to uploading on the render thread. """
+
+    def __init__(self, path, texture=None):
+        self.path = path
+        self.state = QUEUED
+        self.error = None
+        self.texture = texture
+        self.future = None
+
+        self._owner = texture is not None  # Whether this job decodes the texture, rather than sharing it
+        self._cancelled = threading.Event()
+        self._finished = threading.Event()
+
+    @property
+    def progress(self):
+        """ 0.0 to 1.0, the first half for decoding and the second for uploading. """
+        if self.state in [QUEUED, DECODING]:
+            return 0.0
+        if self.state == DONE:
+            return 1.0
+        if not self.texture.byte_size:
+            return 0.5
+        return 0.5 + 0.5 * self.texture.uploaded_bytes / self.texture.byte_size
+
+    def done(self):
+        return self.state in [DONE, CANCELLED, FAILED]
+
+    def cancel(self):
+        """ Stop the job before its texture is decoded. A decoded texture still goes up, others may share it. """
+        if self.done():
+            return
+
+        self._cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def wait(self, timeout=None):
+        """ Wait until decoding finished. Uploading still happens on the render thread. """
+        return self._finished.wait(timeout)
+
+
+class TextureCache:
+    """ Loads textures on a worker pool and keeps them on the GPU within a memory budget.
+
+    Image files are hashed, decoded and mip-mapped on the workers, so a file
+    with the same contents as one loaded before shares its texture and is not
+    decoded again. Call process_uploads() once per frame from the thread owning
+    the GL context: it streams decoded levels through a pixel buffer object in
+    chunks until the frame's time budget is used up, then evicts the least
+    recently drawn textures while more than vram_budget bytes are resident.
+    Textures drawn in the current or the last frame, and those still uploading,
+    are never evicted, so the budget can be overrun when they alone exceed it.
+
+    Draw with bind(), which also marks the texture as used. on_decoded is called
+    from the worker thread whenever a texture finished decoding.
+    """
+
+    def __init__(self, workers=_DEFAULT_WORKERS, upload_budget=_DEFAULT_UPLOAD_BUDGET, vram_budget=_DEFAULT_VRAM_BUDGET,
+                 executor=None, on_decoded=None):
+        if upload_budget is None or upload_budget < 0:
+            raise ValueError('Upload budget must be 0 or more seconds')
+
+        if vram_budget is None or vram_budget <= 0:
+            raise ValueError('Texture memory budget must be more than 0 bytes')
+
+        self.upload_budget = upload_budget
+        self.vram_budget = vram_budget
+        self.on_decoded = on_decoded
+        self.jobs = []
+        self.frame = 0
+
+        self.resident_bytes = 0
+        self.uploaded_bytes = 0
+        self.hits = 0
+        self.evictions = 0
+
+        self._executor = executor if executor is not None else ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self._textures = {}  # Every texture seen, by content hash, resident or not
+        self._resident = collections.OrderedDict()  # Textures on the GPU, least recently drawn first
+        self._decoded = queue.Queue()
+        self._uploading = []
+        self._pixel_buffer = None
+        self._pixel_buffer_size = 0
+
+    def load(self, path):
+        """ Start loading an image file. Returns the TextureJob, whose texture is set once the file is hashed. """
+        if path is None:
+            raise ValueError('Texture path cannot be None')
+
+        return self._submit(TextureJob(path))
+
+    def _submit(self, job):
+        job.state = DECODING
+        job.future = self._executor.submit(self._decode, job)
+        job.future.add_done_callback(lambda future: self._decode_done(job, future))
+        self.jobs.append(job)
+
+        return job
+
+    def _decode(self, job):
+        # Runs on a worker thread
+        if job.cancelled():
+            return None
+
+        with open(job.path, 'rb') as f:
+            data = f.read()
+
+        key = hashlib.sha1(data).hexdigest()
+
+        with self._lock:
+            if job.texture is not None:
+                # Loading an evicted texture back, the file has to still hold the same image
+                if job.texture.key != key:
+                    raise ValueError(f"'{job.path}' changed since it was first loaded")
+            else:
+                job.texture = self._textures.get(key)
+                if job.texture is None:
+                    job.texture = self._textures[key] = Texture(key, job.path)
+                elif job.texture.pending or job.texture.resident:
+                    self.hits += 1
+                    return None
+
+                job.texture.pending = True
+                job._owner = True
+
+        return decode_texture(data)
+
+    def _decode_done(self, job, future):
+        # Runs on the worker thread, the render thread picks the job up in process_uploads
+        if future.cancelled() or job.cancelled():
+            job.state = CANCELLED
+        elif future.exception() is not None:
+            job.error = future.exception()
+            job.state = FAILED
+        else:
+            job.state = UPLOADING
+            self._decoded.put((job, future.result()))
+
+        # A texture that is not going to be uploaded can be loaded by the next job asking for it
+        if job._owner and job.state != UPLOADING:
+            with self._lock:
+                job.texture.error = job.error
+                job.texture.pending = False
+
+        job._finished.set()
+
+        if self.on_decoded is not None:
+            self.on_decoded()
+
+    def pending(self):
+        return any(not job.done() for job in self.jobs)
+
+    def uploading(self):
+        """ Whether decoded textures are waiting for process_uploads(). """
+        return bool(self._uploading) or not self._decoded.empty()
+
+    def bind(self, texture, unit=0):
+        """ Bind a texture for drawing and mark it as recently drawn. Returns False while it has nothing to sample.
+
+        An evicted texture starts loading again.
+        """
+        if texture.ready():
+            texture.last_drawn = self.frame
+            self._resident.move_to_end(texture.key)
+            gl_state.bind_texture(unit, texture.name)
+            return True
+
+        with self._lock:
+            reload = not texture.pending
+            if reload:
+                texture.pending = True
+
+        if reload:
+            self._submit(TextureJob(texture.path, texture))
+
+        return False
+
+    def process_uploads(self, budget=None):
+        """ Upload decoded textures for at most budget seconds, then evict down to the memory budget.
+
+        Call it before drawing, it starts the next frame for the least recently drawn order. Textures drawn in
+        the frame before are kept, as they are likely to be drawn again. Returns the number of chunks uploaded.
+        """
+        if budget is None:
+            budget = self.upload_budget
+
+        self.frame += 1
+
+        while not self._decoded.empty():
+            job, mipmaps = self._decoded.get_nowait()
+            if mipmaps is not None:
+                self._start_upload(job.texture, mipmaps)
+
+        start = time.perf_counter()
+        uploaded = 0
+
+        # At least one chunk goes up every frame, so loads always make progress
+        while self._uploading and (uploaded == 0 or time.perf_counter() - start < budget):
+            texture = self._uploading[0]
+            try:
+                complete = self._upload_chunk(texture)
+            except GLError as error:
+                self._upload_failed(texture, error)
+                complete = True
+
+            if complete:
+                self._uploading.pop(0)
+            uploaded += 1
+
+        if uploaded:
+            # Texture calls elsewhere would read their pixels from the bound buffer
+            gl_state.bind_buffer(GL_PIXEL_UNPACK_BUFFER, 0)
+            gl_error_check()
+
+        self.trim()
+
+        for job in self.jobs:
+            # Done once uploaded, even if the texture was evicted since
+            if job.state == UPLOADING and not job.texture.pending:
+                job.error = job.texture.error
+                job.state = DONE if job.error is None else FAILED
+
+        self.jobs = [job for job in self.jobs if not job.done()]
+
+        return uploaded
+
+    def _start_upload(self, texture, mipmaps):
+        texture.height, texture.width = mipmaps[0].shape[:2]
+        texture.byte_size = sum(level.nbytes for level in mipmaps)
+        texture.uploaded_bytes = 0
+        texture.error = None
+        texture._mipmaps = mipmaps
+        texture._level = len(mipmaps) - 1
+        texture._row = 0
+        self._uploading.append(texture)
+
+    def _upload_chunk(self, texture):
+        """ Upload the next rows of a texture. Returns whether it is complete. """
+        if not texture.resident:
+            self._allocate(texture)
+
+        level = texture._level
+        pixels = texture._mipmaps[level]
+        height, width = pixels.shape[:2]
+
+        rows = min(height - texture._row, max(1, _UPLOAD_CHUNK // (width * 4)))
+        self._stage(pixels[texture._row:texture._row + rows])
+
+        gl_state.bind_texture(_UPLOAD_UNIT, texture.name)
+        glTexSubImage2D(GL_TEXTURE_2D, level, 0, texture._row, width, rows, GL_RGBA, GL_UNSIGNED_BYTE,
+                        ctypes.c_void_p(0))
+
+        texture._row += rows
+        texture.uploaded_bytes += rows * width * 4
+        self.uploaded_bytes += rows * width * 4
+
+        if texture._row < height:
+            return False
+
+        # The finished level and the smaller ones below it can be sampled now
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_BASE_LEVEL, level)
+        texture.base_level = level
+        texture._level -= 1
+        texture._row = 0
+
+        if texture._level >= 0:
+            return False
+
+        texture._mipmaps = None
+        with self._lock:
+            texture.pending = False
+
+        return True
+
+    def _upload_failed(self, texture, error):
+        if texture.resident:
+            self._evict(texture)
+
+        texture._mipmaps = None
+        with self._lock:
+            texture.error = error
+            texture.pending = False
+
+    def _stage(self, pixels):
+        """ Copy pixels into the pixel buffer, orphaning it so the copy never waits on the last upload. """
+        if self._pixel_buffer is None:
+            self._pixel_buffer = glGenBuffers(1)
+
+        gl_state.bind_buffer(GL_PIXEL_UNPACK_BUFFER, self._pixel_buffer)
+
+        size = pixels.nbytes
+        if size > self._pixel_buffer_size:
+            self._pixel_buffer_size = max(size, _UPLOAD_CHUNK)
+            glBufferData(GL_PIXEL_UNPACK_BUFFER, self._pixel_buffer_size, None, GL_STREAM_DRAW)
+
+        pointer = glMapBufferRange(GL_PIXEL_UNPACK_BUFFER, 0, size, GL_MAP_WRITE_BIT | GL_MAP_INVALIDATE_BUFFER_BIT)
+        ctypes.memmove(pointer, pixels.ctypes.data, size)
+        glUnmapBuffer(GL_PIXEL_UNPACK_BUFFER)
+
+    def _allocate(self, texture):
+        self._make_room(texture.byte_size)
+
+        # Without pixels glTexImage2D would read from the bound pixel buffer instead of leaving the level empty
+        gl_state.bind_buffer(GL_PIXEL_UNPACK_BUFFER, 0)
+
+        texture.name = glGenTextures(1)
+        gl_state.bind_texture(_UPLOAD_UNIT, texture.name)
+
+        for level, pixels in enumerate(texture._mipmaps):
+            height, width = pixels.shape[:2]
+            glTexImage2D(GL_TEXTURE_2D, level, GL_RGBA8, width, height, 0, GL_RGBA, GL_UNSIGNED_BYTE, None)
+
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAX_LEVEL, len(texture._mipmaps) - 1)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_BASE_LEVEL, len(texture._mipmaps) - 1)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR_MIPMAP_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_REPEAT)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_REPEAT)
+
+        # Counts as drawn now, so it is not evicted before it had a frame to be drawn in
+        texture.last_drawn = self.frame
+        self._resident[texture.key] = texture
+        self.resident_bytes += texture.byte_size
+
+    def trim(self):
+        """ Evict the least recently drawn textures until the resident ones fit in vram_budget. """
+        self._make_room(0)
+
+    def _make_room(self, size):
+        for texture in list(self._resident.values()):
+            if self.resident_bytes + size <= self.vram_budget:
+                break
+
+            # Ordered by the frame they were last drawn in, the rest were drawn as recently
+            if texture.last_drawn >= self.frame - 1:
+                break
+
+            if not texture.pending:
+                self._evict(texture)
+
+    def _evict(self, texture):
+        glDeleteTextures(1, [texture.name])
+        gl_state.forget_texture(texture.name)
+
+        del self._resident[texture.key]
+        self.resident_bytes -= texture.byte_size
+        self.evictions += 1
+
+        texture.name = 0
+        texture.base_level = None
+        texture.uploaded_bytes = 0
+
+    def __contains__(self, key):
+        return key in self._resident
+
+    def __len__(self):
+        return len(self._resident)
+
+    def report(self):
+        mb = 1024 * 1024
+        return '\n'.join([f'{"textures":18} {len(self._resident):>10}',
+                          f'{"resident MB":18} {self.resident_bytes / mb:>10.1f}',
+                          f'{"budget MB":18} {self.vram_budget / mb:>10.1f}',
+                          f'{"uploaded MB":18} {self.uploaded_bytes / mb:>10.1f}',
+                          f'{"shared loads":18} {self.hits:>10}',
+                          f'{"evictions":18} {self.evictions:>10}'])
+
+    def shutdown(self):
+        for job in self.jobs:
+            job.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def delete(self):
+        """ Delete every texture and the pixel buffer, while the context is still current. """
+        for texture in list(self._resident.values()):
+            self._evict(texture)
+
+        self._uploading.clear()
+
+        if self._pixel_buffer is not None:
+            glDeleteBuffers(1, [self._pixel_buffer])
+            gl_state.forget_buffer(self._pixel_buffer)
+            self._pixel_buffer = None
+            self._pixel_buffer_size = 0
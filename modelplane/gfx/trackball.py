@@ -32,111 +32,73 @@ phi relates to the rotation angle around Z axis.
 __docformat__ = 'restructuredtext'
 __version__ = '1.0'
 
+import argparse
 import math
-import OpenGL.GL as gl
-from OpenGL.GL import GLfloat
-
-
-# Some useful functions on vectors
-# -----------------------------------------------------------------------------
-def _v_add(v1, v2):
-    return [v1[0] + v2[0], v1[1] + v2[1], v1[2] + v2[2]]
-
-
-def _v_sub(v1, v2):
-    return [v1[0] - v2[0], v1[1] - v2[1], v1[2] - v2[2]]
-
-
-def _v_mul(v, s):
-    return [v[0] * s, v[1] * s, v[2] * s]
-
-
-def _v_dot(v1, v2):
-    return v1[0] * v2[0] + v1[1] * v2[1] + v1[2] * v2[2]
-
-
-def _v_cross(v1, v2):
-    return [(v1[1] * v2[2]) - (v1[2] * v2[1]),
-            (v1[2] * v2[0]) - (v1[0] * v2[2]),
-            (v1[0] * v2[1]) - (v1[1] * v2[0])]
-
-
-def _v_length(v):
-    return math.sqrt(_v_dot(v, v))
+import sys
+import timeit
 
+import numpy
+import OpenGL.GL as gl
 
-def _v_normalize(v):
-    try:
-        return _v_mul(v, 1.0 / _v_length(v))
-    except ZeroDivisionError:
-        return v
-
-
-# Some useful functions on quaternions
-# -----------------------------------------------------------------------------
-def _q_add(q1, q2):
-    t1 = _v_mul(q1, q2[3])
-    t2 = _v_mul(q2, q1[3])
-    t3 = _v_cross(q2, q1)
-    tf = _v_add(t1, t2)
-    tf = _v_add(t3, tf)
-    tf.append(q1[3] * q2[3] - _v_dot(q1, q2))
-    return tf
-
-
-def _q_mul(q, s):
-    return [q[0] * s, q[1] * s, q[2] * s, q[3] * s]
-
+_DEFAULT_VIEWPORT = (800, 600)  # Until the owner passes the real size in with resize()
+_MIN_VECTORIZED_DRAGS = 32  # Shorter sequences are quicker one by one than through NumPy
 
-def _q_dot(q1, q2):
-    return q1[0] * q2[0] + q1[1] * q2[1] + q1[2] * q2[2] + q1[3] * q2[3]
 
+def _q_compose(q1x, q1y, q1z, q1w, q2x, q2y, q2z, q2w):
+    """ Rotation q1 followed by q2, on plain floats so nothing is allocated but the result. """
+    return (q1x * q2w + q2x * q1w + q2y * q1z - q2z * q1y,
+            q1y * q2w + q2y * q1w + q2z * q1x - q2x * q1z,
+            q1z * q2w + q2z * q1w + q2x * q1y - q2y * q1x,
+            q1w * q2w - (q1x * q2x + q1y * q2y + q1z * q2z))
 
-def _q_length(q):
-    return math.sqrt(_q_dot(q, q))
 
+def _q_from_axis_angle(ax, ay, az, phi):
+    length = math.sqrt(ax * ax + ay * ay + az * az)
+    s = math.sin(phi / 2.0)
+    if length > 0.0:
+        s /= length
+    return ax * s, ay * s, az * s, math.cos(phi / 2.0)
 
-def _q_normalize(q):
-    try:
-        return _q_mul(q, 1.0 / _q_length(q))
-    except ZeroDivisionError:
-        return q
 
+def _project(r, x, y):
+    """ Project an x,y pair onto a sphere of radius r OR a hyperbolic sheet
+        if we are away from the center of the sphere.
+    """
 
-def _q_from_axis_angle(v, phi):
-    q = _v_mul(_v_normalize(v), math.sin(phi / 2.0))
-    q.append(math.cos(phi / 2.0))
-    return q
+    d = math.sqrt(x * x + y * y)
+    if d < r * 0.70710678118654752440:    # Inside sphere
+        return math.sqrt(r * r - d * d)
+    t = r / 1.41421356237309504880       # On hyperbola
+    return t * t / d
 
 
-def _q_rotmatrix(q):
-    m = [0.0] * 16
-    m[0*4+0] = 1.0 - 2.0 * (q[1] * q[1] + q[2] * q[2])
-    m[0*4+1] = 2.0 * (q[0] * q[1] - q[2] * q[3])
-    m[0*4+2] = 2.0 * (q[2] * q[0] + q[1] * q[3])
-    m[0*4+3] = 0.0
-    m[1*4+0] = 2.0 * (q[0] * q[1] + q[2] * q[3])
-    m[1*4+1] = 1.0 - 2.0 * (q[2] * q[2] + q[0] * q[0])
-    m[1*4+2] = 2.0 * (q[1] * q[2] - q[0] * q[3])
-    m[1*4+3] = 0.0
-    m[2*4+0] = 2.0 * (q[2] * q[0] - q[1] * q[3])
-    m[2*4+1] = 2.0 * (q[1] * q[2] + q[0] * q[3])
-    m[2*4+2] = 1.0 - 2.0 * (q[1] * q[1] + q[0] * q[0])
-    m[3*4+3] = 1.0
-    return m
+def _project_many(r, x, y):
+    d = numpy.hypot(x, y)
+    inside = d < r * 0.70710678118654752440
+    t = r / 1.41421356237309504880
+    return numpy.where(inside, numpy.sqrt(numpy.maximum(r * r - d * d, 0.0)), t * t / numpy.where(inside, 1.0, d))
 
 
 class Trackball:
-    """ Virtual trackball for 3D scene viewing. """
+    """ Virtual trackball for 3D scene viewing.
 
-    def __init__(self, theta=0, phi=0, zoom=1, distance=3):
+    The rotation is kept as a quaternion in a preallocated list and the matrix
+    in a preallocated array, which is only refreshed when asked for after the
+    rotation changed. Drags work in pixels of the viewport set with resize(), so
+    nothing is queried from OpenGL.
+    """
+
+    def __init__(self, theta=0, phi=0, zoom=1, distance=3, viewport=_DEFAULT_VIEWPORT):
         """ Build a new trackball with specified view """
 
-        self._rotation = [0, 0, 0, 1]
+        self._rotation = [0.0, 0.0, 0.0, 1.0]
+        self._matrix = numpy.identity(4, numpy.float32)
+        self._matrix_dirty = True
+        self.revision = 0  # Bumped on every change of the rotation
         self._zoom = zoom
         self._distance = distance
+        self._width, self._height = float(viewport[0]), float(viewport[1])
         self._count = 0
-        self._matrix = None
         self._RENORMCOUNT = 97
         self._TRACKBALLSIZE = 0.8
         self._theta = theta
@@ -145,29 +107,65 @@ class Trackball:
         self._x = 0.0
         self._y = 0.0
 
+    def resize(self, width, height):
+        """ Size of the viewport drags are given in, to be called whenever it changes. """
+        self._width = float(max(width, 1))
+        self._height = float(max(height, 1))
+
+    @property
+    def viewport(self):
+        return self._width, self._height
+
     def drag_to(self, x, y, dx, dy):
         """ Move trackball view from x,y to x+dx,y+dy. """
-        viewport = gl.glGetIntegerv(gl.GL_VIEWPORT)
-        width, height = float(viewport[2]), float(viewport[3])
+        width, height = self._width, self._height
         x = (x * 2.0 - width) / width
         dx = (2.0 * dx) / width
         y = (y * 2.0 - height) / height
         dy = (2.0 * dy) / height
-        q = self._rotate(x, y, dx, dy)
-        self._rotation = _q_add(q, self._rotation)
-        self._rotation[2] = 0.0
+        self._turn(*self._rotate(x, y, dx, dy))
+
+    def drag_many(self, drags):
+        """ Apply a sequence of (x, y, dx, dy) drags at once, the same as calling drag_to for each in turn.
+
+        The rotations of longer sequences are worked out together with NumPy, only
+        chaining them up is done one by one.
+        """
+        if len(drags) < _MIN_VECTORIZED_DRAGS:
+            for x, y, dx, dy in drags:
+                self.drag_to(x, y, dx, dy)
+            return
+
+        drags = numpy.asarray(drags, numpy.float64).reshape(-1, 4)
+
+        width, height = self._width, self._height
+        x = (drags[:, 0] * 2.0 - width) / width
+        y = (drags[:, 1] * 2.0 - height) / height
+        dx = (2.0 * drags[:, 2]) / width
+        dy = (2.0 * drags[:, 3]) / height
+
+        for qx, qy, qz, qw in self._rotate_many(x, y, dx, dy).tolist():
+            self._turn(qx, qy, qz, qw)
+
+    def _turn(self, qx, qy, qz, qw):
+        rotation = self._rotation
+        rx, ry, _, rw = _q_compose(qx, qy, qz, qw, rotation[0], rotation[1], rotation[2], rotation[3])
+        rz = 0.0
+
         self._count += 1
         if self._count > self._RENORMCOUNT:
-            self._rotation = _q_normalize(self._rotation)
+            length = math.sqrt(rx * rx + ry * ry + rw * rw)
+            if length > 0.0:
+                rx, ry, rw = rx / length, ry / length, rw / length
             self._count = 0
-        m = _q_rotmatrix(self._rotation)
-        self._matrix = (GLfloat * len(m))(*m)
+
+        rotation[0], rotation[1], rotation[2], rotation[3] = rx, ry, rz, rw
+        self._matrix_dirty = True
+        self.revision += 1
 
     def zoom_to(self, x, y, dx, dy):
         """ Zoom trackball by a factor dy """
-        viewport = gl.glGetIntegerv(gl.GL_VIEWPORT)
-        height = float(viewport[3])
-        self.zoom = self.zoom - 5 * dy / height
+        self.zoom = self.zoom - 5 * dy / self._height
 
     def pan_to(self, x, y, dx, dy):
         """ Pan trackball by a factor dx,dy """
@@ -175,11 +173,10 @@ class Trackball:
         self._y += dy * 0.1
 
     def push(self):
-        viewport = gl.glGetIntegerv(gl.GL_VIEWPORT)
         gl.glMatrixMode(gl.GL_PROJECTION)
         gl.glPushMatrix()
         gl.glLoadIdentity()
-        aspect = viewport[2] / float(viewport[3])
+        aspect = self._width / self._height
         aperture = 35.0
         near = 0.1
         far = 100.0
@@ -193,7 +190,7 @@ class Trackball:
         gl.glLoadIdentity()
         # gl.glTranslate (0.0, 0, -self._distance)
         gl.glTranslate(self._x, self._y, -self._distance)
-        gl.glMultMatrixf(self._matrix)
+        gl.glMultMatrixf(self.matrix)
 
     @staticmethod
     def pop():
@@ -204,8 +201,25 @@ class Trackball:
 
     @property
     def matrix(self):
+        """ The rotation as a 4x4 float32 array, updated in place. """
+        if self._matrix_dirty:
+            self._update_matrix()
         return self._matrix
 
+    def _update_matrix(self):
+        x, y, z, w = self._rotation
+        m = self._matrix
+        m[0, 0] = 1.0 - 2.0 * (y * y + z * z)
+        m[0, 1] = 2.0 * (x * y - z * w)
+        m[0, 2] = 2.0 * (z * x + y * w)
+        m[1, 0] = 2.0 * (x * y + z * w)
+        m[1, 1] = 1.0 - 2.0 * (z * z + x * x)
+        m[1, 2] = 2.0 * (y * z - x * w)
+        m[2, 0] = 2.0 * (z * x - y * w)
+        m[2, 1] = 2.0 * (y * z + x * w)
+        m[2, 2] = 1.0 - 2.0 * (y * y + x * x)
+        self._matrix_dirty = False
+
     @property
     def zoom(self):
         return self._zoom
@@ -261,27 +275,13 @@ class Trackball:
         self._phi = phi
         angle = self._theta*(math.pi/180.0)
         sine = math.sin(0.5*angle)
-        xrot = [1 * sine, 0, 0, math.cos(0.5 * angle)]
+        xrot = (1 * sine, 0.0, 0.0, math.cos(0.5 * angle))
         angle = self._phi * (math.pi / 180.0)
         sine = math.sin(0.5 * angle)
-        zrot = [0, 0, sine, math.cos(0.5 * angle)]
-        self._rotation = _q_add(xrot, zrot)
-        m = _q_rotmatrix(self._rotation)
-        self._matrix = (GLfloat * len(m))(*m)
-
-    @staticmethod
-    def _project(r, x, y):
-        """ Project an x,y pair onto a sphere of radius r OR a hyperbolic sheet
-            if we are away from the center of the sphere.
-        """
-
-        d = math.sqrt(x * x + y * y)
-        if d < r * 0.70710678118654752440:    # Inside sphere
-            z = math.sqrt(r * r - d * d)
-        else:                                   # On hyperbola
-            t = r / 1.41421356237309504880
-            z = t * t / d
-        return z
+        zrot = (0.0, 0.0, sine, math.cos(0.5 * angle))
+        self._rotation[:] = _q_compose(*xrot, *zrot)
+        self._matrix_dirty = True
+        self.revision += 1
 
     def _rotate(self, x, y, dx, dy): 
         """ Simulate a track-ball.
@@ -296,18 +296,42 @@ class Trackball:
         """
 
         if not dx and not dy:
-            return [0.0, 0.0, 0.0, 1.0]
-        last = [x, y, self._project(self._TRACKBALLSIZE, x, y)]
-        new = [x + dx, y + dy, self._project(self._TRACKBALLSIZE, x + dx, y + dy)]
-        a = _v_cross(new, last)
-        d = _v_sub(last, new)
-        t = _v_length(d) / (2.0 * self._TRACKBALLSIZE)
-        if t > 1.0:
-            t = 1.0
-        if t < -1.0:
-            t = -1.0
-        phi = 2.0 * math.asin(t)
-        return _q_from_axis_angle(a, phi)
+            return 0.0, 0.0, 0.0, 1.0
+        r = self._TRACKBALLSIZE
+        last_z = _project(r, x, y)
+        nx, ny = x + dx, y + dy
+        new_z = _project(r, nx, ny)
+
+        # Axis of rotation: new x last
+        ax = ny * last_z - new_z * y
+        ay = new_z * x - nx * last_z
+        az = nx * y - ny * x
+
+        t = math.sqrt(dx * dx + dy * dy + (last_z - new_z) ** 2) / (2.0 * r)
+        t = min(max(t, -1.0), 1.0)
+        return _q_from_axis_angle(ax, ay, az, 2.0 * math.asin(t))
+
+    def _rotate_many(self, x, y, dx, dy):
+        """ _rotate for arrays of drags, as an (n, 4) array of quaternions. """
+        r = self._TRACKBALLSIZE
+        last_z = _project_many(r, x, y)
+        nx, ny = x + dx, y + dy
+        new_z = _project_many(r, nx, ny)
+
+        axes = numpy.stack([ny * last_z - new_z * y, new_z * x - nx * last_z, nx * y - ny * x], axis=1)
+        lengths = numpy.linalg.norm(axes, axis=1)
+
+        t = numpy.clip(numpy.sqrt(dx * dx + dy * dy + (last_z - new_z) ** 2) / (2.0 * r), -1.0, 1.0)
+        half = numpy.arcsin(t)
+
+        quaternions = numpy.empty((len(x), 4))
+        quaternions[:, :3] = axes * (numpy.sin(half) / numpy.where(lengths > 0.0, lengths, 1.0))[:, None]
+        quaternions[:, 3] = numpy.cos(half)
+
+        # No movement is no rotation
+        still = (dx == 0.0) & (dy == 0.0)
+        quaternions[still] = (0.0, 0.0, 0.0, 1.0)
+        return quaternions
 
     def __str__(self):
         return self.__repr__()
@@ -317,3 +341,47 @@ class Trackball:
         theta = str(self.theta)
         zoom = str(self.zoom)
         return f'Trackball(phi={phi},theta={theta},zoom={zoom})'
+
+
+def _benchmark(events, repeat):
+    rng = numpy.random.default_rng(0)
+    width, height = _DEFAULT_VIEWPORT
+    drags = numpy.column_stack([rng.uniform(0, width, events), rng.uniform(0, height, events),
+                                rng.normal(0, 3, events), rng.normal(0, 3, events)])
+    drag_list = drags.tolist()
+
+    def single():
+        trackball = Trackball()
+        for x, y, dx, dy in drag_list:
+            trackball.drag_to(x, y, dx, dy)
+
+    def single_with_matrix():
+        trackball = Trackball()
+        for x, y, dx, dy in drag_list:
+            trackball.drag_to(x, y, dx, dy)
+            trackball.matrix
+
+    def batched():
+        Trackball().drag_many(drags)
+
+    results = []
+    for name, function in [('drag_to', single), ('drag_to + matrix', single_with_matrix),
+                           ('drag_many', batched)]:
+        seconds = min(timeit.repeat(function, number=1, repeat=repeat))
+        results.append((name, seconds / events * 1e6))
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time trackball drags, in microseconds per mouse move event.')
+    parser.add_argument('--events', type=int, default=10000, help='Drag events per run')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs, the fastest counts')
+    args = parser.parse_args(argv)
+
+    for name, microseconds in _benchmark(args.events, args.repeat):
+        print(f'{name:>18}: {microseconds:.2f} us/event')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,194 @@
+import numpy
+
+from pyrr import Quaternion
+
+_DEFAULT_CAPACITY = 1024
+
+
+def quaternions_to_matrices(quaternions, out=None):
+    """ Convert an N x 4 array of (x, y, z, w) quaternions into N x 3 x 3 rotation matrices.
+
+    Follows pyrr's matrix33.create_from_quaternion, so the result matches Matrix44.from_quaternion.
+    """
+    qx, qy, qz, qw = quaternions[:, 0], quaternions[:, 1], quaternions[:, 2], quaternions[:, 3]
+
+    if out is None:
+        out = numpy.empty((len(quaternions), 3, 3), quaternions.dtype)
+
+    sqx, sqy, sqz, sqw = qx * qx, qy * qy, qz * qz, qw * qw
+    invs = 1.0 / (sqx + sqy + sqz + sqw)
+
+    out[:, 0, 0] = (sqx - sqy - sqz + sqw) * invs
+    out[:, 1, 1] = (-sqx + sqy - sqz + sqw) * invs
+    out[:, 2, 2] = (-sqx - sqy + sqz + sqw) * invs
+    out[:, 1, 0] = 2.0 * (qx * qy + qz * qw) * invs
+    out[:, 0, 1] = 2.0 * (qx * qy - qz * qw) * invs
+    out[:, 2, 0] = 2.0 * (qx * qz - qy * qw) * invs
+    out[:, 0, 2] = 2.0 * (qx * qz + qy * qw) * invs
+    out[:, 2, 1] = 2.0 * (qy * qz + qx * qw) * invs
+    out[:, 1, 2] = 2.0 * (qy * qz - qx * qw) * invs
+
+    return out
+
+
+class TransformStore:
+    """ Translation, rotation and scale of many shapes kept in contiguous arrays.
+
+    Shapes bound to the store write their transforms into a slot of the
+    N x 3 translation, N x 4 quaternion and N x 3 scale arrays. update()
+    then computes every local and world matrix in a handful of batched NumPy
+    operations: one pass for the local matrices and one matmul per depth
+    level of the hierarchy for the world matrices. Matrices are stored in
+    pyrr's layout, so a slot's world matrix can be uploaded as is.
+    """
+
+    def __init__(self, capacity=_DEFAULT_CAPACITY):
+        if capacity is None or capacity <= 0:
+            raise ValueError('Transform store capacity must be more than 0')
+
+        self.count = 0  # Slots in use are below count, freed ones are reused first
+        self._free_slots = []
+
+        self.translations = numpy.zeros((capacity, 3), numpy.float32)
+        self.rotations = numpy.zeros((capacity, 4), numpy.float32)
+        self.rotations[:, 3] = 1.0
+        self.scales = numpy.ones((capacity, 3), numpy.float32)
+        self.tints = numpy.zeros((capacity, 4), numpy.float32)
+        self.parents = numpy.full(capacity, -1, numpy.int64)
+        self.alive = numpy.zeros(capacity, bool)
+
+        self.local_matrices = numpy.zeros((capacity, 4, 4), numpy.float32)
+        self.world_matrices = numpy.zeros((capacity, 4, 4), numpy.float32)
+
+        # Bumped when slots are added, removed or re-parented
+        self.structure_revision = 0
+
+        self._levels = None
+        self._dirty = False
+
+    def capacity(self):
+        return len(self.alive)
+
+    def _grow(self):
+        capacity = self.capacity()
+
+        def grown(array, fill):
+            bigger = numpy.full((capacity * 2,) + array.shape[1:], fill, array.dtype)
+            bigger[:capacity] = array
+            return bigger
+
+        self.translations = grown(self.translations, 0.0)
+        self.rotations = grown(self.rotations, 0.0)
+        self.rotations[capacity:, 3] = 1.0
+        self.scales = grown(self.scales, 1.0)
+        self.tints = grown(self.tints, 0.0)
+        self.parents = grown(self.parents, -1)
+        self.alive = grown(self.alive, False)
+        self.local_matrices = grown(self.local_matrices, 0.0)
+        self.world_matrices = grown(self.world_matrices, 0.0)
+
+    def allocate(self, parent=-1):
+        if self._free_slots:
+            slot = self._free_slots.pop()
+        else:
+            if self.count == self.capacity():
+                self._grow()
+            slot = self.count
+            self.count += 1
+
+        self.translations[slot] = 0.0
+        self.rotations[slot] = (0.0, 0.0, 0.0, 1.0)
+        self.scales[slot] = 1.0
+        self.tints[slot] = 0.0
+        self.parents[slot] = parent
+        self.alive[slot] = True
+
+        self._structure_changed()
+        return slot
+
+    def free(self, slot):
+        if not self.alive[slot]:
+            return
+
+        self.alive[slot] = False
+        self.parents[slot] = -1
+        self._free_slots.append(slot)
+        self._structure_changed()
+
+    def _structure_changed(self):
+        self.structure_revision += 1
+        self._levels = None
+        self._dirty = True
+
+    def set_parent(self, slot, parent):
+        self.parents[slot] = parent
+        self._structure_changed()
+
+    def set_translation(self, slot, translation):
+        self.translations[slot] = translation
+        self._dirty = True
+
+    def set_rotation(self, slot, quaternion):
+        self.rotations[slot] = quaternion
+        self._dirty = True
+
+    def set_rotation_matrix(self, slot, matrix):
+        self.set_rotation(slot, Quaternion.from_matrix(numpy.asarray(matrix, numpy.float32)[:3, :3]))
+
+    def set_scale(self, slot, scale):
+        self.scales[slot] = scale
+        self._dirty = True
+
+    def set_tint(self, slot, tint):
+        self.tints[slot] = tint
+
+    def _build_levels(self):
+        """ Group the live slots by their depth in the hierarchy, roots first. """
+        count = self.count
+        parents = self.parents[:count]
+        depth = numpy.zeros(count, numpy.int64)
+
+        # Walk every slot up towards its root at once, one hierarchy level per step
+        ancestors = parents.copy()
+        while True:
+            has_ancestor = ancestors >= 0
+            if not has_ancestor.any():
+                break
+            depth[has_ancestor] += 1
+            ancestors = numpy.where(has_ancestor, parents[numpy.maximum(ancestors, 0)], -1)
+
+        alive = self.alive[:count]
+        max_depth = depth[alive].max() if alive.any() else -1
+
+        return [numpy.flatnonzero(alive & (depth == level)) for level in range(max_depth + 1)]
+
+    def update(self):
+        if not self._dirty:
+            return
+
+        count = self.count
+        local = self.local_matrices[:count]
+
+        # Scale, then rotate, then translate, in pyrr's row-vector layout
+        local[:] = 0.0
+        quaternions_to_matrices(self.rotations[:count], local[:, :3, :3])
+        local[:, :3, :3] *= self.scales[:count, :, None]
+        local[:, 3, :3] = self.translations[:count]
+        local[:, 3, 3] = 1.0
+
+        if self._levels is None:
+            self._levels = self._build_levels()
+
+        world = self.world_matrices
+        for level, slots in enumerate(self._levels):
+            if level == 0:
+                world[slots] = local[slots]
+            else:
+                world[slots] = numpy.matmul(local[slots], world[self.parents[slots]])
+
+        self._dirty = False
+
+    def model_view_matrices(self, view_matrix):
+        """ Model-view matrices of all slots below count as an N x 4 x 4 array. """
+        self.update()
+        return numpy.matmul(self.world_matrices[:self.count], numpy.asarray(view_matrix, numpy.float32))
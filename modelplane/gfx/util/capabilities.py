@@ -0,0 +1,24 @@
+from OpenGL.GL import *
+
+_extensions = None
+
+
+def gl_version():
+    """ (major, minor) of the current context. """
+    return glGetIntegerv(GL_MAJOR_VERSION), glGetIntegerv(GL_MINOR_VERSION)
+
+
+def has_extension(name):
+    global _extensions
+
+    # The list is read once, every context the viewer creates runs on the same driver
+    if _extensions is None:
+        count = glGetIntegerv(GL_NUM_EXTENSIONS)
+        _extensions = {glGetStringi(GL_EXTENSIONS, i).decode() for i in range(count)}
+
+    return name in _extensions
+
+
+def supports(major, minor, extension=None):
+    """ Whether the context is at least the given version or has the extension that adds the feature. """
+    return gl_version() >= (major, minor) or (extension is not None and has_extension(extension))
@@ -6,6 +6,9 @@ class Color:
     def __init__(self, r=0.0, g=0.0, b=0.0, a=1.0):
         self._color = [r, g, b, a]
 
+        # Called without arguments whenever a channel is set, by the shape owning the color
+        self.on_change = None
+
     @property
     def r(self):
         return self._color[0]
@@ -14,6 +17,7 @@ class Color:
     def r(self, value):
         self._check_type(value)
         self._color[0] = float(value)
+        self._changed()
 
     @property
     def g(self):
@@ -23,6 +27,7 @@ class Color:
     def g(self, value):
         self._check_type(value)
         self._color[1] = float(value)
+        self._changed()
 
     @property
     def b(self):
@@ -32,6 +37,7 @@ class Color:
     def b(self, value):
         self._check_type(value)
         self._color[2] = float(value)
+        self._changed()
 
     @property
     def a(self):
@@ -41,6 +47,11 @@ class Color:
     def a(self, value):
         self._check_type(value)
         self._color[3] = float(value)
+        self._changed()
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change()
 
     @staticmethod
     def _check_type(checkee):
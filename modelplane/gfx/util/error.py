@@ -1,15 +1,77 @@
-import inspect
+import os
 import sys
 
 from OpenGL.GL import *
-from OpenGL.GLU import *
+
+from modelplane.gfx import runtime
+from modelplane.gfx.util.capabilities import supports
+
+_OPENGL_PACKAGE = os.path.dirname(os.path.dirname(sys.modules['OpenGL.GL'].__file__))
+
+# Errors reported by the debug output, with where they were caused, waiting for the next gl_error_check()
+_debug_errors = []
+_debug_callback = None
+
+
+def _caller():
+    """ File, function and line of the innermost frame outside PyOpenGL and this module. """
+    frame = sys._getframe(1)
+    while frame is not None and (frame.f_code.co_filename.startswith(_OPENGL_PACKAGE) or
+                                 frame.f_code.co_filename == __file__):
+        frame = frame.f_back
+
+    if frame is None:
+        return '?', '?', 0
+    return frame.f_code.co_filename, frame.f_code.co_name, frame.f_lineno
+
+
+def _debug_message(source, message_type, message_id, severity, length, message, user_param):
+    # Synchronous output runs this inside the GL call that caused the message
+    filename, function, line = _caller()
+    text = ctypes.string_at(message, length).decode(errors='replace')
+
+    if message_type == GL_DEBUG_TYPE_ERROR:
+        _debug_errors.append(f'ERROR in {filename}, {function}, at {line}: OpenGL error: {text}')
+    else:
+        print(f'WARNING: OpenGL in {filename}, {function}, at {line}: {text}', file=sys.stderr)
+
+
+def enable_debug_output():
+    """ Have the driver report errors and warnings as they happen, through KHR_debug. Returns whether it could.
+
+    Errors are then raised by gl_error_check() without asking the driver with
+    glGetError, which waits for the GPU. Only used in the debug profile.
+    """
+    global _debug_callback
+
+    if runtime.current_profile() != runtime.DEBUG or not supports(4, 3, 'GL_KHR_debug'):
+        return False
+
+    # Kept referenced, the driver calls it for as long as the context lives
+    _debug_callback = GLDEBUGPROC(_debug_message)
+
+    glEnable(GL_DEBUG_OUTPUT)
+    glEnable(GL_DEBUG_OUTPUT_SYNCHRONOUS)
+    glDebugMessageCallback(_debug_callback, None)
+    glDebugMessageControl(GL_DONT_CARE, GL_DONT_CARE, GL_DEBUG_SEVERITY_NOTIFICATION, 0, None, GL_FALSE)
+    return True
 
 
 def gl_error_check():
+    """ Exit with the first OpenGL error since the last check. Does nothing in the release profile. """
+    if not runtime.checking:
+        return
+
+    if _debug_callback is not None:
+        if _debug_errors:
+            sys.exit(_debug_errors[0])
+        return
+
     error_code = glGetError()
     if error_code != GL_NO_ERROR:
-        caller_frame_record = inspect.stack()[1]  # line from caller
-        frame = caller_frame_record[0]
-        info = inspect.getframeinfo(frame)
-        sys.exit(f'ERROR in {info.filename}, {info.function}, before {info.lineno}: '
+        # GLU is only needed to name the error
+        from OpenGL.GLU import gluErrorString
+
+        filename, function, line = _caller()
+        sys.exit(f'ERROR in {filename}, {function}, before {line}: '
                  f'OpenGL error: {gluErrorString(error_code)}')
@@ -0,0 +1,24 @@
+import importlib.util
+import sys
+
+
+def lazy_import(name):
+    """ The named module, only executed when one of its attributes is first used.
+
+    For dependencies that are slow to import and not needed on every path,
+    such as glfw for a headless viewer. A module that is already imported is
+    returned as it is.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f"No module named '{name}'", name=name)
+
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
@@ -1,76 +1,364 @@
-import glfw
+import collections
 
 from OpenGL.GL import *
-from OpenGL.GLU import *
-from pyrr import Matrix44, Vector4
 
+from modelplane.camera import Camera
+from modelplane.gfx import runtime
+from modelplane.gfx.framebuffer import Framebuffer
+from modelplane.gfx.mesh.cache import MeshCache
+from modelplane.gfx.picking import ray_from_screen
+from modelplane.gfx.profiler import FrameProfiler
 from modelplane.gfx.shapes.cube import Cube
-from modelplane.gfx.shader.shader import Shader
+from modelplane.gfx.shader.program_cache import ProgramCache
+from modelplane.gfx.shader.shader import Shader, bundled
+from modelplane.gfx.shader.uniform_buffer import UniformBuffer
 from modelplane.gfx.scene import Scene
-from modelplane.interaction import Interaction
+from modelplane.gfx.texture import TextureCache
+from modelplane.importer import ModelImporter
 from modelplane.gfx.util.error import *
+from modelplane.gfx.util.lazy import lazy_import
+from modelplane.startup import StartupTimer
 
+# Only a viewer with a window needs glfw, which takes a while to load
+glfw = lazy_import('glfw')
 
-class Viewer:
+CONTINUOUS = 'continuous'  # Draw a frame every vsync
+ON_DEMAND = 'on_demand'  # Sleep until an event, then draw only when something changed
+
+# A camera's part of the window, x and y from the bottom left corner, all as fractions of the window size
+Viewport = collections.namedtuple('Viewport', ['camera', 'x', 'y', 'width', 'height'])
 
-    _DEFAULT_FOV = 70
-    _DEFAULT_NEAR_PLANE = 0.1
-    _DEFAULT_FAR_PLANE = 800.0
 
-    def __init__(self, width, height, title):
+class Viewer:
+
+    _FRAME_DATA_BLOCK = 'FrameData'
+    _FRAME_DATA_BINDING = 0
+    _FRAME_DATA_FIELDS = [('u_view', 'mat4'), ('u_projection', 'mat4')]
+
+    def __init__(self, width, height, title, headless=False, profile=False, render_mode=ON_DEMAND, frame_cap=None,
+                 startup=None):
+        """ With headless=True there is no window: frames are rendered into a
+        framebuffer object on an offscreen context, created through the platform
+        picked with offscreen.select_platform() before OpenGL was imported.
+        How much OpenGL checking is done is chosen the same way, with
+        runtime.select_profile(); the debug profile reports driver messages as they happen.
+        With profile=True each frame's stages are timed by self.profiler.
+        frame_cap limits the frames per second on top of vsync, in either render mode.
+        The startup phases are timed into startup, a StartupTimer, or a new one in self.startup.
+        """
         if not width or not height or width < 0 or height < 0:
             raise ValueError('Width and height should be 0 or more')
 
         if title is None:
             raise ValueError('Viewer needs to have a title')
 
-        self._last_width = width - 1
-        self._last_height = height - 1
+        if render_mode not in [CONTINUOUS, ON_DEMAND]:
+            raise ValueError(f"Unknown render mode '{render_mode}'")
+
+        if frame_cap is not None and frame_cap <= 0:
+            raise ValueError('Frame cap must be more than 0 frames per second')
+
+        self.headless = headless
+        self.render_mode = render_mode
+        self.frame_cap = frame_cap
+        self._dirty = True
+
+        # None draws the active camera over the whole window
+        self._viewports = None
+
+        self._window = None
+        self._interaction = None
+        self._offscreen = None
+        self._framebuffer = None
+        self._headless_camera = None
+        self.startup = startup if startup is not None else StartupTimer()
+
+        if headless:
+            with self.startup.phase('context'):
+                from modelplane.gfx.offscreen import OffscreenContext
+                self._offscreen = OffscreenContext(width, height)
+                self._framebuffer = Framebuffer(width, height)
+                self._headless_camera = Camera()
+                self._init_opengl(width, height)
+        else:
+            # GLFW creates the window and its context together
+            with self.startup.phase('window'):
+                self._window = self._init_interface(width, height, title)
+            with self.startup.phase('context'):
+                self._init_opengl(width, height)
+                self._interaction = self._init_interaction(self._window)
+                self._interaction.register_callback('mouse_press', self._mouse_press)
+
+        with self.startup.phase('shaders'):
+            # Linked programs are kept on disk, a later start only compiles shaders that changed
+            self._shader = Shader(bundled('viewer_shader.vert'), bundled('viewer_shader.frag'), cache=ProgramCache())
+            self._shader.bind_uniform_block(self._FRAME_DATA_BLOCK, self._FRAME_DATA_BINDING)
+            self._frame_data = UniformBuffer(self._FRAME_DATA_FIELDS, self._FRAME_DATA_BINDING)
+
+        with self.startup.phase('scene'):
+            self._scene = self._init_scene()
+            self._importer = ModelImporter(cache=MeshCache(), on_parsed=None if headless else glfw.post_empty_event)
+            self.textures = TextureCache(on_decoded=None if headless else glfw.post_empty_event)
+
+        self.profiler = FrameProfiler(enabled=profile)
+
+    def import_model(self, path, optimize=False, lods=False):
+        """ Start importing a model file in the background. Returns the ImportJob to follow its progress.
+
+        optimize reorders the meshes for the vertex cache and overdraw on import, lods
+        builds simplified levels of detail for dense meshes.
+        """
+        return self._importer.import_model(path, optimize=optimize, lods=lods)
+
+    def load_texture(self, path):
+        """ Start loading an image file into self.textures. Returns the TextureJob to follow its progress. """
+        return self.textures.load(path)
+
+    def input_latency(self):
+        """ p50, p90 and p99 milliseconds from input events to the frame showing them, None without a window. """
+        if self._interaction is None:
+            return None
+        return self._interaction.latency_percentiles()
+
+    def camera(self):
+        if self.headless:
+            return self._headless_camera
+        return self._interaction.camera()
+
+    def set_viewports(self, viewports):
+        """ Split the window between several cameras, drawn in the same frame.
+
+        viewports is a list of Viewport, or None to go back to the active camera
+        filling the window. Clicking in a viewport makes its camera the active one.
+        """
+        if viewports is not None:
+            for viewport in viewports:
+                if viewport.width <= 0 or viewport.height <= 0:
+                    raise ValueError('Viewport width and height must be more than 0')
+
+                if self._interaction is not None and viewport.camera not in self._interaction.cameras:
+                    self._interaction.cameras.append(viewport.camera)
+
+        self._viewports = list(viewports) if viewports is not None else None
+        self.request_redraw()
+
+    def quad_view(self):
+        """ Split the window in four: front, top and side views, and the active camera in the bottom right. """
+        camera = self.camera()
+        views = [Camera(camera.position, camera.distance, theta=0, phi=0),
+                 Camera(camera.position, camera.distance, theta=90, phi=0),
+                 Camera(camera.position, camera.distance, theta=0, phi=90)]
+
+        self.set_viewports([Viewport(views[0], 0.0, 0.5, 0.5, 0.5),
+                            Viewport(views[1], 0.5, 0.5, 0.5, 0.5),
+                            Viewport(views[2], 0.0, 0.0, 0.5, 0.5),
+                            Viewport(camera, 0.5, 0.0, 0.5, 0.5)])
+
+    def render_frame(self):
+        """ Upload everything imported so far and render one frame into the offscreen framebuffer. """
+        if not self.headless:
+            raise RuntimeError('render_frame() is only available on a headless viewer')
+
+        self.profiler.begin_frame()
+
+        with self.profiler.stage('uploads'):
+            self._importer.process_uploads(self._scene, budget=float('inf'))
+            self.textures.process_uploads(budget=float('inf'))
+
+        self._framebuffer.bind()
+        self._shader.use()
+        self._render()
+        self._shader.end_use()
+
+        with self.profiler.stage('finish'):
+            glFinish()
+
+        self.startup.first_frame()
+        self.profiler.end_frame()
+
+    def read_pixels(self):
+        """ The last rendered frame as a height x width x 4 uint8 array, top row first. """
+        if not self.headless:
+            raise RuntimeError('read_pixels() is only available on a headless viewer')
+
+        return self._framebuffer.read_pixels()
+
+    def snapshot(self, path=None):
+        """ Render a frame and return it as a Pillow image, saved to path when given. """
+        from PIL import Image
+
+        self.render_frame()
+        image = Image.fromarray(self.read_pixels(), 'RGBA')
+        if path is not None:
+            image.save(path)
+
+        return image
+
+    def resize(self, width, height):
+        if not self.headless:
+            glfw.set_window_size(self._window, width, height)
+            return
+
+        self._framebuffer.resize(width, height)
+        self._window_size_callback(None, width, height)
+
+    def shutdown(self):
+        """ Release the headless context. A windowed viewer cleans up when main_loop() returns. """
+        self._importer.shutdown()
+        self.textures.shutdown()
 
-        self._inverse_modelview = Matrix44().identity()
-        self._modelview = Matrix44().identity()
+        self.profiler.delete()
+        self.textures.delete()
 
-        self._window = self._init_interface(width, height, title)
-        self._init_opengl(width, height)
-        self._scene = self._init_scene()
-        self._interaction = self._init_interaction(self._window)
-        self._shader = Shader('gfx/shader/viewer_shader.vert', 'gfx/shader/viewer_shader.frag')
+        if self.headless:
+            self._framebuffer.delete()
+            self._offscreen.destroy()
+
+    def request_redraw(self):
+        """ Draw the next frame even when nothing the viewer tracks has changed. """
+        self._dirty = True
+        if not self.headless:
+            glfw.post_empty_event()
+
+    def _needs_redraw(self):
+        return self._dirty or self._interaction.dirty or self._interaction.moving() or self._scene.changed() or \
+            self._importer.uploading() or self.textures.uploading()
 
     def main_loop(self):
+        if self.headless:
+            raise RuntimeError('A headless viewer has no window, use render_frame() or snapshot()')
+
         self._shader.use()
 
         while not glfw.window_should_close(self._window):
-            glfw.poll_events()
+            # Input, resizes and finished imports all wake the loop up; anything else that
+            # should be drawn has to go through request_redraw()
+            if self.render_mode == ON_DEMAND and not self._needs_redraw():
+                glfw.wait_events()
+                # Only input that changes the view is worth a frame, which is not drawn yet
+                self._interaction.process(frame=False)
+                continue
+
+            frame_start = glfw.get_time()
+            self.profiler.begin_frame()
+
+            # Input callbacks run inside poll_events and only queue the events, which are applied together
+            with self.profiler.stage('events'):
+                glfw.poll_events()
+                self._interaction.process(frame_start)
+
+            with self.profiler.stage('uploads'):
+                self._importer.process_uploads(self._scene)
+                self.textures.process_uploads()
+
             self._render()
-            glfw.swap_buffers(self._window)
+
+            with self.profiler.stage('swap'):
+                glfw.swap_buffers(self._window)
+            self._interaction.presented()
+            self.startup.first_frame()
+
+            self._dirty = False
+            self._interaction.dirty = False
+
+            self.profiler.end_frame()
+
+            if self.frame_cap is not None:
+                remaining = 1.0 / self.frame_cap - (glfw.get_time() - frame_start)
+                if remaining > 0.0:
+                    glfw.wait_events_timeout(remaining)
 
         self._shader.end_use()
+        self._importer.shutdown()
+        self.textures.shutdown()
+        self.profiler.delete()
+        self.textures.delete()
 
         glfw.destroy_window(self._window)
         glfw.terminate()
 
     def _render(self):
-        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-
-        width, height = glfw.get_window_size(self._window)
+        width, height = self._size()
 
         # Prevent errors upon minimizing the window. Cannot just set to 1, as
         # errors will occur in the perspective projection matrix creation.
         if height == 0:
+            glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+            return
+
+        # Updating the scene and uploading mesh edits is done once for all the views
+        with self.profiler.stage('prepare'):
+            self._scene.prepare(self._shader)
+
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+
+        with self.profiler.stage('matrices'):
+            # The cameras only compute the matrices again when they moved
+            views = []
+            for camera, x, y, view_width, view_height in self._layout(width, height):
+                camera.set_viewport(view_width, view_height, x, y)
+                views.append((camera, camera.view_matrix(), camera.projection_matrix(), camera.view_projection()))
+
+        with self.profiler.stage('scene'):
+            for camera, view, projection, view_projection in views:
+                x, y, view_width, view_height = camera.viewport
+                glViewport(x, y, view_width, view_height)
+
+                self._frame_data['u_view'] = view
+                self._frame_data['u_projection'] = projection
+                self._frame_data.flush()
+
+                self._scene.draw(view_projection, view_height, view=camera)
+
+            if len(views) > 1:
+                glViewport(0, 0, width, height)
+
+    def _layout(self, width, height):
+        """ Camera and pixel rectangle of each viewport, x and y from the bottom left. """
+        if self._viewports is None:
+            return [(self.camera(), 0, 0, width, height)]
+
+        rectangles = []
+        for camera, x, y, view_width, view_height in self._viewports:
+            left, bottom = round(x * width), round(y * height)
+            right, top = round((x + view_width) * width), round((y + view_height) * height)
+            if right > left and top > bottom:
+                rectangles.append((camera, left, bottom, right - left, top - bottom))
+
+        return rectangles
+
+    def _viewport_at(self, x, y):
+        """ The camera and its pixel rectangle under window position x, y counted from the bottom left. """
+        width, height = self._size()
+        for camera, left, bottom, view_width, view_height in self._layout(width, height):
+            if left <= x < left + view_width and bottom <= y < bottom + view_height:
+                return camera, left, bottom, view_width, view_height
+
+        return None
+
+    def _mouse_press(self, button, x, y):
+        viewport = self._viewport_at(x, y)
+        if viewport is None:
             return
 
-        if width != self._last_width and height != self._last_height:
-            self._shader['u_projection'] = Matrix44.perspective_projection(
-                self._DEFAULT_FOV, float(width) / float(height), self._DEFAULT_NEAR_PLANE, self._DEFAULT_FAR_PLANE) * \
-                Matrix44.from_translation(Vector4([0.0, 0.0, -self._interaction.camera().distance, 0.0]))
-            self._last_width = width
-            self._last_height = height
+        camera, left, bottom, width, height = viewport
+
+        # Clicking into a viewport hands it the mouse
+        if self._interaction is not None and self._viewports is not None:
+            self._interaction.active_camera = self._interaction.cameras.index(camera)
+
+        if button == glfw.MOUSE_BUTTON_LEFT:
+            self._pick(camera, x - left, y - bottom, width, height)
 
-        current_model_view = Matrix44.from_translation(self._interaction.camera().position) * self._interaction.matrix()
-        #self._modelview = current_model_view.T
-        #self._inverse_modelview = self._modelview.inverse
+    def _pick(self, camera, x, y, width, height):
+        origin, direction = ray_from_screen(x, y, width, height, camera.view_projection())
+        hit = self._scene.pick(origin, direction)
+        self._scene.select(hit.shape if hit is not None else None)
 
-        self._scene.render(self._shader, current_model_view)
+    def _size(self):
+        if self.headless:
+            return self._framebuffer.width, self._framebuffer.height
+        return glfw.get_window_size(self._window)
 
     def _init_interface(self, width, height, title):
         if not width or not height or not title:
@@ -87,6 +375,7 @@ class Viewer:
         glfw.window_hint(glfw.CONTEXT_VERSION_MAJOR, 3)
         glfw.window_hint(glfw.CONTEXT_VERSION_MINOR, 3)
         glfw.window_hint(glfw.OPENGL_PROFILE, glfw.OPENGL_CORE_PROFILE)
+        glfw.window_hint(glfw.OPENGL_DEBUG_CONTEXT, runtime.current_profile() == runtime.DEBUG)
 
         if 'darwin' in sys.platform:  # Mac platform
             glfw.window_hint(glfw.OPENGL_FORWARD_COMPAT, GL_TRUE)
@@ -102,6 +391,7 @@ class Viewer:
 
         # Setup event callbacks
         glfw.set_window_size_callback(window, self._window_size_callback)
+        glfw.set_window_refresh_callback(window, self._window_refresh_callback)
 
         return window
 
@@ -109,6 +399,7 @@ class Viewer:
     def _init_opengl(width, height):
         if width < 0 or height < 0:
             raise ValueError('Width and height must be 0 or greater')
+        enable_debug_output()
         glViewport(0, 0, width, height)
         glEnable(GL_DEPTH_TEST)
         gl_error_check()
@@ -127,17 +418,21 @@ class Viewer:
         if not window:
             raise ValueError('Interaction window is None')
 
+        from modelplane.interaction import Interaction
         return Interaction(window)
 
     def _window_size_callback(self, window, width, height):
-        if window is None or width < 0 or height < 0:
+        if (window is None and not self.headless) or width < 0 or height < 0:
             return
         glViewport(0, 0, width, height)
-        self._shader['u_projection'] = Matrix44.perspective_projection(
-            self._DEFAULT_FOV, float(width) / float(height), self._DEFAULT_NEAR_PLANE, self._DEFAULT_FAR_PLANE) * \
-            Matrix44.from_translation(Vector4([0.0, 0.0, -self._interaction.camera().distance, 0.0]))
-        self._last_width = width
-        self._last_height = height
+        if self._interaction is not None:
+            self._interaction.resize(width, height)
+        # The cameras are fitted to their viewports when the next frame is drawn
+        self._dirty = True
+
+    def _window_refresh_callback(self, window):
+        # The window was uncovered or damaged and its contents have to be drawn again
+        self._dirty = True
 
     def _window_error_callback(self, issue, info):
         glfw.destroy_window(self._window)
@@ -0,0 +1,408 @@
+import queue
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+from pyrr import Matrix44
+
+from modelplane.gfx.mesh.layout import STANDARD
+from modelplane.gfx.mesh.optimize import optimize_mesh
+from modelplane.gfx.mesh.registry import mesh_registry
+from modelplane.gfx.mesh.simplify import build_lods
+from modelplane.gfx.shapes.shape import HierarchicalShape, PrimitiveShape
+
+QUEUED = 'queued'
+PARSING = 'parsing'
+UPLOADING = 'uploading'
+DONE = 'done'
+CANCELLED = 'cancelled'
+FAILED = 'failed'
+
+_DEFAULT_WORKERS = 2
+_DEFAULT_UPLOAD_BUDGET = 0.004  # Seconds of each frame that may be spent uploading imported meshes
+_UPLOAD_CHUNK = 1024 * 1024  # Bytes of mesh data per glBufferSubData, a big mesh goes up over several frames
+_DEFAULT_COLOR = (0.8, 0.8, 0.8)
+_LOD_LEVELS = 4
+
+
+def load_model(path, processing=None, cache=None, optimize=False, lods=False, reports=None, nodes=None):
+    """ Meshes of a model file as (vertices, indices, geometry key, levels of detail) tuples.
+
+    With a MeshCache, a model imported before is mapped straight from the cache
+    and a newly parsed one is written to it. Keys not stored in the cache are
+    computed here, so the render thread does not hash the meshes.
+    optimize runs the meshes through optimize_mesh once, before they are cached,
+    adding a (name, OptimizationReport) pair for each to the reports list when
+    given; meshes mapped from the cache were optimized before and add none.
+    With lods, dense meshes get a chain of simplified (vertices, indices, key)
+    levels, which are cached too; otherwise the chains are empty.
+    The node graph is added to the nodes list when given, as load_meshes does.
+    """
+    # Optimized meshes are cached apart from the plain ones
+    options = (processing, 'optimized') if optimize else processing
+
+    meshes = cache.load(path, options) if cache is not None else None
+    graph = cache.load(path, (options, 'nodes')) if cache is not None else None
+
+    if meshes is None or graph is None:
+        parsed_nodes = []
+        meshes = load_meshes(path, processing, parsed_nodes)
+        if optimize:
+            meshes = _optimize(meshes, [f'mesh {i}' for i in range(len(meshes))], reports)
+        meshes = [(vertices, indices, None) for vertices, indices in meshes]
+
+        # Each node is cached as an entry of its own, the matrix as vertices and the parent followed by
+        # the node's meshes as indices
+        graph = [(matrix.ravel(), numpy.concatenate([[parent], node_meshes]).astype(numpy.int32), None)
+                 for parent, matrix, node_meshes in parsed_nodes]
+
+        if cache is not None:
+            cache.store(path, meshes, options)
+            cache.store(path, graph, (options, 'nodes'))
+            # Mapping the fresh cache file picks up the stored keys and lets the parsed copies go
+            meshes = cache.load(path, options) or meshes
+
+    if nodes is not None:
+        nodes.extend((int(entry[0]), numpy.asarray(matrix, numpy.float32).reshape(4, 4), entry[1:])
+                     for matrix, entry, _ in graph)
+
+    meshes = [(vertices, indices, key if key is not None else mesh_registry.geometry_key(vertices, indices))
+              for vertices, indices, key in meshes]
+
+    chains = _load_lods(path, meshes, options, cache, optimize, reports) if lods else [[] for _ in meshes]
+
+    return [(vertices, indices, key, chain) for (vertices, indices, key), chain in zip(meshes, chains)]
+
+
+def _optimize(meshes, names, reports):
+    optimized = []
+    for (vertices, indices), name in zip(meshes, names):
+        vertices, indices, report = optimize_mesh(vertices, indices)
+        optimized.append((vertices, indices))
+        if reports is not None:
+            reports.append((name, report))
+
+    return optimized
+
+
+def _load_lods(path, meshes, options, cache, optimize, reports):
+    """ Levels of detail of each mesh, cached one file per level with an empty mesh where a chain ended. """
+    levels = [(options, 'lod', level) for level in range(1, _LOD_LEVELS + 1)]
+
+    if cache is not None:
+        cached = [cache.load(path, level) for level in levels]
+        if all(level is not None and len(level) == len(meshes) for level in cached):
+            return [[lod for lod in chain if len(lod[1]) > 0] for chain in zip(*cached)]
+
+    chains = [build_lods(vertices, indices, _LOD_LEVELS) for vertices, indices, _ in meshes]
+    if optimize:
+        chains = [_optimize(chain, [f'mesh {i} lod {level}' for level in range(1, len(chain) + 1)], reports)
+                  for i, chain in enumerate(chains)]
+    chains = [[(vertices, indices, None) for vertices, indices in chain] for chain in chains]
+
+    if cache is not None:
+        empty = (numpy.zeros(0, numpy.float32), numpy.zeros(0, numpy.int32), None)
+        for i, level in enumerate(levels):
+            cache.store(path, [chain[i] if i < len(chain) else empty for chain in chains], level)
+
+    return chains
+
+
+def load_meshes(path, processing=None, nodes=None):
+    """ Parse a model file with PyAssimp into (vertices, indices) pairs.
+
+    Vertices are interleaved x, y, z, r, g, b float32 as PrimitiveShape expects and
+    indices are int32 triangles. Only NumPy arrays are returned, so this can run on a
+    thread or in a separate process.
+    The vertices are in the space of the meshes themselves. When a nodes list is given,
+    the node graph placing them is added to it as (parent, matrix, meshes) tuples, parents
+    before their children and -1 for the parent of the root. The matrix is the node's
+    transform relative to its parent in Pyrr's layout, and meshes are indices into the
+    returned pairs, the same mesh may appear in several nodes.
+    """
+    import pyassimp
+    from pyassimp import postprocess
+
+    # Sorting by primitive type moves points and lines into meshes of their own, which are skipped below
+    if processing is None:
+        processing = postprocess.aiProcess_Triangulate | postprocess.aiProcess_SortByPType | \
+            postprocess.aiProcess_JoinIdenticalVertices
+
+    meshes = []
+    kept = {}  # Position among the returned meshes of each PyAssimp mesh kept, by its index in the model
+
+    with pyassimp.load(path, processing=processing) as model:
+        for i, mesh in enumerate(model.meshes):
+            positions = numpy.asarray(mesh.vertices, numpy.float32).reshape(-1, 3)
+
+            # Points and lines are left out, only triangles can be drawn. Faces all of one size come as
+            # an array, mixed sizes cannot be turned into one and are picked one by one
+            faces = mesh.faces
+            if not (isinstance(faces, numpy.ndarray) and faces.ndim == 2):
+                faces = [face for face in faces if len(face) == 3]
+            faces = numpy.asarray(faces, numpy.int32)
+
+            if len(positions) == 0 or faces.ndim != 2 or faces.shape[1] != 3 or len(faces) == 0:
+                continue
+
+            vertices = numpy.empty((len(positions), 6), numpy.float32)
+            vertices[:, :3] = positions
+
+            colors = numpy.asarray(mesh.colors[0], numpy.float32) if len(mesh.colors) > 0 else None
+            if colors is not None and len(colors) == len(positions):
+                vertices[:, 3:] = colors[:, :3]
+            else:
+                vertices[:, 3:] = _DEFAULT_COLOR
+
+            kept[i] = len(meshes)
+            meshes.append((vertices.ravel(), faces.ravel()))
+
+        if nodes is not None and model.rootnode is not None:
+            model_indices = {id(mesh): i for i, mesh in enumerate(model.meshes)}
+            _walk_nodes(model.rootnode, -1, lambda mesh: kept.get(model_indices.get(id(mesh), mesh)), nodes)
+
+    return meshes
+
+
+def _walk_nodes(node, parent, position, nodes):
+    # Assimp matrices transform column vectors, Pyrr's row vectors
+    matrix = numpy.asarray(node.transformation, numpy.float32).reshape(4, 4).T
+
+    # PyAssimp resolves a node's mesh indices to the meshes themselves, position() takes either
+    node_meshes = [position(mesh) for mesh in node.meshes]
+    node_meshes = numpy.array([mesh for mesh in node_meshes if mesh is not None], numpy.int32)
+
+    index = len(nodes)
+    nodes.append((parent, matrix, node_meshes))
+
+    for child in node.children:
+        _walk_nodes(child, index, position, nodes)
+
+
+def _node_shape(matrix):
+    """ A hierarchy placed by a node matrix, split into the translation, rotation and scale shapes have. """
+    shape = HierarchicalShape()
+
+    # Rows of the upper 3x3 are the scaled axes, a mirrored node flips the first one. Shear is lost
+    scale = numpy.linalg.norm(matrix[:3, :3], axis=1)
+    if numpy.linalg.det(matrix[:3, :3]) < 0:
+        scale[0] = -scale[0]
+    scale[scale == 0] = 1.0
+
+    rotation = numpy.identity(4, numpy.float32)
+    rotation[:3, :3] = matrix[:3, :3] / scale[:, None]
+
+    shape.translation_matrix = Matrix44.from_translation(matrix[3, :3])
+    shape.rotation_matrix = Matrix44(rotation)
+    shape.scale_matrix = Matrix44.from_scale(scale)
+
+    return shape
+
+
+class ImportJob:
+    """ Progress of one model import, from parsing on a worker to uploading on the render thread. """
+
+    def __init__(self, path):
+        self.path = path
+        self.state = QUEUED
+        self.error = None
+        self.root = HierarchicalShape()
+        self.future = None
+        self.reports = []  # (name, OptimizationReport) of each mesh optimized while parsing
+
+        self._meshes = []
+        self._nodes = []  # The model's node graph as load_meshes gives it
+        self._placements = []  # The node hierarchies each mesh is added to
+        self._uploaded = 0
+        self._streaming = None  # Mesh being uploaded, held until its shapes are added
+        self._cancelled = threading.Event()
+        self._finished = threading.Event()
+
+    @property
+    def progress(self):
+        """ 0.0 to 1.0, the first half for parsing and the second for uploading. """
+        if self.state in [QUEUED, PARSING]:
+            return 0.0
+        if self.state == DONE:
+            return 1.0
+        if not self._meshes:
+            return 0.5
+        return 0.5 + 0.5 * self._uploaded / len(self._meshes)
+
+    def done(self):
+        return self.state in [DONE, CANCELLED, FAILED]
+
+    def cancel(self):
+        if self.done():
+            return
+
+        self._cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def wait(self, timeout=None):
+        """ Wait until parsing finished. Uploading still happens on the render thread. """
+        return self._finished.wait(timeout)
+
+
+class ModelImporter:
+    """ Parses model files on a worker pool and uploads the meshes on the render thread.
+
+    Call process_uploads() once per frame from the thread owning the GL context.
+    It uploads parsed meshes in chunks until the frame's time budget is used up,
+    so a large import, or a single large mesh, is spread over several frames
+    instead of stalling one.
+    on_parsed is called from the worker thread whenever a model finished parsing,
+    for instance to wake up a render loop sleeping until the next event.
+    """
+
+    def __init__(self, workers=_DEFAULT_WORKERS, upload_budget=_DEFAULT_UPLOAD_BUDGET, executor=None, cache=None,
+                 on_parsed=None):
+        if upload_budget is None or upload_budget < 0:
+            raise ValueError('Upload budget must be 0 or more seconds')
+
+        self.upload_budget = upload_budget
+        self.cache = cache
+        self.on_parsed = on_parsed
+        self.jobs = []
+        self._executor = executor if executor is not None else ThreadPoolExecutor(max_workers=workers)
+        self._parsed = queue.Queue()
+        self._uploading = []
+
+    def import_model(self, path, processing=None, optimize=False, lods=False):
+        if path is None:
+            raise ValueError('Model path cannot be None')
+
+        job = ImportJob(path)
+        job.state = PARSING
+        job.future = self._executor.submit(load_model, path, processing, self.cache, optimize, lods, job.reports,
+                                           job._nodes)
+        job.future.add_done_callback(lambda future: self._parse_done(job, future))
+        self.jobs.append(job)
+
+        return job
+
+    def _parse_done(self, job, future):
+        # Runs on the worker thread, the render thread picks the job up in process_uploads
+        if future.cancelled() or job.cancelled():
+            job.state = CANCELLED
+        elif future.exception() is not None:
+            job.error = future.exception()
+            job.state = FAILED
+        else:
+            job._meshes = future.result()
+            job.state = UPLOADING
+            self._parsed.put(job)
+
+        job._finished.set()
+
+        if self.on_parsed is not None:
+            self.on_parsed()
+
+    def pending(self):
+        return any(not job.done() for job in self.jobs)
+
+    def uploading(self):
+        """ Whether parsed meshes are waiting for process_uploads(). """
+        return bool(self._uploading) or not self._parsed.empty()
+
+    def process_uploads(self, scene, budget=None):
+        """ Upload parsed meshes into the scene for at most budget seconds. Returns the number of chunks uploaded.
+
+        The meshes completed in a frame are added to the scene together, so it rebuilds once for all of them.
+        """
+        if budget is None:
+            budget = self.upload_budget
+
+        while not self._parsed.empty():
+            job = self._parsed.get_nowait()
+            self._build_nodes(job)
+            scene.add_shape(job.root)
+            self._uploading.append(job)
+
+        start = time.perf_counter()
+        uploaded = 0
+        finished = {}  # Shapes of the meshes completed this frame by the node they go into
+        held = []
+
+        # At least one chunk goes up every frame, so imports always make progress
+        while self._uploading and (uploaded == 0 or time.perf_counter() - start < budget):
+            job = self._uploading[0]
+
+            if job.cancelled():
+                scene.remove_shape(job.root)
+                if job._streaming is not None:
+                    held.append(job._streaming)
+                    job._streaming = None
+                job.state = CANCELLED
+                self._uploading.pop(0)
+                continue
+
+            if job._uploaded == len(job._meshes):
+                job.state = DONE
+                self._uploading.pop(0)
+                continue
+
+            vertices, indices, geometry_key, lods = job._meshes[job._uploaded]
+            if not job._placements[job._uploaded]:
+                job._uploaded += 1
+                continue
+
+            # Encoding a big mesh compact would take longer than the frame's budget and copy the mapped cache
+            # arrays, so imported meshes go to the GPU in the layout they were parsed in
+            if job._streaming is None:
+                job._streaming = mesh_registry.acquire(vertices, indices, layout=STANDARD, key=geometry_key, lods=lods,
+                                                       streamed=True)
+
+            job._streaming.stream(_UPLOAD_CHUNK)
+            uploaded += 1
+
+            if job._streaming.streaming():
+                continue
+
+            # A mesh used by several nodes goes up once, the shapes share it through its key
+            for node in job._placements[job._uploaded]:
+                shape = PrimitiveShape(vertices, indices, geometry_key, layout=STANDARD, lods=lods)
+                finished.setdefault(node, []).append(shape)
+
+            held.append(job._streaming)
+            job._streaming = None
+            job._uploaded += 1
+
+        for node, shapes in finished.items():
+            node.add_children(shapes)
+
+        # The shapes hold the meshes now, which the uploads held until here
+        for mesh in held:
+            mesh_registry.release(mesh)
+
+        self.jobs = [job for job in self.jobs if not job.done()]
+
+        return uploaded
+
+    @staticmethod
+    def _build_nodes(job):
+        """ Mirror the model's node graph below the job's root and find the nodes each mesh goes into. """
+        if not job._nodes:
+            job._placements = [[job.root] for _ in job._meshes]
+            return
+
+        job._placements = [[] for _ in job._meshes]
+        shapes = []
+
+        for parent, matrix, node_meshes in job._nodes:
+            shape = _node_shape(matrix)
+            (job.root if parent < 0 else shapes[parent]).add_child(shape)
+            shapes.append(shape)
+            for mesh in node_meshes:
+                job._placements[mesh].append(shape)
+
+    def shutdown(self):
+        for job in self.jobs:
+            job.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
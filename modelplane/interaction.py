@@ -1,19 +1,101 @@
+import collections
 import math
 
 import glfw
+import numpy
 
 from OpenGL.GL import *
 from pyrr import Matrix44
 
 from modelplane.camera import Camera
+from modelplane.gfx.profiler import FrameProfiler
 
 _MAX_KEYS = 1024
 _MAX_MOUSE_BUTTONS = 32
+_DEFAULT_QUEUE_SIZE = 1024  # Events between two frames, several times what a 1000 Hz mouse sends at 60 Hz
+_LATENCY_HISTORY = 1000  # Events kept for the latency percentiles
+_MAX_STEP = 0.1  # Seconds of motion a frame may apply at most, so the first frame after idling does not jump
+
+# Kinds of queued events
+_MOVE = 0
+_SCROLL = 1
+_BUTTON = 2
+_KEY = 3
+
+
+class EventQueue:
+    """ Fixed size ring of timestamped input events, stored as rows of floats.
+
+    Every row is kind, time and up to four arguments. When the ring is full,
+    two queued cursor moves in a row are merged to make room, so presses and
+    releases are not lost. Merged or lost events are counted in dropped.
+    """
+
+    _FIELDS = 6
+
+    def __init__(self, capacity=_DEFAULT_QUEUE_SIZE):
+        if capacity < 1:
+            raise ValueError('Event queue needs room for at least one event')
+
+        self._events = numpy.zeros((capacity, self._FIELDS), numpy.float64)
+        self._first = 0
+        self._count = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self._count
+
+    def push(self, kind, time, a=0.0, b=0.0, c=0.0, d=0.0):
+        if self._count == len(self._events):
+            self._make_room()
+
+        self._events[(self._first + self._count) % len(self._events)] = kind, time, a, b, c, d
+        self._count += 1
+
+    def _make_room(self):
+        self.dropped += 1
+        events = self._ordered()
+
+        # Two cursor moves in a row become one at the later position with the earlier time; only
+        # when there are none is the oldest event lost
+        moves = numpy.nonzero((events[:-1, 0] == _MOVE) & (events[1:, 0] == _MOVE))[0]
+        if len(moves):
+            first = moves[0]
+            events[first, 2:] = events[first + 1, 2:]
+            events = numpy.delete(events, first + 1, axis=0)
+        else:
+            events = events[1:]
+
+        self._events[:len(events)] = events
+        self._first = 0
+        self._count = len(events)
+
+    def _ordered(self):
+        end = self._first + self._count
+        if end <= len(self._events):
+            return self._events[self._first:end].copy()
+        return numpy.concatenate([self._events[self._first:], self._events[:end - len(self._events)]])
+
+    def drain(self):
+        """ The queued events, oldest first, as a list of row lists. The queue is empty afterwards. """
+        events = self._ordered().tolist()
+        self._first = 0
+        self._count = 0
+        return events
 
 
 class Interaction:
+    """ Mouse and keyboard handling for a window.
+
+    The GLFW callbacks only queue timestamped events. process(), called once a
+    frame, applies them all: the drags of the frame turn the trackball in one
+    go and the scrolls add up to one move of the camera. Holding W or the up
+    arrow zooms in and S or the down arrow out, by key_zoom_rate scroll steps a
+    second of the time between frames. The time from an event to the frame
+    showing it being presented is kept as the input latency.
+    """
 
-    def __init__(self, window):
+    def __init__(self, window, queue_size=_DEFAULT_QUEUE_SIZE):
         if not window:
             raise ValueError('Interaction window is None')
 
@@ -23,14 +105,27 @@ class Interaction:
         self.cameras = [Camera()]
         self.active_camera = 0
         self.zoom_sensitivity = 0.1
+        self.key_zoom_rate = 10.0
         self.xmove_sensitivity = 0.20
         self.ymove_sensitivity = 0.20
 
-        self.last_frame = 0.0
+        # Time of the last frame's process() call and the time since the one before
+        self.last_frame = None
         self.delta_time = 0.0
 
+        self.events = EventQueue(queue_size)
+        self.latencies = collections.deque(maxlen=_LATENCY_HISTORY)
+        self._shown_times = []
+
+        # Set whenever the camera moved, cleared by the viewer after drawing
+        self.dirty = True
+
         self.window = window
 
+        # Window size, kept up to date by the viewer through resize() so events need not query it
+        self.width, self.height = 0, 0
+        self.resize(*glfw.get_window_size(window))
+
         # current mouse location
         self.mouse_location = None
         self.callbacks = {}
@@ -44,8 +139,13 @@ class Interaction:
         glfw.set_input_mode(self.window, glfw.CURSOR, glfw.CURSOR_NORMAL)  # TODO ???
         glfw.set_cursor_pos_callback(self.window, self._handle_mouse_move)
 
+    def resize(self, width, height):
+        # The viewer fits the cameras to their viewports
+        self.width, self.height = width, height
+
     def translate(self, x, y, z):
         self.cameras[self.active_camera].translate(x, y, z)
+        self.dirty = True
 
     def camera(self):
         return self.cameras[self.active_camera]
@@ -55,13 +155,102 @@ class Interaction:
 
     def register_callback(self, call_by, action_func):
         if call_by and action_func:
-            self.callbacks[call_by] = action_func
+            self.callbacks.setdefault(call_by, []).append(action_func)
         else:
             raise ValueError('Attempt to register None callback')
 
+    def process(self, now=None, frame=True):
+        """ Apply the events queued since the last call. Returns whether the view changed.
+
+        With frame=False, as while waiting for events between frames, nothing time based
+        happens and the frame timing is left alone.
+        """
+        moved = False
+        if frame:
+            if now is None:
+                now = glfw.get_time()
+
+            self.delta_time = now - self.last_frame if self.last_frame is not None else 0.0
+            self.last_frame = now
+            moved = self._zoom_keys(min(self.delta_time, _MAX_STEP))
+
+        if len(self.events) == 0:
+            return moved
+
+        drags = []
+        scroll = 0.0
+        changed_times = []
+
+        for kind, time, a, b, c, d in self.events.drain():
+            if kind == _MOVE:
+                if self._move(a, b, drags):
+                    changed_times.append(time)
+            elif kind == _SCROLL:
+                scroll += b
+                changed_times.append(time)
+            else:
+                # A press or release changes what the moves after it do, so the drags so far go first
+                self._apply_drags(drags)
+                if kind == _BUTTON:
+                    self._mouse_button(int(a), int(b), c, d)
+                else:
+                    self._key(int(a), int(b))
+
+        self._apply_drags(drags)
+        if scroll:
+            self._scroll(scroll)
+
+        # Events applied between frames are shown by the next one, so they count from its present too
+        if changed_times:
+            self._shown_times.extend(changed_times)
+            self.dirty = True
+
+        return moved or bool(changed_times)
+
+    def _zoom_direction(self):
+        pressed = self._key_pressed
+        return (pressed[glfw.KEY_W] or pressed[glfw.KEY_UP]) - (pressed[glfw.KEY_S] or pressed[glfw.KEY_DOWN])
+
+    def moving(self):
+        """ Whether a held key keeps the camera moving, so frames have to keep coming. """
+        return self._zoom_direction() != 0
+
+    def _zoom_keys(self, seconds):
+        direction = self._zoom_direction()
+        if direction == 0 or seconds <= 0.0:
+            return False
+
+        self._scroll(direction * self.key_zoom_rate * seconds)
+        return True
+
+    def presented(self, now=None):
+        """ Record the latency of the events applied since the last presented frame, to call after swapping. """
+        if now is None:
+            now = glfw.get_time()
+
+        self.latencies.extend(now - time for time in self._shown_times)
+        self._shown_times.clear()
+
+    def latency_percentiles(self):
+        """ p50, p90 and p99 of the event to present latency, in milliseconds. """
+        return FrameProfiler.percentiles(self.latencies)
+
     def _handle_key(self, window, key, scancode, action, mode):
+        self.events.push(_KEY, glfw.get_time(), key, action)
+
+    def _handle_mouse_button(self, window, button, action, mods):
+        x, y = glfw.get_cursor_pos(window)
+        self.events.push(_BUTTON, glfw.get_time(), button, action, x, y)
+
+    def _handle_scroll_wheel(self, window, xoff, yoff):
+        self.events.push(_SCROLL, glfw.get_time(), xoff, yoff)
+
+    def _handle_mouse_move(self, window, x, y):
+        self.events.push(_MOVE, glfw.get_time(), x, y)
+
+    def _key(self, key, action):
         if key == glfw.KEY_ESCAPE and action == glfw.PRESS:
-            glfw.set_window_should_close(window, GL_TRUE)
+            glfw.set_window_should_close(self.window, GL_TRUE)
 
         if key in range(len(self._key_pressed)):
             if action == glfw.PRESS:
@@ -69,23 +258,21 @@ class Interaction:
             elif action == glfw.RELEASE:
                 self._key_pressed[key] = False
 
-    def _handle_mouse_button(self, window, button, action, mods):
+    def _mouse_button(self, button, action, x, y):
         if button not in range(len(self._mb_pressed)):
             raise ValueError('Mouse button not supported')
 
-        width, height = glfw.get_window_size(window)
-
-        x, y = glfw.get_cursor_pos(window)
-        y = height - y  # invert y coordinate because OpenGL is inverted
+        y = self.height - y  # invert y coordinate because OpenGL is inverted
 
         self.mouse_location = (x, y)
 
         if action == glfw.PRESS:
             self._mb_pressed[button] = True
+            self._trigger('mouse_press', button, x, y)
         elif action == glfw.RELEASE:
             self._mb_pressed[button] = False
 
-    def _handle_scroll_wheel(self, window, xoff, yoff):
+    def _scroll(self, yoff):
         cam_pos = self.camera().position
 
         if math.isclose(cam_pos[0], 0.0) and math.isclose(cam_pos[1], 0.0) and \
@@ -94,16 +281,28 @@ class Interaction:
 
         self.translate(0.0, 0.0, yoff * self.zoom_sensitivity)
 
-    def _handle_mouse_move(self, window, x, y):
-        width, height = glfw.get_window_size(window)
+    def _move(self, x, y, drags):
+        """ Follow the cursor, adding a trackball drag while the middle button is held. Returns whether it was one. """
+        dragging = self._mb_pressed[glfw.MOUSE_BUTTON_MIDDLE] and self.camera().trackball is not None \
+            and self.mouse_location is not None
 
-        if self._mb_pressed[glfw.MOUSE_BUTTON_MIDDLE] and self.camera().trackball is not None:
+        if dragging:
             dx = (x - self.mouse_location[0]) * self.xmove_sensitivity
             dy = (y - self.mouse_location[1]) * self.ymove_sensitivity
-            x, y, dx, dy = self._wrap_around(window, width, height, x, y, dx, dy)
-            self.camera().trackball.drag_to(self.mouse_location[0], self.mouse_location[1], dx, dy)
+            x, y, dx, dy = self._wrap_around(self.window, self.width, self.height, x, y, dx, dy)
+
+            # The trackball works in the pixels of the camera's own viewport
+            left, bottom, _, height = self.camera().viewport
+            top = self.height - bottom - height
+            drags.append((self.mouse_location[0] - left, self.mouse_location[1] - top, dx, dy))
 
         self.mouse_location = (x, y)
+        return dragging
+
+    def _apply_drags(self, drags):
+        if drags:
+            self.camera().trackball.drag_many(drags)
+            drags.clear()
 
     @staticmethod
     def _wrap_around(window, width, height, x, y, dx, dy):
@@ -131,5 +330,5 @@ class Interaction:
         return x, y, dx, dy
 
     def _trigger(self, call_by, *args, **kwargs):
-        for action_func in self.callbacks[call_by]:
+        for action_func in self.callbacks.get(call_by, []):
             action_func(*args, **kwargs)
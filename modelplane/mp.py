@@ -1,16 +1,108 @@
-import modelplane.about as about
+import argparse
+import sys
 
-from modelplane.gfx.viewer import Viewer
+import modelplane.about as about
+from modelplane.startup import StartupTimer
 
 _WIDTH = 1000
 _HEIGHT = 800
 
 
-def main():
+def main(argv=None):
+    startup = StartupTimer()
+
+    parser = argparse.ArgumentParser(description=f'{about.MP_TITLE} model viewer.')
+    parser.add_argument('models', nargs='*', help='Model files to import')
+    parser.add_argument('--headless', metavar='OUTPUT', default=None,
+                        help='Render a single frame without a window and save it as an image')
+    parser.add_argument('--profile', metavar='TRACE', nargs='?', const='', default=None,
+                        help='Print frame timings on exit and write a Chrome trace JSON when a path is given')
+    parser.add_argument('--continuous', action='store_true',
+                        help='Draw every frame instead of only when something changed')
+    parser.add_argument('--frame-cap', type=float, default=None, metavar='FPS', help='Limit the frames per second')
+    parser.add_argument('--optimize', action='store_true',
+                        help='Reorder imported meshes for the vertex cache and overdraw')
+    parser.add_argument('--lod', action='store_true',
+                        help='Build levels of detail for dense meshes and draw distant ones simplified')
+    parser.add_argument('--quad', action='store_true', help='Split the window into front, top, side and free views')
+    parser.add_argument('--release', action='store_true',
+                        help='Turn off the per call OpenGL error checks of the debug profile, whatever '
+                             'MODELPLANE_GL_PROFILE says')
+    parser.add_argument('--startup', metavar='JSON', nargs='?', const='', default=None,
+                        help='Print how long each startup phase took and write them as JSON when a path is given')
+    parser.add_argument('--startup-budget', type=float, default=None, metavar='MS',
+                        help='Time to the first frame to report the startup against')
+    parser.add_argument('--size', nargs=2, type=int, default=[_WIDTH, _HEIGHT], metavar=('WIDTH', 'HEIGHT'))
+    args = parser.parse_args(argv)
+
     print(f'{about.MP_TITLE} version {about.MP_VERSION}')
-    viewer = Viewer(_WIDTH, _HEIGHT, about.MP_TITLE)
-    viewer.main_loop()
+
+    if args.startup_budget is not None:
+        startup.budget = args.startup_budget / 1e3
+
+    # Nothing heavy is imported before the arguments are known to be good
+    with startup.phase('imports'):
+        # PyOpenGL reads its checking switches on first import as well
+        # Without --release the MODELPLANE_GL_PROFILE variable decides, debug when it is not set
+        from modelplane.gfx.runtime import select_profile, RELEASE
+        select_profile(RELEASE if args.release else None)
+
+        if args.headless is not None:
+            # PyOpenGL picks its platform on first import, so this has to happen before the viewer is imported
+            from modelplane.gfx.offscreen import select_platform
+            select_platform()
+
+        from modelplane.gfx.state import gl_state
+        from modelplane.gfx.viewer import Viewer, CONTINUOUS, ON_DEMAND
+        from modelplane.importer import FAILED
+
+    width, height = args.size
+    viewer = Viewer(width, height, about.MP_TITLE, headless=args.headless is not None,
+                    profile=args.profile is not None, render_mode=CONTINUOUS if args.continuous else ON_DEMAND,
+                    frame_cap=args.frame_cap, startup=startup)
+
+    if args.quad:
+        viewer.quad_view()
+
+    jobs = [viewer.import_model(path, optimize=args.optimize, lods=args.lod) for path in args.models]
+
+    if args.headless is None:
+        viewer.main_loop()
+    else:
+        with startup.phase('models'):
+            for job in jobs:
+                job.wait()
+
+        failed = [job for job in jobs if job.state == FAILED]
+        if failed:
+            viewer.shutdown()
+            for job in failed:
+                print(f'Error: Failed to import {job.path}: {job.error}', file=sys.stderr)
+            sys.exit(1)
+
+        viewer.snapshot(args.headless)
+        viewer.shutdown()
+        print(f'Saved {args.headless}')
+
+    if args.optimize:
+        for job in jobs:
+            for name, report in job.reports:
+                print(f'{job.path} {name}: {report}')
+
+    if args.profile is not None:
+        print(viewer.profiler.report())
+        print(gl_state.report())
+        latency = viewer.input_latency()
+        if latency is not None:
+            print('input latency ms p50 / p90 / p99: ' + ' / '.join(f'{t:.2f}' for t in latency))
+        if args.profile:
+            viewer.profiler.write_chrome_trace(args.profile)
+
+    if args.startup is not None:
+        print(startup.report())
+        if args.startup:
+            startup.write_json(args.startup)
 
 
 if __name__ == '__main__':
-    main()
+    main(sys.argv[1:])
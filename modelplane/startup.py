@@ -0,0 +1,59 @@
+import contextlib
+import json
+import time
+
+
+class StartupTimer:
+    """ Wall time of each phase from launch to the first frame on screen.
+
+    Kept free of heavy imports so it can be created before anything else is
+    loaded. Phases are timed with phase(), the first frame is marked once with
+    first_frame(). With a budget in seconds, the report says whether the time
+    to the first frame stayed within it.
+    """
+
+    def __init__(self, budget=None):
+        self.start = time.perf_counter()
+        self.budget = budget
+        self.phases = []  # (name, seconds) in the order they ran
+        self.time_to_first_frame = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+
+    def first_frame(self):
+        if self.time_to_first_frame is None:
+            self.time_to_first_frame = time.perf_counter() - self.start
+
+    def summary(self):
+        """ {'phases': {name: ms}, 'first_frame': ms, 'budget': ms}, phases run more than once added up. """
+        phases = {}
+        for name, seconds in self.phases:
+            phases[name] = phases.get(name, 0.0) + seconds * 1e3
+
+        return {'phases': phases,
+                'first_frame': self.time_to_first_frame * 1e3 if self.time_to_first_frame is not None else None,
+                'budget': self.budget * 1e3 if self.budget is not None else None}
+
+    def report(self):
+        summary = self.summary()
+        lines = [f'{"startup phase":14} {"ms":>10}']
+        lines += [f'{name:14} {ms:>10.1f}' for name, ms in summary['phases'].items()]
+
+        first_frame = summary['first_frame']
+        if first_frame is not None:
+            lines.append(f'{"first frame":14} {first_frame:>10.1f}')
+            if summary['budget'] is not None:
+                verdict = 'within' if first_frame <= summary['budget'] else 'over'
+                lines.append(f'{verdict} the {summary["budget"]:.0f} ms budget')
+
+        return '\n'.join(lines)
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)